@@ -2,11 +2,13 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import bisect
 import json
 import os
+import StringIO
 import subprocess
+import tempfile
 import time
-import urllib2
 import urlparse
 
 import cherrypy
@@ -14,18 +16,43 @@ import cherrypy
 from build_util import BuildObject
 import autoupdate_lib
 import common_util
+import fs_util
+import host_info
+import lock_util
 import log_util
+import metrics
+import remote_metadata
+import trace_util
+import update_stats
+import version_util
 
 
 # Module-local log function.
-def _Log(message, *args):
-  return log_util.LogWithTag('UPDATE', message, *args)
+def _Log(message, *args, **kwargs):
+  return log_util.LogWithTag('UPDATE', message, *args, **kwargs)
 
 
 UPDATE_FILE = 'update.gz'
 METADATA_FILE = 'update.meta'
 STATEFUL_FILE = 'stateful.tgz'
 CACHE_DIR = 'cache'
+# Hidden directory of the cache holding the lock file of each cache entry.
+CACHE_LOCK_DIR = '.locks'
+
+# Prefix of payload generator commands run at the lowest CPU priority.
+_NICE_COMMAND = ['nice', '-n', '19']
+
+_UPDATE_PINGS = metrics.Counter(
+    'devserver_update_pings_total',
+    'Update pings handled, by Omaha protocol and result (update, noupdate, '
+    'event or error).', ('protocol', 'result'))
+_UPDATE_PING_SECONDS = metrics.Histogram(
+    'devserver_update_ping_seconds',
+    'Time taken to handle an update ping, by Omaha protocol.', ('protocol',))
+_PAYLOAD_GENERATION_SECONDS = metrics.Histogram(
+    'devserver_payload_generation_seconds',
+    'Time taken to generate an update payload, by kind (full or delta).',
+    ('kind',))
 
 
 class AutoupdateError(Exception):
@@ -33,6 +60,24 @@ class AutoupdateError(Exception):
   pass
 
 
+class NoUpdateError(AutoupdateError):
+  """Raised when the client is already up to date."""
+  pass
+
+
+def GetCacheLockPath(cache_entry):
+  """Returns the path of the lock file of a cache entry.
+
+  Lock files are kept in a hidden directory of the cache, so that they are
+  neither counted nor removed as cache entries.
+
+  Args:
+    cache_entry: path of the cache entry, e.g. static/cache/<hash>.
+  """
+  return os.path.join(os.path.dirname(cache_entry), CACHE_LOCK_DIR,
+                      os.path.basename(cache_entry))
+
+
 def _ChangeUrlPort(url, new_port):
   """Return the URL passed in with a different port"""
   scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
@@ -53,57 +98,6 @@ def _NonePathJoin(*args):
   return os.path.join(*filter(None, args))
 
 
-class HostInfo(object):
-  """Records information about an individual host.
-
-  Members:
-    attrs: Static attributes (legacy)
-    log: Complete log of recorded client entries
-  """
-
-  def __init__(self):
-    # A dictionary of current attributes pertaining to the host.
-    self.attrs = {}
-
-    # A list of pairs consisting of a timestamp and a dictionary of recorded
-    # attributes.
-    self.log = []
-
-  def __repr__(self):
-    return 'attrs=%s, log=%s' % (self.attrs, self.log)
-
-  def AddLogEntry(self, entry):
-    """Append a new log entry."""
-    # Append a timestamp.
-    assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
-    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
-    # Add entry to hosts' message log.
-    self.log.append(entry)
-
-
-class HostInfoTable(object):
-  """Records information about a set of hosts who engage in update activity.
-
-  Members:
-    table: Table of information on hosts.
-  """
-
-  def __init__(self):
-    # A dictionary of host information. Keys are normally IP addresses.
-    self.table = {}
-
-  def __repr__(self):
-    return '%s' % self.table
-
-  def GetInitHostInfo(self, host_id):
-    """Return a host's info object, or create a new one if none exists."""
-    return self.table.setdefault(host_id, HostInfo())
-
-  def GetHostInfo(self, host_id):
-    """Return an info object for given host, if such exists."""
-    return self.table.get(host_id)
-
-
 class UpdateMetadata(object):
   """Object containing metadata about an update payload."""
 
@@ -134,7 +128,13 @@ class Autoupdate(BuildObject):
     critical_update:  whether provisioned payload is critical.
     remote_payload:   whether provisioned payload is remotely staged.
     max_updates:      maximum number of updates we'll try to provision.
-    host_log:         record full history of host update events.
+    host_log:         record history of host update events.
+    host_log_size:    number of most recent events recorded per host.
+    host_memory_budget:  memory budget for host records, in bytes.
+    client_deltas:    serve clients deltas from their reported version, when
+                      the image of that version is around.
+    payload_scheduler:  if set, a payload_prewarmer.PayloadPrewarmer that
+                        generates client deltas in the background.
   """
 
   _PAYLOAD_URL_PREFIX = '/static/'
@@ -150,7 +150,9 @@ class Autoupdate(BuildObject):
                proxy_port=None, src_image='', vm=False, board=None,
                copy_to_static_root=True, private_key=None,
                critical_update=False, remote_payload=False, max_updates= -1,
-               host_log=False, *args, **kwargs):
+               host_log=False, host_log_size=host_info.DEFAULT_LOG_SIZE,
+               host_memory_budget=host_info.DEFAULT_MEMORY_BUDGET,
+               client_deltas=False, *args, **kwargs):
     super(Autoupdate, self).__init__(*args, **kwargs)
     self.serve_only = serve_only
     self.use_test_image = test_image
@@ -171,15 +173,38 @@ class Autoupdate(BuildObject):
     self.remote_payload = remote_payload
     self.max_updates = max_updates
     self.host_log = host_log
+    self.client_deltas = client_deltas
+    self.payload_scheduler = None
+
+    # Latest image dir per board, and the default board, each with the mtime
+    # they were found at; see _GetLatestImageDir and _GetDefaultBoardID.
+    self._latest_image_dirs = {}
+    self._default_board = None
 
-    # Path to pre-generated file.
+    # Memoized MD5 hashes of images, keyed by path; see _GetFileMd5.
+    self._file_md5s = {}
+    # Images of each version in an images dir, keyed by that dir; see
+    # FindVersionImage.
+    self._version_images = {}
+
+    # Path to pre-generated file, and the image it was generated from.
     self.pregenerated_path = None
+    self._pregenerated_image = None
 
     # Initialize empty host info cache. Used to keep track of various bits of
     # information about a given host.  A host is identified by its IP address.
-    # The info stored for each host includes a complete log of events for this
+    # The info stored for each host includes a log of recent events for this
     # host, as well as a dictionary of current attributes derived from events.
-    self.host_infos = HostInfoTable()
+    # No event log memory is set aside unless events are recorded.
+    self.host_infos = host_info.HostInfoTable(
+        log_size=host_log_size if host_log else 0,
+        memory_budget=host_memory_budget)
+
+    # Recently retrieved file info of remote payloads, keyed by URL.
+    self._remote_metadata = remote_metadata.MetadataCache()
+
+    # Fleet-wide counts of update checks and events, in fixed memory.
+    self.update_stats = update_stats.UpdateStats()
 
   @classmethod
   def _ReadMetadataFromStream(cls, stream):
@@ -212,21 +237,64 @@ class Autoupdate(BuildObject):
                  cls.SIZE_ATTR: metadata_obj.size,
                  cls.ISDELTA_ATTR: metadata_obj.is_delta_format}
     metadata_file = os.path.join(payload_dir, METADATA_FILE)
-    with open(metadata_file, 'w') as file_handle:
-      json.dump(file_dict, file_handle)
+    # Concurrent update checks read the file while it is being written, so
+    # write it aside and rename it into place.
+    fd, temp_file = tempfile.mkstemp(dir=payload_dir, prefix=METADATA_FILE)
+    try:
+      with os.fdopen(fd, 'w') as file_handle:
+        json.dump(file_dict, file_handle)
+      os.chmod(temp_file, 0644)
+      os.rename(temp_file, metadata_file)
+    except:
+      os.remove(temp_file)
+      raise
 
   def _GetDefaultBoardID(self):
-    """Returns the default board id stored in .default_board."""
+    """Returns the default board id stored in .default_board.
+
+    The file is only read again once it changes.
+    """
     board_file = '%s/.default_board' % (self.scripts_dir)
     try:
-      return open(board_file).read()
-    except IOError:
+      mtime = os.path.getmtime(board_file)
+      if not self._default_board or self._default_board[0] != mtime:
+        with open(board_file) as board_stream:
+          self._default_board = (mtime, board_stream.read())
+      return self._default_board[1]
+    except (IOError, OSError):
       return 'x86-generic'
 
   def _GetLatestImageDir(self, board):
-    """Returns the latest image dir based on shell script."""
-    cmd = '%s/get_latest_image.sh --board %s' % (self.scripts_dir, board)
-    return os.popen(cmd).read().strip()
+    """Returns the latest image dir of a board, or '' if there is none.
+
+    Like get_latest_image.sh, this is the target of the `latest' link in the
+    board's images dir if there is one, or else its most recently modified
+    entry. The result is kept until the images dir changes.
+    """
+    images_dir = os.path.normpath(os.path.join(
+        self.scripts_dir, '..', 'build', 'images', board))
+    try:
+      mtime = os.path.getmtime(images_dir)
+    except OSError:
+      return ''
+
+    cached = self._latest_image_dirs.get(board)
+    if cached and cached[0] == mtime:
+      return cached[1]
+
+    latest_link = os.path.join(images_dir, 'latest')
+    if os.path.islink(latest_link):
+      latest_image_dir = os.path.join(images_dir, os.readlink(latest_link))
+    else:
+      entries = [os.path.join(images_dir, entry)
+                 for entry in os.listdir(images_dir)]
+      latest_image_dir = ''
+      if entries:
+        latest_image_dir = max(entries,
+                               key=lambda entry: os.lstat(entry).st_mtime)
+
+    self._latest_image_dirs[board] = (mtime, latest_image_dir)
+    return latest_image_dir
 
   @staticmethod
   def _GetVersionFromDir(image_dir):
@@ -246,26 +314,10 @@ class Autoupdate(BuildObject):
     """Returns true if the latest_version is greater than the client_version.
     """
     _Log('client version %s latest version %s', client_version, latest_version)
-
-    client_tokens = client_version.replace('_', '').split('.')
-    # If the client has an old four-token version like "0.16.892.0", drop the
-    # first two tokens -- we use versions like "892.0.0" now.
-    # TODO(derat): Remove the code for old-style versions after 20120101.
-    if len(client_tokens) == 4:
-      client_tokens = client_tokens[2:]
-
-    latest_tokens = latest_version.replace('_', '').split('.')
-    if len(latest_tokens) == 4:
-      latest_tokens = latest_tokens[2:]
-
-    for i in range(min(len(client_tokens), len(latest_tokens))):
-      if int(latest_tokens[i]) == int(client_tokens[i]):
-        continue
-      return int(latest_tokens[i]) > int(client_tokens[i])
-
-    # Favor four-token new-style versions on the server over old-style versions
-    # on the client if everything else matches.
-    return len(latest_tokens) > len(client_tokens)
+    # Old four-token versions on the client compare by their last two tokens,
+    # and lose to new-style versions on the server if everything else matches;
+    # see version_util.VersionKey.
+    return version_util.IsNewer(latest_version, client_version)
 
   def _GetImageName(self):
     """Returns the name of the image that should be used."""
@@ -289,11 +341,13 @@ class Autoupdate(BuildObject):
       # used in update_engine at all as of now.
       return False
 
-  def GenerateUpdateFile(self, src_image, image_path, output_dir):
+  def GenerateUpdateFile(self, src_image, image_path, output_dir,
+                         low_priority=False):
     """Generates an update gz given a full path to an image.
 
     Args:
       image_path: Full path to image.
+      low_priority: run the generator at the lowest CPU priority.
     Raises:
       subprocess.CalledProcessError if the update generator fails to generate a
       stateful payload.
@@ -301,7 +355,8 @@ class Autoupdate(BuildObject):
     update_path = os.path.join(output_dir, UPDATE_FILE)
     _Log('Generating update image %s', update_path)
 
-    update_command = [
+    update_command = list(_NICE_COMMAND) if low_priority else []
+    update_command += [
         'cros_generate_update_payload',
         '--image', image_path,
         '--output', update_path,
@@ -317,16 +372,18 @@ class Autoupdate(BuildObject):
     subprocess.check_call(update_command)
 
   @staticmethod
-  def GenerateStatefulFile(image_path, output_dir):
+  def GenerateStatefulFile(image_path, output_dir, low_priority=False):
     """Generates a stateful update payload given a full path to an image.
 
     Args:
       image_path: Full path to image.
+      low_priority: run the generator at the lowest CPU priority.
     Raises:
       subprocess.CalledProcessError if the update generator fails to generate a
       stateful payload.
     """
-    update_command = [
+    update_command = list(_NICE_COMMAND) if low_priority else []
+    update_command += [
         'cros_generate_stateful_update_payload',
         '--image', image_path,
         '--output_dir', output_dir,
@@ -334,6 +391,82 @@ class Autoupdate(BuildObject):
     _Log('Running %s', ' '.join(update_command))
     subprocess.check_call(update_command)
 
+  def _GetFileMd5(self, file_path):
+    """Returns the MD5 of a file, hashing it only if it changed since."""
+    try:
+      file_stat = os.stat(file_path)
+    except OSError:
+      return common_util.GetFileMd5(file_path)
+
+    key = (file_stat.st_mtime, file_stat.st_size)
+    cached = self._file_md5s.get(file_path)
+    metrics.RecordCacheLookup('image_md5', cached and cached[0] == key)
+    if cached and cached[0] == key:
+      return cached[1]
+    md5 = common_util.GetFileMd5(file_path)
+    self._file_md5s[file_path] = (key, md5)
+    return md5
+
+  def FindVersionImage(self, images_dir, version):
+    """Returns the path of the image of a version, or None if not around.
+
+    Args:
+      images_dir: directory holding the image dirs of a board, which are
+                  named after their versions (see _GetVersionFromDir).
+      version: version to find the image of.
+    """
+    try:
+      mtime = os.path.getmtime(images_dir)
+    except OSError:
+      return None
+
+    cached = self._version_images.get(images_dir)
+    if not cached or cached[0] != mtime:
+      images = {}
+      for image_dir in os.listdir(images_dir):
+        try:
+          image_version = self._GetVersionFromDir(image_dir)
+        except IndexError:
+          continue
+        images[image_version] = os.path.join(images_dir, image_dir,
+                                             self._GetImageName())
+      cached = self._version_images[images_dir] = (mtime, images)
+
+    image_path = cached[1].get(version)
+    if image_path and os.path.exists(image_path):
+      return image_path
+    return None
+
+  def _GetClientDelta(self, client_version, latest_image_path,
+                      static_image_dir):
+    """Returns the cached delta from the client's version, if ready.
+
+    If the delta hasn't been generated yet, it is scheduled for generation in
+    the background, so that later update checks of the same version get it.
+
+    Returns:
+      The delta's directory relative to static_image_dir, or None if there
+      is no delta to serve (yet).
+    """
+    images_dir = os.path.dirname(os.path.dirname(latest_image_path))
+    src_image = self.FindVersionImage(images_dir, client_version)
+    if not src_image:
+      return None
+
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image,
+                                                     latest_image_path)
+    # The metadata file is written once the payloads are complete.
+    if os.path.exists(os.path.join(static_image_dir, cache_sub_dir,
+                                   METADATA_FILE)):
+      _Log('Serving delta from %s', src_image)
+      return cache_sub_dir
+
+    if self.payload_scheduler:
+      self.payload_scheduler.Schedule(src_image, latest_image_path,
+                                      static_image_dir)
+    return None
+
+  @trace_util.TracedMethod
   def FindCachedUpdateImageSubDir(self, src_image, dest_image):
     """Find directory to store a cached update.
 
@@ -351,9 +484,9 @@ class Autoupdate(BuildObject):
     """
     update_dir = ''
     if src_image:
-      update_dir += common_util.GetFileMd5(src_image) + '_'
+      update_dir += self._GetFileMd5(src_image) + '_'
 
-    update_dir += common_util.GetFileMd5(dest_image)
+    update_dir += self._GetFileMd5(dest_image)
     if self.private_key:
       update_dir += '+' + common_util.GetFileMd5(self.private_key)
 
@@ -362,30 +495,84 @@ class Autoupdate(BuildObject):
 
     return os.path.join(CACHE_DIR, update_dir)
 
-  def GenerateUpdateImage(self, image_path, output_dir):
+  @trace_util.TracedMethod
+  def GenerateUpdateImage(self, image_path, output_dir, src_image=None,
+                          low_priority=False):
     """Force generates an update payload based on the given image_path.
 
     Args:
-      src_image: image we are updating from (Null/empty for non-delta)
       image_path: full path to the image.
       output_dir: the directory to write the update payloads to
+      src_image: image we are updating from; defaults to self.src_image
+        (Null/empty for non-delta)
+      low_priority: run the generators at the lowest CPU priority.
     Raises:
       AutoupdateError if it failed to generate either update or stateful
         payload.
     """
+    if src_image is None:
+      src_image = self.src_image
     _Log('Generating update for image %s', image_path)
 
     # Delete any previous state in this directory.
-    os.system('rm -rf "%s"' % output_dir)
+    fs_util.Remove(output_dir)
     os.makedirs(output_dir)
 
     try:
-      self.GenerateUpdateFile(self.src_image, image_path, output_dir)
-      self.GenerateStatefulFile(image_path, output_dir)
+      with _PAYLOAD_GENERATION_SECONDS.Time(
+          ('delta' if src_image else 'full',)):
+        self.GenerateUpdateFile(src_image, image_path, output_dir,
+                                low_priority=low_priority)
+        self.GenerateStatefulFile(image_path, output_dir,
+                                  low_priority=low_priority)
     except subprocess.CalledProcessError:
-      os.system('rm -rf "%s"' % output_dir)
+      fs_util.Remove(output_dir)
       raise AutoupdateError('Failed to generate update in %s' % output_dir)
 
+  def GenerateCachedUpdateImage(self, src_image, image_path, static_image_dir,
+                                low_priority=False):
+    """Generates an update payload into the cache, unless already there.
+
+    Unlike GenerateUpdateImageWithCache(), this leaves the state of the
+    updater alone, so it can be used to warm the cache in the background.
+
+    Args:
+      src_image: image we are updating from (Null/empty for non-delta)
+      image_path: full path to the image.
+      static_image_dir: the directory holding the cache.
+      low_priority: run the generators at the lowest CPU priority.
+    Returns:
+      The cache directory of the update, relative to static_image_dir.
+    Raises:
+      AutoupdateError if it we need to generate a payload and fail to do so.
+    """
+    # Which sub_dir of static_image_dir should hold our cached update image
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image, image_path)
+    _Log('Caching in sub_dir "%s"', cache_sub_dir)
+    full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
+
+    # Serialize generation of the same payload by update pings and the
+    # prewarmer, as generating wipes the cache directory first.
+    lock_path = GetCacheLockPath(full_cache_dir)
+    fs_util.MakeDirs(os.path.dirname(lock_path))
+    lock_util.Acquire(lock_path)
+    try:
+      # Check to see if this cache directory is valid.
+      cached = (os.path.exists(os.path.join(full_cache_dir, UPDATE_FILE)) and
+                os.path.exists(os.path.join(full_cache_dir, STATEFUL_FILE)))
+      metrics.RecordCacheLookup('payload', cached)
+      if not cached:
+        self.GenerateUpdateImage(image_path, full_cache_dir,
+                                 src_image=src_image or '',
+                                 low_priority=low_priority)
+
+      # Generate the cache file.
+      self.GetLocalPayloadAttrs(full_cache_dir)
+    finally:
+      lock_util.Release(lock_path)
+
+    return cache_sub_dir
+
   def GenerateUpdateImageWithCache(self, image_path, static_image_dir):
     """Force generates an update payload based on the given image_path.
 
@@ -400,30 +587,20 @@ class Autoupdate(BuildObject):
     """
     _Log('Generating update for src %s image %s', self.src_image, image_path)
 
-    # If it was pregenerated_path, don't regenerate
-    if self.pregenerated_path:
+    # If it was pregenerated_path, don't regenerate, unless a newer image has
+    # been built since.
+    if self.pregenerated_path and self._pregenerated_image == image_path:
       return self.pregenerated_path
 
-    # Which sub_dir of static_image_dir should hold our cached update image
-    cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image, image_path)
-    _Log('Caching in sub_dir "%s"', cache_sub_dir)
+    cache_sub_dir = self.GenerateCachedUpdateImage(self.src_image, image_path,
+                                                   static_image_dir)
+    self.pregenerated_path = cache_sub_dir
+    self._pregenerated_image = image_path
 
     # The cached payloads exist in a cache dir
-    cache_update_payload = os.path.join(static_image_dir,
-                                        cache_sub_dir, UPDATE_FILE)
-    cache_stateful_payload = os.path.join(static_image_dir,
-                                          cache_sub_dir, STATEFUL_FILE)
-
     full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
-    # Check to see if this cache directory is valid.
-    if not os.path.exists(cache_update_payload) or not os.path.exists(
-        cache_stateful_payload):
-      self.GenerateUpdateImage(image_path, full_cache_dir)
-
-    self.pregenerated_path = cache_sub_dir
-
-    # Generate the cache file.
-    self.GetLocalPayloadAttrs(full_cache_dir)
+    cache_update_payload = os.path.join(full_cache_dir, UPDATE_FILE)
+    cache_stateful_payload = os.path.join(full_cache_dir, STATEFUL_FILE)
     cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
 
     # Generation complete, copy if requested.
@@ -441,6 +618,18 @@ class Autoupdate(BuildObject):
     else:
       return self.pregenerated_path
 
+  def GetLatestImage(self, board):
+    """Returns the version and path of the latest image built for a board.
+
+    Returns:
+      A (version, image path) tuple, or None if no image has been built.
+    """
+    latest_image_dir = self._GetLatestImageDir(board)
+    if not latest_image_dir:
+      return None
+    return (self._GetVersionFromDir(latest_image_dir),
+            os.path.join(latest_image_dir, self._GetImageName()))
+
   def GenerateLatestUpdateImage(self, board, client_version,
                                 static_image_dir):
     """Generates an update using the latest image that has been built.
@@ -456,8 +645,8 @@ class Autoupdate(BuildObject):
       Name of the update directory relative to the static dir. None if it should
         serve from the static_image_dir.
     Raises:
-      AutoupdateError if it failed to generate the payload or can't update
-        the given client_version.
+      NoUpdateError if the client_version is up to date.
+      AutoupdateError if it failed to generate the payload.
     """
     latest_image_dir = self._GetLatestImageDir(board)
     latest_version = self._GetVersionFromDir(latest_image_dir)
@@ -466,12 +655,19 @@ class Autoupdate(BuildObject):
      # Check to see whether or not we should update.
     if client_version != 'ForcedUpdate' and not self._CanUpdate(
         client_version, latest_version):
-      raise AutoupdateError('Update check received but no update available '
-                            'for client')
+      raise NoUpdateError('Update check received but no update available '
+                          'for client')
+
+    if self.client_deltas and client_version != 'ForcedUpdate':
+      delta_dir = self._GetClientDelta(client_version, latest_image_path,
+                                       static_image_dir)
+      if delta_dir:
+        return delta_dir
 
     return self.GenerateUpdateImageWithCache(latest_image_path,
                                              static_image_dir=static_image_dir)
 
+  @trace_util.TracedMethod
   def GenerateUpdatePayload(self, board, client_version, static_image_dir):
     """Generates an update for an image and returns the relative payload dir.
 
@@ -479,6 +675,7 @@ class Autoupdate(BuildObject):
       payload dir relative to static_image_dir. None if it should
       serve from the static_image_dir.
     Raises:
+      NoUpdateError if the client_version is up to date.
       AutoupdateError if it failed to generate the payload.
     """
     dest_path = os.path.join(static_image_dir, UPDATE_FILE)
@@ -533,6 +730,7 @@ class Autoupdate(BuildObject):
                                                    UPDATE_FILE)
     return pregenerated_update
 
+  @trace_util.TracedMethod
   def _GetRemotePayloadAttrs(self, url):
     """Returns hashes, size and delta flag of a remote update payload.
 
@@ -554,21 +752,24 @@ class Autoupdate(BuildObject):
 
     fileinfo_url = url.replace(self._PAYLOAD_URL_PREFIX,
                                self._FILEINFO_URL_PREFIX)
-    _Log('Retrieving file info for remote payload via %s', fileinfo_url)
     try:
-      conn = urllib2.urlopen(fileinfo_url)
-      metadata_obj = Autoupdate._ReadMetadataFromStream(conn)
-      # These fields are required for remote calls.
-      if not metadata_obj:
-        raise AutoupdateError('Failed to obtain remote payload info')
+      # Served from memory unless stale; see remote_metadata.MetadataCache.
+      fileinfo = self._remote_metadata.Get(fileinfo_url)
+      metadata_obj = Autoupdate._ReadMetadataFromStream(
+          StringIO.StringIO(fileinfo))
+    except (remote_metadata.RemoteMetadataError, ValueError) as e:
+      raise AutoupdateError('Failed to obtain remote payload info: %s' % e)
 
-      if not metadata_obj.is_delta_format:
-        metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
+    # These fields are required for remote calls.
+    if not metadata_obj:
+      raise AutoupdateError('Failed to obtain remote payload info')
 
-      return metadata_obj
-    except IOError as e:
-      raise AutoupdateError('Failed to obtain remote payload info: %s', e)
+    if not metadata_obj.is_delta_format:
+      metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
+
+    return metadata_obj
 
+  @trace_util.TracedMethod
   def GetLocalPayloadAttrs(self, payload_dir):
     """Returns hashes, size and delta flag of a local update payload.
 
@@ -603,11 +804,11 @@ class Autoupdate(BuildObject):
     """
     # Initialize an empty dictionary for event attributes to log.
     log_message = {}
+    # Attributes of the host derived from this request.
+    host_attrs = {}
 
     # Determine request IP, strip any IPv6 data for simplicity.
     client_ip = cherrypy.request.remote.ip.split(':')[-1]
-    # Obtain (or init) info object for this client.
-    curr_host_info = self.host_infos.GetInitHostInfo(client_ip)
 
     client_version = 'ForcedUpdate'
     board = None
@@ -620,7 +821,7 @@ class Autoupdate(BuildObject):
       log_message['version'] = client_version
       log_message['track'] = channel
       log_message['board'] = board
-      curr_host_info.attrs['last_known_version'] = client_version
+      host_attrs['last_known_version'] = client_version
 
     if event:
       event_result = int(event[0].getAttribute('eventresult'))
@@ -629,19 +830,24 @@ class Autoupdate(BuildObject):
                                  if event[0].hasAttribute('previousversion')
                                  else None)
       # Store attributes to legacy host info structure
-      curr_host_info.attrs['last_event_status'] = event_result
-      curr_host_info.attrs['last_event_type'] = event_type
+      host_attrs['last_event_status'] = event_result
+      host_attrs['last_event_type'] = event_type
       # Add attributes to log message
       log_message['event_result'] = event_result
       log_message['event_type'] = event_type
       if client_previous_version is not None:
         log_message['previous_version'] = client_previous_version
 
-    # Log host event, if so instructed.
-    if self.host_log:
-      curr_host_info.AddLogEntry(log_message)
+    self.update_stats.Record(board, client_version,
+                             log_message.get('event_type'),
+                             log_message.get('event_result'))
 
-    return (curr_host_info.attrs.pop('forced_update_label', None),
+    # Update (or init) info for this client, logging the host event if so
+    # instructed.
+    self.host_infos.UpdateHost(client_ip, attrs=host_attrs,
+                               log_entry=log_message if self.host_log else None)
+
+    return (self.host_infos.PopAttr(client_ip, 'forced_update_label'),
             client_version, board)
 
   def _GetStaticUrl(self):
@@ -664,8 +870,8 @@ class Autoupdate(BuildObject):
     if self.proxy_port:
       static_urlbase = _ChangeUrlPort(static_urlbase, self.proxy_port)
 
-    _Log('Using static url base %s', static_urlbase)
-    _Log('Handling update ping as %s', hostname)
+    _Log('Using static url base %s', static_urlbase, level=log_util.DEBUG)
+    _Log('Handling update ping as %s', hostname, level=log_util.DEBUG)
     return static_urlbase
 
   def HandleUpdatePing(self, data, label=None):
@@ -677,12 +883,30 @@ class Autoupdate(BuildObject):
     Returns:
       Update payload message for client.
     """
+    start = time.time()
+    protocol, result = 'unknown', 'error'
+    try:
+      protocol, result, response = self._HandleUpdatePing(data, label)
+      return response
+    finally:
+      _UPDATE_PINGS.Inc((protocol, result))
+      _UPDATE_PING_SECONDS.Observe(time.time() - start, (protocol,))
+
+  def _HandleUpdatePing(self, data, label):
+    """Implements HandleUpdatePing().
+
+    Returns:
+      A tuple of the Omaha protocol version of the client, the result of the
+      ping for metrics and the update payload message for the client.
+    """
     # Get the static url base that will form that base of our update url e.g.
     # http://hostname:8080/static/update.gz.
     static_urlbase = self._GetStaticUrl()
 
     # Parse the XML we got into the components we care about.
-    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(data)
+    with trace_util.Span('parse_request'):
+      protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(
+          data)
 
     # #########################################################################
     # Process attributes of the update check.
@@ -694,14 +918,16 @@ class Autoupdate(BuildObject):
       _Log('Non-update check received.  Returning blank payload')
       # TODO(sosa): Generate correct non-updatecheck payload to better test
       # update clients.
-      return autoupdate_lib.GetNoUpdateResponse(protocol)
+      return (protocol, 'event',
+              autoupdate_lib.GetNoUpdateResponse(protocol))
 
     # In case max_updates is used, return no response if max reached.
     if self.max_updates > 0:
       self.max_updates -= 1
     elif self.max_updates == 0:
       _Log('Request received but max number of updates handled')
-      return autoupdate_lib.GetNoUpdateResponse(protocol)
+      return (protocol, 'noupdate',
+              autoupdate_lib.GetNoUpdateResponse(protocol))
 
     _Log('Update Check Received. Client is using protocol version: %s',
          protocol)
@@ -746,39 +972,167 @@ class Autoupdate(BuildObject):
         local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
         metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir)
 
+    except NoUpdateError as e:
+      _Log('%s', e)
+      return (protocol, 'noupdate',
+              autoupdate_lib.GetNoUpdateResponse(protocol))
     except AutoupdateError as e:
       # Raised if we fail to generate an update payload.
       _Log('Failed to process an update: %r', e)
-      return autoupdate_lib.GetNoUpdateResponse(protocol)
+      return (protocol, 'error',
+              autoupdate_lib.GetNoUpdateResponse(protocol))
 
     _Log('Responding to client to use url %s to get image', url)
-    return autoupdate_lib.GetUpdateResponse(
+    return (protocol, 'update', autoupdate_lib.GetUpdateResponse(
         metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
-        metadata_obj.is_delta_format, protocol, self.critical_update)
+        metadata_obj.is_delta_format, protocol, self.critical_update))
 
   def HandleHostInfoPing(self, ip):
     """Returns host info dictionary for the given IP in JSON format."""
     assert ip, 'No ip provided.'
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).attrs)
+    curr_host_info = self.host_infos.GetHostInfo(ip)
+    if curr_host_info:
+      return json.dumps(curr_host_info.attrs)
+
+  def HandleHostInfoBatchPing(self, ips):
+    """Returns host info dictionaries for several IPs in JSON format.
+
+    The result maps each IP to its info dictionary, or to null for unknown
+    hosts, all taken at the same instant.
+    """
+    assert all(ips), 'Empty ip provided.'
+    return json.dumps(self.host_infos.GetAttrsBatch(ips))
 
-  def HandleHostLogPing(self, ip):
-    """Returns a complete log of events for host in JSON format."""
-    # If all events requested, return a dictionary of logs keyed by IP address.
+  def _IterHostLogs(self, since=None, limit=None, cursor=None):
+    """Yields (ip, log) pairs of hosts, in order of IP.
+
+    Logs are retrieved lazily, one host at a time.
+
+    Args:
+      since: only include events logged at or after this time (seconds since
+             the epoch), and only hosts with such events.
+      limit: maximum number of hosts to yield.
+      cursor: only include hosts whose IP sorts after this one.
+    """
+    host_ids = sorted(self.host_infos.GetHostIds())
+    start = bisect.bisect_right(host_ids, cursor) if cursor else 0
+    count = 0
+    for ip in host_ids[start:]:
+      if limit is not None and count >= limit:
+        return
+      curr_host_info = self.host_infos.GetHostInfo(ip)
+      # The host may have expired since we listed the table.
+      if not curr_host_info:
+        continue
+      log = curr_host_info.GetLog(since=since)
+      if since is None or log:
+        count += 1
+        yield ip, log
+
+  def _GetHostLog(self, ip, since=None, limit=None):
+    """Returns the (possibly filtered) log of a single host."""
+    curr_host_info = self.host_infos.GetHostInfo(ip)
+    if not curr_host_info:
+      return []
+    log = curr_host_info.GetLog(since=since)
+    if limit is not None:
+      log = log[:limit]
+    return log
+
+  def HandleHostLogPing(self, ip, since=None, limit=None, cursor=None):
+    """Returns a log of recent events for host in JSON format.
+
+    Args:
+      ip: address of the host, or `all'.
+      since: only include events logged at or after this time (seconds since
+             the epoch).
+      limit: for `all', the maximum number of hosts to return in one page;
+             otherwise the maximum number of events.
+      cursor: for `all', the cursor returned with the previous page.
+    Returns:
+      For a single host, a JSON encoded list of events. For `all', a JSON
+      dictionary of logs keyed by IP address, including hosts with an empty
+      log unless since is given; if any of since, limit or cursor
+      are given, this is wrapped in a dictionary with keys `log' and `cursor',
+      the latter being the cursor of the next page or null if there is none.
+    """
     if ip == 'all':
-      return json.dumps(
-          dict([(key, self.host_infos.table[key].log)
-                for key in self.host_infos.table]))
+      if since is None and limit is None and cursor is None:
+        return json.dumps(dict(self._IterHostLogs()))
+
+      page = list(self._IterHostLogs(since=since, limit=limit, cursor=cursor))
+      next_cursor = None
+      if page and limit is not None and len(page) == limit:
+        next_cursor = page[-1][0]
+      return json.dumps({'log': dict(page), 'cursor': next_cursor})
 
-    # Otherwise we're looking for a specific IP address, so find its log.
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).log)
+    # Otherwise we're looking for a specific IP address, so find its log. If
+    # no events were logged for this IP, this is an empty log.
+    return json.dumps(self._GetHostLog(ip, since=since, limit=limit))
 
-    # If no events were logged for this IP, return an empty log.
-    return json.dumps([])
+  def StreamHostLog(self, ip, since=None, limit=None, cursor=None):
+    """Yields the events of a host, or of all hosts, as newline-delimited JSON.
+
+    Takes the same arguments as HandleHostLogPing(). Each event is a JSON
+    dictionary on a line of its own, with an additional `ip' field. Logs are
+    read lazily, a host at a time, as the output is consumed.
+    """
+    if ip == 'all':
+      host_logs = self._IterHostLogs(since=since, limit=limit, cursor=cursor)
+    else:
+      host_logs = [(ip, self._GetHostLog(ip, since=since, limit=limit))]
+
+    for host_ip, log in host_logs:
+      for entry in log:
+        entry['ip'] = host_ip
+        yield json.dumps(entry) + '\n'
+
+  def HandleHostStatsPing(self):
+    """Returns size and memory use of the host table in JSON format."""
+    return json.dumps(self.host_infos.GetStats())
+
+  def HandleUpdateStatsPing(self, window=None, board=None, version=None):
+    """Returns counts of recent update activity in JSON format.
+
+    Args:
+      window: number of seconds to look back; defaults to everything kept.
+      board: if set, only count activity of this board.
+      version: if set, only count activity of this version.
+    Raises:
+      AutoupdateError: if the window is not positive.
+    """
+    try:
+      stats = self.update_stats.Query(window=window, board=board,
+                                      version=version)
+    except update_stats.UpdateStatsError, e:
+      raise AutoupdateError(str(e))
+    max_window = (self.update_stats.bucket_seconds *
+                  self.update_stats.num_buckets)
+    return json.dumps({
+        'window': min(window or max_window, max_window),
+        'bucket_seconds': self.update_stats.bucket_seconds,
+        'stats': stats,
+    })
 
   def HandleSetUpdatePing(self, ip, label):
     """Sets forced_update_label for a given host."""
     assert ip, 'No ip provided.'
     assert label, 'No label provided.'
-    self.host_infos.GetInitHostInfo(ip).attrs['forced_update_label'] = label
+    self.host_infos.SetAttr(ip, 'forced_update_label', label)
+
+  def HandleSetUpdateBatchPing(self, labels):
+    """Sets forced_update_label for several hosts at once.
+
+    The labels are set as one write: other writers and batch reads see either
+    none or all of them, though an update ping may see some of them set
+    before the others.
+
+    Args:
+      labels: dictionary mapping host IPs to labels.
+    Returns:
+      The labels set, in JSON format.
+    """
+    assert all(labels), 'Empty ip provided.'
+    assert all(labels.itervalues()), 'Empty label provided.'
+    self.host_infos.SetAttrBatch('forced_update_label', labels)
+    return json.dumps(labels)
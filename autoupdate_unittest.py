@@ -10,6 +10,7 @@ import json
 import os
 import shutil
 import socket
+import tempfile
 import unittest
 
 import cherrypy
@@ -112,6 +113,48 @@ class AutoupdateTest(mox.MoxTestBase):
                                                       self.static_image_dir))
     self.mox.VerifyAll()
 
+  def testGenerateLatestUpdateImageWithClientDelta(self):
+    """Tests that a delta is scheduled on first request and served once ready.
+    """
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'GenerateUpdateImageWithCache')
+    self.mox.StubOutWithMock(common_util, 'GetFileMd5')
+    au_mock = self._DummyAutoupdateConstructor(client_deltas=True)
+    au_mock.payload_scheduler = self.mox.CreateMockAnything()
+    images_dir = os.path.join(self.static_image_dir, 'images', self.test_board)
+    image_paths = []
+    for image_dir in ['R21-1.0.0-a1', 'R21-2.0.0-a1']:
+      os.makedirs(os.path.join(images_dir, image_dir))
+      image_paths.append(os.path.join(images_dir, image_dir,
+                                      'chromiumos_image.bin'))
+      open(image_paths[-1], 'w').close()
+    src_image, latest_image = image_paths
+
+    au_mock._GetLatestImageDir(self.test_board).AndReturn(
+        os.path.dirname(latest_image))
+    common_util.GetFileMd5(src_image).AndReturn('src')
+    common_util.GetFileMd5(latest_image).AndReturn('dest')
+    au_mock.payload_scheduler.Schedule(src_image, latest_image,
+                                       self.static_image_dir)
+    au_mock.GenerateUpdateImageWithCache(
+        latest_image, static_image_dir=self.static_image_dir).AndReturn(None)
+    au_mock._GetLatestImageDir(self.test_board).AndReturn(
+        os.path.dirname(latest_image))
+    self.mox.ReplayAll()
+
+    # The delta isn't ready, so the full payload is served.
+    self.assertEqual(au_mock.GenerateLatestUpdateImage(
+        self.test_board, '1.0.0', self.static_image_dir), None)
+
+    # Image hashes are remembered.
+    delta_dir = au_mock.FindCachedUpdateImageSubDir(src_image, latest_image)
+    os.makedirs(os.path.join(self.static_image_dir, delta_dir))
+    open(os.path.join(self.static_image_dir, delta_dir,
+                      autoupdate.METADATA_FILE), 'w').close()
+    self.assertEqual(au_mock.GenerateLatestUpdateImage(
+        self.test_board, '1.0.0', self.static_image_dir), delta_dir)
+    self.mox.VerifyAll()
+
   def testHandleUpdatePingForForcedImage(self):
     self.mox.StubOutWithMock(autoupdate.Autoupdate,
                              'GenerateUpdateImageWithCache')
@@ -179,6 +222,32 @@ class AutoupdateTest(mox.MoxTestBase):
                      self.test_dict['event_type'])
     self.assertEqual(curr_host_info.attrs['last_event_status'],
                      self.test_dict['event_result'])
+    self.assertEqual(json.loads(au_mock.HandleUpdateStatsPing())['stats'],
+                     [{'board': self.test_board, 'version': 'ForcedUpdate',
+                       'event_type': self.test_dict['event_type'],
+                       'event_result': self.test_dict['event_result'],
+                       'count': 1}])
+    self.mox.VerifyAll()
+
+  def testHandleUpdatePingNoUpdate(self):
+    """Tests that an up to date client counts as noupdate, not as an error."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GenerateLatestUpdateImage')
+    self.mox.StubOutWithMock(autoupdate_lib, 'GetNoUpdateResponse')
+    au_mock = self._DummyAutoupdateConstructor()
+
+    au_mock.GenerateLatestUpdateImage(
+        self.test_board, 'ForcedUpdate', self.static_image_dir).AndRaise(
+            autoupdate.NoUpdateError('No update available'))
+    autoupdate_lib.GetNoUpdateResponse('3.0').AndReturn('No update')
+
+    self.mox.ReplayAll()
+    pings = autoupdate._UPDATE_PINGS.Collect()
+    self.assertEqual(au_mock.HandleUpdatePing(self.test_data), 'No update')
+    new_pings = autoupdate._UPDATE_PINGS.Collect()
+    self.assertEqual(new_pings.get(('3.0', 'noupdate'), 0),
+                     pings.get(('3.0', 'noupdate'), 0) + 1)
+    self.assertEqual(new_pings.get(('3.0', 'error')),
+                     pings.get(('3.0', 'error')))
     self.mox.VerifyAll()
 
   def testChangeUrlPort(self):
@@ -204,6 +273,55 @@ class AutoupdateTest(mox.MoxTestBase):
     self.assertEqual(
         json.loads(au_mock.HandleHostInfoPing(test_ip)), self.test_dict)
 
+  def testHandleHostLogPing(self):
+    au_mock = self._DummyAutoupdateConstructor(host_log=True)
+    for ip in ['1.2.3.6', '1.2.3.4', '1.2.3.5']:
+      au_mock.host_infos.GetInitHostInfo(ip).AddLogEntry(
+          {'event_type': 3, 'event_result': 2})
+    au_mock.host_infos.GetInitHostInfo('1.2.3.7')
+
+    # Hosts without events are listed too, as they always were.
+    host_logs = json.loads(au_mock.HandleHostLogPing('all'))
+    self.assertEqual(sorted(host_logs),
+                     ['1.2.3.4', '1.2.3.5', '1.2.3.6', '1.2.3.7'])
+    self.assertEqual(host_logs['1.2.3.7'], [])
+    self.assertEqual(json.loads(au_mock.HandleHostLogPing('1.2.3.7')), [])
+    self.assertEqual(
+        len(json.loads(au_mock.HandleHostLogPing('1.2.3.4'))), 1)
+
+    # Page through all hosts, two at a time.
+    page = json.loads(au_mock.HandleHostLogPing('all', limit=2))
+    self.assertEqual(sorted(page['log']), ['1.2.3.4', '1.2.3.5'])
+    page = json.loads(au_mock.HandleHostLogPing('all', limit=2,
+                                                cursor=page['cursor']))
+    self.assertEqual(page, {'log': {'1.2.3.6': mox.IgnoreArg(),
+                                    '1.2.3.7': []},
+                            'cursor': '1.2.3.7'})
+    page = json.loads(au_mock.HandleHostLogPing('all', limit=2,
+                                                cursor=page['cursor']))
+    self.assertEqual(page, {'log': {}, 'cursor': None})
+
+    # Events older than |since| are left out, along with hosts left without
+    # events.
+    page = json.loads(au_mock.HandleHostLogPing('all', since=2 ** 40))
+    self.assertEqual(page, {'log': {}, 'cursor': None})
+    page = json.loads(au_mock.HandleHostLogPing('all', since=0))
+    self.assertEqual(sorted(page['log']), ['1.2.3.4', '1.2.3.5', '1.2.3.6'])
+
+  def testStreamHostLog(self):
+    au_mock = self._DummyAutoupdateConstructor(host_log=True)
+    for ip in ['1.2.3.5', '1.2.3.4']:
+      au_mock.host_infos.GetInitHostInfo(ip).AddLogEntry({'event_type': 3})
+    au_mock.host_infos.GetInitHostInfo('1.2.3.4').AddLogEntry(
+        {'event_type': 1})
+
+    lines = list(au_mock.StreamHostLog('all'))
+    self.assertTrue(all(line.endswith('\n') for line in lines))
+    events = [json.loads(line) for line in lines]
+    self.assertEqual([(event['ip'], event['event_type']) for event in events],
+                     [('1.2.3.4', 3), ('1.2.3.4', 1), ('1.2.3.5', 3)])
+    self.assertEqual(len(list(au_mock.StreamHostLog('1.2.3.4', limit=1))), 1)
+
   def testHandleSetUpdatePing(self):
     au_mock = self._DummyAutoupdateConstructor()
     test_ip = '1.2.3.4'
@@ -323,5 +441,56 @@ class AutoupdateTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class LatestImageTest(unittest.TestCase):
+  """Tests resolving the latest image without get_latest_image.sh."""
+
+  def setUp(self):
+    self.src_dir = tempfile.mkdtemp('autoupdate_unittest')
+    self.images_dir = os.path.join(self.src_dir, 'build', 'images', 'x86-alex')
+    os.makedirs(self.images_dir)
+    self.au = autoupdate.Autoupdate(root_dir=None, static_dir=self.src_dir)
+    self.au.scripts_dir = os.path.join(self.src_dir, 'scripts')
+    os.makedirs(self.au.scripts_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.src_dir)
+
+  def _MakeImageDir(self, name, mtime):
+    path = os.path.join(self.images_dir, name)
+    os.mkdir(path)
+    os.utime(path, (mtime, mtime))
+    # Adding an entry changes the images dir, as a new build would.
+    os.utime(self.images_dir, (mtime, mtime))
+    return path
+
+  def testGetLatestImageDir(self):
+    self.assertEqual(self.au._GetLatestImageDir('lumpy'), '')
+    self.assertEqual(self.au._GetLatestImageDir('x86-alex'), '')
+
+    self._MakeImageDir('R21-1.0.0-a1', 1000)
+    newest = self._MakeImageDir('R21-3.0.0-a1', 3000)
+    self._MakeImageDir('R21-2.0.0-a1', 2000)
+    os.utime(self.images_dir, (4000, 4000))
+    self.assertEqual(self.au._GetLatestImageDir('x86-alex'), newest)
+
+    # The `latest' link takes precedence.
+    os.symlink('R21-2.0.0-a1', os.path.join(self.images_dir, 'latest'))
+    os.utime(self.images_dir, (5000, 5000))
+    self.assertEqual(self.au._GetLatestImageDir('x86-alex'),
+                     os.path.join(self.images_dir, 'R21-2.0.0-a1'))
+
+  def testGetDefaultBoardID(self):
+    self.assertEqual(self.au._GetDefaultBoardID(), 'x86-generic')
+    board_file = os.path.join(self.au.scripts_dir, '.default_board')
+    with open(board_file, 'w') as f:
+      f.write('x86-alex')
+    os.utime(board_file, (1000, 1000))
+    self.assertEqual(self.au._GetDefaultBoardID(), 'x86-alex')
+    with open(board_file, 'w') as f:
+      f.write('lumpy')
+    os.utime(board_file, (2000, 2000))
+    self.assertEqual(self.au._GetDefaultBoardID(), 'lumpy')
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -9,8 +9,12 @@ import re
 import shutil
 import subprocess
 
+import control_file_util
+import fs_util
 import gsutil_util
 import log_util
+import metrics
+import trace_util
 
 
 # Names of artifacts we care about.
@@ -25,6 +29,15 @@ TEST_IMAGE = 'chromiumos_test_image.bin'
 TEST_SUITES_PACKAGE = 'test_suites.tar.bz2'
 AU_SUITE_PACKAGE = 'au_control.tar.bz2'
 
+_DOWNLOAD_SECONDS = metrics.Histogram(
+    'devserver_artifact_download_seconds',
+    'Time taken to download an artifact from Google Storage, by artifact type.',
+    ('artifact',))
+_DOWNLOADED_BYTES = metrics.Counter(
+    'devserver_artifact_downloaded_bytes_total',
+    'Bytes of artifacts downloaded from Google Storage, by artifact type.',
+    ('artifact',))
+
 
 class ArtifactDownloadError(Exception):
   """Error used to signify an issue processing an artifact."""
@@ -60,14 +73,21 @@ class BuildArtifact(log_util.Loggable):
     if not os.path.isdir(os.path.dirname(self._install_path)):
       os.makedirs(os.path.dirname(self._install_path))
 
+  @trace_util.TracedMethod
   def Download(self):
     """Stages the artifact from google storage to a local staging directory."""
-    gsutil_util.DownloadFromGS(self._gs_path, self._tmp_stage_path)
+    label_values = (self.__class__.__name__,)
+    with _DOWNLOAD_SECONDS.Time(label_values):
+      gsutil_util.DownloadFromGS(self._gs_path, self._tmp_stage_path)
+    if os.path.isfile(self._tmp_stage_path):
+      _DOWNLOADED_BYTES.Inc(label_values,
+                            os.path.getsize(self._tmp_stage_path))
 
   def Synchronous(self):
     """Returns False if this artifact can be downloaded in the background."""
     return self._synchronous
 
+  @trace_util.TracedMethod
   def Stage(self):
     """Moves the artifact from the tmp staging directory to the final path."""
     shutil.move(self._tmp_stage_path, self._install_path)
@@ -79,6 +99,7 @@ class BuildArtifact(log_util.Loggable):
 
 class AUTestPayloadBuildArtifact(BuildArtifact):
   """Wrapper for AUTest delta payloads which need additional setup."""
+  @trace_util.TracedMethod
   def Stage(self):
     super(AUTestPayloadBuildArtifact, self).Stage()
 
@@ -115,6 +136,7 @@ class TarballBuildArtifact(BuildArtifact):
     except subprocess.CalledProcessError, e:
       raise ArtifactDownloadError('%s %s' % (msg, e))
 
+  @trace_util.TracedMethod
   def Stage(self):
     """Changes directory into the install path and untars the tarball."""
     if not os.path.isdir(self._install_path):
@@ -126,6 +148,7 @@ class TarballBuildArtifact(BuildArtifact):
 class AutotestTarballBuildArtifact(TarballBuildArtifact):
   """Wrapper around the autotest tarball to download from gsutil."""
 
+  @trace_util.TracedMethod
   def Stage(self):
     """Untars the autotest tarball into the install path excluding test suites.
     """
@@ -152,8 +175,11 @@ class AutotestTarballBuildArtifact(TarballBuildArtifact):
 
     # TODO(scottz): Remove after we have moved away from the old test_scheduler
     # code.
-    cmd = 'cp %s/* %s' % (autotest_pkgs_dir, autotest_dir)
-    subprocess.check_call(cmd, shell=True)
+    fs_util.CopyFiles(autotest_pkgs_dir, autotest_dir)
+
+    # Index control files now, so that /controlfiles never has to walk the
+    # tree.
+    control_file_util.GenerateIndex(self._install_path)
 
 
 class DebugTarballBuildArtifact(TarballBuildArtifact):
@@ -201,6 +227,7 @@ class ZipfileBuildArtifact(BuildArtifact):
     except subprocess.CalledProcessError, e:
       raise ArtifactDownloadError('%s %s' % (msg, e))
 
+  @trace_util.TracedMethod
   def Stage(self):
     """Unzip files into the install path."""
     if not os.path.isdir(self._install_path):
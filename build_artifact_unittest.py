@@ -75,9 +75,6 @@ class BuildArtifactTest(mox.MoxTestBase):
         exclude='autotest/test_suites')
     subprocess.check_call(mox.StrContains('autotest/utils/packager.py'),
                           cwd=os.path.join(self.work_dir, 'stage'), shell=True)
-    subprocess.check_call('cp %s %s' % (
-        os.path.join(self.work_dir, 'install', 'autotest', 'packages/*'),
-        os.path.join(self.work_dir, 'install', 'autotest')), shell=True)
     self.mox.ReplayAll()
     artifact.Stage()
     self.mox.VerifyAll()
@@ -6,20 +6,25 @@
 
 import base64
 import binascii
-import distutils.version
 import errno
 import hashlib
 import os
 import random
 import re
 import shutil
+import stat
+import threading
 import time
 
-import lockfile
-
-import build_artifact
-import gsutil_util
+import fs_util
+import lock_util
 import log_util
+import metrics
+import version_util
+
+# Modules only needed to stage builds from Google Storage (build_artifact,
+# gsutil_util) or to list control files (control_file_util) are imported where
+# they are used, so that serving updates doesn't load them.
 
 
 # Module-local log function.
@@ -33,8 +38,25 @@ MTON_DIR_SUFFIX = '_mton'
 UPLOADED_LIST = 'UPLOADED'
 DEVSERVER_LOCK_FILE = 'devserver'
 
+# Matches the milestone prefix of a build name, e.g. R17 in R17-1234.0.0-a1-b1.
+_MILESTONE_RE = re.compile(r'^(R\d+)-')
+
+# Seconds a reader of a staged build waits for staging of that build to finish.
+STAGED_READ_TIMEOUT = 30
+
 _HASH_BLOCK_SIZE = 8192
 
+_LOCK_WAIT_SECONDS = metrics.Histogram(
+    'devserver_build_lock_wait_seconds',
+    'Time taken to acquire the lock of a build directory, by lock mode.',
+    ('mode',))
+_HASHED_BYTES = metrics.Counter(
+    'devserver_hashed_bytes_total',
+    'Bytes of files hashed, by the hashes computed.', ('hashes',))
+_HASH_SECONDS = metrics.Counter(
+    'devserver_hash_seconds_total',
+    'Time spent hashing files, by the hashes computed.', ('hashes',))
+
 
 def CommaSeparatedList(value_list, is_quoted=False):
   """Concatenates a list of strings.
@@ -71,6 +93,7 @@ def ParsePayloadList(archive_url, payload_list):
   Raises:
     CommonUtilError: If full payload is missing or invalid.
   """
+  import build_artifact
   full_payload_url = None
   mton_payload_url = None
   nton_payload_url = None
@@ -154,6 +177,7 @@ def WaitUntilAvailable(to_wait_list, archive_url, err_str, timeout=600,
   Raises:
     CommonUtilError: If timeout occurs.
   """
+  import gsutil_util
 
   cmd = 'gsutil cat %s/%s' % (archive_url, UPLOADED_LIST)
   msg = 'Failed to get a list of uploaded files.'
@@ -193,6 +217,7 @@ def GatherArtifactDownloads(main_staging_dir, archive_url, build_dir, build,
   Note, these artifacts can be downloaded asynchronously iff
   !artifact.Synchronous().
   """
+  import build_artifact
 
   # Wait up to 10 minutes for the full payload to be uploaded because we
   # do not know the exact name of the full payload.
@@ -278,6 +303,7 @@ def GatherSymbolArtifactDownloads(temp_download_dir, archive_url, staging_dir,
           GatherArtifactDownloads.  Also, it's possible that someday we might
           have more than one.
   """
+  import build_artifact
 
   artifact_name = build_artifact.DEBUG_SYMBOLS
   WaitUntilAvailable([artifact_name], archive_url, 'debug symbols',
@@ -308,6 +334,7 @@ def GatherImageArchiveArtifactDownloads(temp_download_dir, archive_url,
     list of downloadable artifacts (of type ZipfileBuildArtifact), currently
     containing a single obejct
   """
+  import build_artifact
 
   artifact_name = build_artifact.IMAGE_ARCHIVE
   WaitUntilAvailable([artifact_name], archive_url, 'image archive',
@@ -325,6 +352,7 @@ def PrepareBuildDirectory(build_dir):
   Args:
     build_dir: Directory to install build components into.
   """
+  import build_artifact
   if not os.path.isdir(build_dir):
     os.path.makedirs(build_dir)
 
@@ -349,18 +377,30 @@ def SafeSandboxAccess(static_dir, path):
   return (path.startswith(static_dir) and path != static_dir)
 
 
-def AcquireLock(static_dir, tag, create_once=True):
+def _GetLockPath(static_dir, tag):
+  """Returns the lock file path for a given tag, verifying it is sandboxed."""
+  build_dir = os.path.join(static_dir, tag)
+  if not SafeSandboxAccess(static_dir, build_dir):
+    raise CommonUtilError('Invalid tag "%s".' % tag)
+  return os.path.join(build_dir, DEVSERVER_LOCK_FILE)
+
+
+def AcquireLock(static_dir, tag, create_once=True, timeout=0, shared=False):
   """Acquires a lock for a given tag.
 
-  Creates a directory for the specified tag, and atomically creates a lock file
-  in it. This tells other components the resource/task represented by the tag
-  is unavailable.
+  Creates a directory for the specified tag, and locks the lock file in it.
+  This tells other components the resource/task represented by the tag is
+  unavailable. Threads of this process contend in memory; other processes are
+  kept out by an flock() on the lock file.
 
   Args:
     static_dir:  Directory where builds are served from.
     tag:         Unique resource/task identifier. Use '/' for nested tags.
     create_once: Determines whether the directory must be freshly created; this
                  preserves previous semantics of the lock acquisition.
+    timeout:     Seconds to wait for a contended lock; None waits forever and 0
+                 (the default) fails immediately.
+    shared:      Take a shared (reader) lock instead of an exclusive one.
 
   Returns:
     Path to the created directory or None if creation failed.
@@ -368,42 +408,55 @@ def AcquireLock(static_dir, tag, create_once=True):
   Raises:
     CommonUtilError: If lock can't be acquired.
   """
-  build_dir = os.path.join(static_dir, tag)
-  if not SafeSandboxAccess(static_dir, build_dir):
-    raise CommonUtilError('Invalid tag "%s".' % tag)
-
-  # Create the directory.
-  is_created = False
-  try:
-    os.makedirs(build_dir)
-    is_created = True
-  except OSError, e:
-    if e.errno == errno.EEXIST:
-      if create_once:
-        raise CommonUtilError(str(e))
-    else:
-      raise
+  lock_path = _GetLockPath(static_dir, tag)
+  build_dir = os.path.dirname(lock_path)
+  deadline = None if timeout is None else time.time() + timeout
 
-  # Lock the directory.
-  try:
-    lock = lockfile.FileLock(os.path.join(build_dir, DEVSERVER_LOCK_FILE))
-    lock.acquire(timeout=0)
-  except lockfile.AlreadyLocked, e:
-    raise CommonUtilError(str(e))
-  except:
-    # In any other case, remove the directory if we actually created it, so
-    # that subsequent attempts won't fail to re-create it.
-    if is_created:
-      shutil.rmtree(build_dir)
-    raise
+  while True:
+    # Create the directory.
+    is_created = False
+    try:
+      os.makedirs(build_dir)
+      is_created = True
+    except OSError, e:
+      if e.errno == errno.EEXIST:
+        if create_once:
+          raise CommonUtilError(str(e))
+      else:
+        raise
 
-  return build_dir
+    # Lock the directory.
+    remaining = None if deadline is None else max(0, deadline - time.time())
+    try:
+      with _LOCK_WAIT_SECONDS.Time(('shared' if shared else 'exclusive',)):
+        lock_util.Acquire(lock_path, shared=shared, timeout=remaining)
+      return build_dir
+    except lock_util.LockTimeout, e:
+      if is_created:
+        shutil.rmtree(build_dir)
+      raise CommonUtilError(str(e))
+    except OSError, e:
+      if is_created:
+        shutil.rmtree(build_dir)
+      # The holder of the lock removed the directory while we waited for it,
+      # see ReleaseLock(); start over on a new one.
+      if e.errno != errno.ENOENT:
+        raise
+    except:
+      # In any other case, remove the directory if we actually created it, so
+      # that subsequent attempts won't fail to re-create it.
+      if is_created:
+        shutil.rmtree(build_dir)
+      raise
 
 
 def ReleaseLock(static_dir, tag, destroy=False):
   """Releases the lock for a given tag.
 
-  Optionally, removes the locked directory entirely.
+  Optionally, removes the locked directory entirely. It is renamed aside, with
+  the lock still held, and deleted in the background, so the directory can be
+  locked again at once; those waiting for the lock start over on a new
+  directory.
 
   Args:
     static_dir: Directory where builds are served from.
@@ -414,22 +467,100 @@ def ReleaseLock(static_dir, tag, destroy=False):
   Raises:
     CommonUtilError: If lock can't be released.
   """
-  build_dir = os.path.join(static_dir, tag)
-  if not SafeSandboxAccess(static_dir, build_dir):
-    raise CommonUtilError('Invalid tag "%s".' % tag)
-
-  lock = lockfile.FileLock(os.path.join(build_dir, DEVSERVER_LOCK_FILE))
+  lock_path = _GetLockPath(static_dir, tag)
   try:
-    lock.break_lock()
-    if destroy:
-      shutil.rmtree(build_dir)
+    try:
+      if destroy:
+        fs_util.Remove(os.path.dirname(lock_path))
+    finally:
+      lock_util.Release(lock_path)
   except Exception, e:
     raise CommonUtilError(str(e))
 
 
+def _AcquireStagedReadLock(static_dir, build):
+  """Takes a shared lock on a staged build, waiting out any staging writer.
+
+  Returns:
+    The lock file path to pass to lock_util.Release(), or None if the build
+    directory does not exist (and hence nothing needs to be released).
+
+  Raises:
+    CommonUtilError: If the build is still being staged after
+        STAGED_READ_TIMEOUT seconds.
+  """
+  lock_path = _GetLockPath(static_dir, build)
+  if not os.path.isdir(os.path.dirname(lock_path)):
+    return None
+  try:
+    lock_util.Acquire(lock_path, shared=True, timeout=STAGED_READ_TIMEOUT)
+  except lock_util.LockTimeout:
+    raise CommonUtilError('Build %s is still being staged.' % build)
+  return lock_path
+
+
+class _LatestBuildIndex(object):
+  """Builds of a target, sorted once so that latest-build lookups are O(1).
+
+  Members:
+    mtime: modification time of the target dir when the index was built.
+    builds: build names sorted from newest to oldest.
+    latest_by_milestone: dictionary mapping milestones (e.g. R17) to the newest
+        build of that milestone.
+  """
+
+  def __init__(self, mtime, build_names):
+    self.mtime = mtime
+    # Hidden entries, such as the trash of removed builds, aren't builds.
+    self.builds = sorted((name for name in build_names
+                          if not name.startswith('.')),
+                         key=version_util.VersionKey, reverse=True)
+    self.latest_by_milestone = {}
+    for build in self.builds:
+      match = _MILESTONE_RE.match(build)
+      if match:
+        self.latest_by_milestone.setdefault(match.group(1), build)
+
+  def GetLatest(self, milestone=None):
+    """Returns the newest build, optionally of a given milestone, or None."""
+    if not milestone:
+      return self.builds[0] if self.builds else None
+
+    milestone = milestone.upper()
+    latest = self.latest_by_milestone.get(milestone)
+    if latest:
+      return latest
+
+    # Fall back to matching the milestone anywhere in the build name, as this
+    # function always has.
+    for build in self.builds:
+      if milestone in build:
+        return build
+    return None
+
+
+# Latest build indexes keyed by target path, and the lock guarding them.
+_latest_build_cache = {}
+_latest_build_cache_lock = threading.Lock()
+
+
+def InvalidateLatestBuildVersion(static_dir, target):
+  """Drops the cached latest build index of a target, e.g. after a download.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    target: The build target, e.g. x86-mario-release.
+  """
+  with _latest_build_cache_lock:
+    _latest_build_cache.pop(os.path.join(static_dir, target), None)
+
+
 def GetLatestBuildVersion(static_dir, target, milestone=None):
   """Retrieves the latest build version for a given board.
 
+  The builds of each target are indexed once and the index is reused until the
+  target dir changes, or InvalidateLatestBuildVersion() is called for it.
+
   Args:
     static_dir: Directory where builds are served from.
     target: The build target, typically a combination of the board and the
@@ -447,20 +578,27 @@ def GetLatestBuildVersion(static_dir, target, milestone=None):
         being present after filtering on milestone.
   """
   target_path = os.path.join(static_dir, target)
-  if not os.path.isdir(target_path):
+  try:
+    target_stat = os.stat(target_path)
+  except OSError:
+    target_stat = None
+  if not target_stat or not stat.S_ISDIR(target_stat.st_mode):
     raise CommonUtilError('Cannot find path %s' % target_path)
 
-  builds = [distutils.version.LooseVersion(build) for build in
-            os.listdir(target_path)]
-
-  if milestone and builds:
-    # Check if milestone Rxx is in the string representation of the build.
-    builds = filter(lambda x: milestone.upper() in str(x), builds)
-
-  if not builds:
+  with _latest_build_cache_lock:
+    index = _latest_build_cache.get(target_path)
+  is_cached = index is not None and index.mtime == target_stat.st_mtime
+  metrics.RecordCacheLookup('latest_build', is_cached)
+  if not is_cached:
+    index = _LatestBuildIndex(target_stat.st_mtime, os.listdir(target_path))
+    with _latest_build_cache_lock:
+      _latest_build_cache[target_path] = index
+
+  latest = index.GetLatest(milestone)
+  if not latest:
     raise CommonUtilError('Could not determine build for %s' % target)
 
-  return str(max(builds))
+  return latest
 
 
 def GetControlFile(static_dir, build, control_path):
@@ -472,7 +610,8 @@ def GetControlFile(static_dir, build, control_path):
     control_path: Path to control file on Dev Server relative to Autotest root.
 
   Raises:
-    CommonUtilError: If lock can't be acquired.
+    CommonUtilError: If the path is outside of the sandbox or the build is
+        still being staged.
 
   Returns:
     Content of the requested control file.
@@ -484,46 +623,82 @@ def GetControlFile(static_dir, build, control_path):
   if not SafeSandboxAccess(static_dir, control_path):
     raise CommonUtilError('Invalid control file "%s".' % control_path)
 
-  if not os.path.exists(control_path):
-    # TODO(scottz): Come up with some sort of error mechanism.
-    # crosbug.com/25040
-    return 'Unknown control path %s' % control_path
+  lock_path = _AcquireStagedReadLock(static_dir, build)
+  try:
+    if not os.path.exists(control_path):
+      # TODO(scottz): Come up with some sort of error mechanism.
+      # crosbug.com/25040
+      return 'Unknown control path %s' % control_path
 
-  with open(control_path, 'r') as control_file:
-    return control_file.read()
+    with open(control_path, 'r') as control_file:
+      return control_file.read()
+  finally:
+    if lock_path:
+      lock_util.Release(lock_path)
 
 
-def GetControlFileList(static_dir, build):
-  """List all control|control. files in the specified board/build path.
+def ListControlFiles(static_dir, build, prefix=None, suite=None):
+  """Lists control|control. files of a build, using its control file index.
 
   Args:
     static_dir: Directory where builds are served from.
     build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    prefix: If set, only list control files whose path starts with it.
+    suite: If set, only list control files that declare this suite.
 
   Raises:
-    CommonUtilError: If path is outside of sandbox.
+    CommonUtilError: If path is outside of sandbox, the build is unknown or
+        the build is still being staged.
 
   Returns:
-    String of each file separated by a newline.
+    A sorted list of paths relative to the autotest dir.
   """
+  import control_file_util
   autotest_dir = os.path.join(static_dir, build, 'autotest/')
   if not SafeSandboxAccess(static_dir, autotest_dir):
     raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
 
-  control_files = set()
-  if not os.path.exists(autotest_dir):
+  build_dir = os.path.join(static_dir, build)
+  index = control_file_util.GetCachedIndex(build_dir)
+  if not index:
+    # Make sure the index isn't loaded, or generated, while staging.
+    lock_path = _AcquireStagedReadLock(static_dir, build)
+    try:
+      if not os.path.exists(autotest_dir):
+        raise CommonUtilError('Unknown build path %s' % autotest_dir)
+      index = control_file_util.GetIndex(build_dir)
+    finally:
+      if lock_path:
+        lock_util.Release(lock_path)
+
+  return index.List(prefix=prefix, suite=suite)
+
+
+def GetControlFileList(static_dir, build, prefix=None, suite=None):
+  """List all control|control. files in the specified board/build path.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    prefix: If set, only list control files whose path starts with it.
+    suite: If set, only list control files that declare this suite.
+
+  Raises:
+    CommonUtilError: If path is outside of sandbox or the build is still being
+        staged.
+
+  Returns:
+    String of each file separated by a newline.
+  """
+  autotest_dir = os.path.join(static_dir, build, 'autotest/')
+  if (SafeSandboxAccess(static_dir, autotest_dir) and
+      not os.path.exists(autotest_dir)):
     # TODO(scottz): Come up with some sort of error mechanism.
     # crosbug.com/25040
     return 'Unknown build path %s' % autotest_dir
 
-  for entry in os.walk(autotest_dir):
-    dir_path, _, files = entry
-    for file_entry in files:
-      if file_entry.startswith('control.') or file_entry == 'control':
-        control_files.add(os.path.join(dir_path,
-                                       file_entry).replace(autotest_dir, ''))
-
-  return '\n'.join(control_files)
+  return '\n'.join(ListControlFiles(static_dir, build, prefix=prefix,
+                                    suite=suite))
 
 
 def GetFileSize(file_path):
@@ -554,14 +729,22 @@ def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
     hasher_md5 = hashlib.md5() if do_md5 else None
 
     # Read blocks from file, update hashes.
+    start = time.time()
+    num_bytes = 0
     with open(file_path, 'rb') as fd:
       while True:
         block = fd.read(_HASH_BLOCK_SIZE)
         if not block:
           break
+        num_bytes += len(block)
         hasher_sha1 and hasher_sha1.update(block)
         hasher_sha256 and hasher_sha256.update(block)
         hasher_md5 and hasher_md5.update(block)
+    label_values = ('+'.join(name for name, do in (('sha1', do_sha1),
+                                                    ('sha256', do_sha256),
+                                                    ('md5', do_md5)) if do),)
+    _HASHED_BYTES.Inc(label_values, num_bytes)
+    _HASH_SECONDS.Inc(label_values, time.time() - start)
 
     # Update return values.
     if hasher_sha1:
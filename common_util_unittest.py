@@ -10,12 +10,15 @@ import os
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import unittest
 
 import mox
 
 import build_artifact
 import common_util
+import fs_util
 import gsutil_util
 
 
@@ -67,6 +70,7 @@ class CommonUtilTest(mox.MoxTestBase):
     self._bad_mock_process.returncode = 1
 
   def tearDown(self):
+    fs_util.WaitForRemovals()
     shutil.rmtree(self._static_dir)
     shutil.rmtree(self._outside_sandbox_dir)
     shutil.rmtree(self._install_dir)
@@ -165,11 +169,48 @@ class CommonUtilTest(mox.MoxTestBase):
                       self._static_dir, 'test-lock')
     common_util.ReleaseLock(self._static_dir, 'test-lock', destroy=True)
 
+  def testWaiterOnDestroyedLock(self):
+    """Tests that waiters start over on a directory removed by the holder."""
+    build_dir = common_util.AcquireLock(self._static_dir, 'test-lock')
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(
+        common_util.AcquireLock(self._static_dir, 'test-lock',
+                                create_once=False, timeout=10)))
+    waiter.start()
+    time.sleep(0.1)
+    common_util.ReleaseLock(self._static_dir, 'test-lock', destroy=True)
+    waiter.join()
+
+    self.assertEqual(acquired, [build_dir])
+    fs_util.WaitForRemovals()
+    self.assertTrue(os.path.exists(os.path.join(
+        build_dir, common_util.DEVSERVER_LOCK_FILE)))
+
+    # The directory is removed before the lock is released.
+    remove = fs_util.Remove
+
+    def _CheckedRemove(path):
+      self.assertRaises(common_util.CommonUtilError, common_util.AcquireLock,
+                        self._static_dir, 'test-lock', create_once=False)
+      remove(path)
+
+    self.mox.stubs.Set(fs_util, 'Remove', _CheckedRemove)
+    common_util.ReleaseLock(self._static_dir, 'test-lock', destroy=True)
+    self.assertFalse(os.path.exists(build_dir))
+
   def testGetLatestBuildVersion(self):
     self.assertEqual(
         common_util.GetLatestBuildVersion(self._static_dir, 'test-board-1'),
         'R17-1413.0.0-a1-b1346')
 
+  def testGetLatestBuildVersionSkipsTrash(self):
+    """Tests that the trash of removed builds isn't taken for a build."""
+    board_path = os.path.join(self._static_dir, 'test-board-1')
+    os.mkdir(os.path.join(board_path, fs_util.TRASH_PREFIX + 'R99-1.0.0'))
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-1'),
+        'R17-1413.0.0-a1-b1346')
+
   def testGetLatestBuildVersionLatest(self):
     """Test that we raise CommonUtilError when a build dir is empty."""
     self.assertRaises(common_util.CommonUtilError,
@@ -190,6 +231,28 @@ class CommonUtilTest(mox.MoxTestBase):
         self._static_dir, 'test-board-2', milestone)
     self.assertEqual(expected_build_str, build_str)
 
+  def testGetLatestBuildVersionCached(self):
+    """Tests that the builds of a target are listed only when it changes."""
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2'),
+        'R17-2.0.0-a1-b1346')
+    self.mox.StubOutWithMock(os, 'listdir')
+    self.mox.ReplayAll()
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2',
+                                          'r16'),
+        'R16-2241.0.0-a0-b2')
+    self.mox.VerifyAll()
+    self.mox.UnsetStubs()
+
+    # A new build shows up once the index is invalidated.
+    os.mkdir(os.path.join(self._static_dir, 'test-board-2',
+                          'R18-1.0.0-a1-b1'))
+    common_util.InvalidateLatestBuildVersion(self._static_dir, 'test-board-2')
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2'),
+        'R18-1.0.0-a1-b1')
+
   def testGetControlFile(self):
     control_file_dir = os.path.join(
         self._static_dir, 'test-board-1', 'R17-1413.0.0-a1-b1346', 'autotest',
@@ -203,6 +266,50 @@ class CommonUtilTest(mox.MoxTestBase):
         os.path.join('server', 'site_tests', 'network_VPN', 'control'))
     self.assertEqual(control_content, 'hello!')
 
+  def testListControlFiles(self):
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    for test in ['network_VPN', 'platform_Reboot']:
+      control_file_dir = os.path.join(self._static_dir, build, 'autotest',
+                                      'server', 'site_tests', test)
+      os.makedirs(control_file_dir)
+      with open(os.path.join(control_file_dir, 'control'), 'w') as f:
+        f.write("SUITE = 'bvt'\n" if test == 'network_VPN' else '')
+
+    self.assertEqual(
+        common_util.ListControlFiles(self._static_dir, build),
+        ['server/site_tests/network_VPN/control',
+         'server/site_tests/platform_Reboot/control'])
+    self.assertEqual(
+        common_util.ListControlFiles(self._static_dir, build, suite='bvt'),
+        ['server/site_tests/network_VPN/control'])
+    self.assertEqual(
+        common_util.GetControlFileList(
+            self._static_dir, build, prefix='server/site_tests/platform'),
+        'server/site_tests/platform_Reboot/control')
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.ListControlFiles, self._static_dir,
+                      'test-board-1/R17-18.0.0-a1-b1346')
+
+  def testGetControlFileWaitsForStaging(self):
+    """Tests that control files of a build being staged can't be read."""
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    control_file_dir = os.path.join(self._static_dir, build, 'autotest',
+                                    'server')
+    os.makedirs(control_file_dir)
+    with open(os.path.join(control_file_dir, 'control'), 'w') as f:
+      f.write('hello!')
+
+    self.mox.stubs.Set(common_util, 'STAGED_READ_TIMEOUT', 0)
+    common_util.AcquireLock(self._static_dir, build, create_once=False)
+    self.assertRaises(common_util.CommonUtilError, common_util.GetControlFile,
+                      self._static_dir, build, 'server/control')
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetControlFileList, self._static_dir, build)
+    common_util.ReleaseLock(self._static_dir, build)
+    self.assertEqual(
+        common_util.GetControlFile(self._static_dir, build, 'server/control'),
+        'hello!')
+
   def commonGatherArtifactDownloads(self, payload_names):
     """Tests that we can gather the correct download requirements."""
     build = 'R17-1413.0.0-a1-b1346'
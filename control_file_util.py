@@ -0,0 +1,197 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Per-build index of autotest control files.
+
+The index is generated once, when the autotest tarball of a build is staged,
+and persisted next to the build as CONTROL_FILE_INDEX. Lookups are then served
+from an in-memory copy that is reloaded only if the index file changes.
+"""
+
+import bisect
+import json
+import os
+import re
+import tempfile
+import threading
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CONTROL_FILES', message, *args)
+
+
+CONTROL_FILE_INDEX = 'control_files.json'
+AUTOTEST_DIR = 'autotest'
+
+# Matches the SUITE variable of an autotest control file,
+# e.g. SUITE = 'bvt, smoke'.
+_SUITE_RE = re.compile(r'''^SUITE\s*=\s*['"]([^'"]*)['"]''', re.MULTILINE)
+
+# In-memory indexes keyed by build directory, and the lock guarding them.
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+
+class ControlFileUtilError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+class ControlFileIndex(object):
+  """Control files of one build, sorted by path and grouped by suite.
+
+  Members:
+    mtime: modification time of the index file this was loaded from.
+    control_files: sorted list of paths relative to the autotest dir.
+    suites: dictionary mapping suite names to sorted lists of paths.
+  """
+
+  def __init__(self, mtime, control_files, suites):
+    self.mtime = mtime
+    self.control_files = control_files
+    self.suites = suites
+
+  def List(self, prefix=None, suite=None):
+    """Returns control files matching an optional path prefix and/or suite."""
+    if suite is not None:
+      control_files = self.suites.get(suite, [])
+    else:
+      control_files = self.control_files
+
+    if prefix:
+      # The list is sorted, so all matching paths form a single run.
+      start = bisect.bisect_left(control_files, prefix)
+      end = start
+      while (end < len(control_files) and
+             control_files[end].startswith(prefix)):
+        end += 1
+      control_files = control_files[start:end]
+
+    return list(control_files)
+
+
+def _IsControlFile(filename):
+  return filename == 'control' or filename.startswith('control.')
+
+
+def _ReadSuites(control_path):
+  """Returns the suites a control file declares via its SUITE variable."""
+  try:
+    with open(control_path) as control_file:
+      match = _SUITE_RE.search(control_file.read())
+  except IOError:
+    return []
+  if not match:
+    return []
+  return [suite.strip() for suite in match.group(1).split(',')
+          if suite.strip()]
+
+
+def _GetIndexPath(build_dir):
+  return os.path.join(build_dir, CONTROL_FILE_INDEX)
+
+
+def GenerateIndex(build_dir):
+  """Walks the autotest dir of a build and persists its control file index.
+
+  Args:
+    build_dir: Directory the build is staged in; must contain AUTOTEST_DIR.
+  Returns:
+    The resulting ControlFileIndex.
+  Raises:
+    ControlFileUtilError: If the build has no autotest dir.
+  """
+  autotest_dir = os.path.join(build_dir, AUTOTEST_DIR)
+  if not os.path.isdir(autotest_dir):
+    raise ControlFileUtilError('No autotest dir in %s' % build_dir)
+
+  control_files = []
+  suites = {}
+  for dir_path, _, files in os.walk(autotest_dir):
+    rel_dir = os.path.relpath(dir_path, autotest_dir)
+    for file_entry in files:
+      if not _IsControlFile(file_entry):
+        continue
+      rel_path = os.path.normpath(os.path.join(rel_dir, file_entry))
+      control_files.append(rel_path)
+      for suite in _ReadSuites(os.path.join(dir_path, file_entry)):
+        suites.setdefault(suite, []).append(rel_path)
+
+  control_files.sort()
+  for suite_files in suites.itervalues():
+    suite_files.sort()
+
+  # Write to a temporary file first so that readers never see a partial index.
+  index_path = _GetIndexPath(build_dir)
+  fd, tmp_index_path = tempfile.mkstemp(prefix=CONTROL_FILE_INDEX,
+                                        dir=build_dir)
+  with os.fdopen(fd, 'w') as index_file:
+    json.dump({'control_files': control_files, 'suites': suites}, index_file)
+  os.chmod(tmp_index_path, 0644)
+  os.rename(tmp_index_path, index_path)
+
+  index = ControlFileIndex(os.path.getmtime(index_path), control_files, suites)
+  with _index_cache_lock:
+    _index_cache[build_dir] = index
+  _Log('Indexed %d control files in %s', len(control_files), build_dir)
+  return index
+
+
+def _LoadIndex(index_path):
+  """Reads a persisted index file into a ControlFileIndex."""
+  mtime = os.path.getmtime(index_path)
+  with open(index_path) as index_file:
+    index_dict = json.load(index_file)
+  return ControlFileIndex(mtime, index_dict['control_files'],
+                          index_dict['suites'])
+
+
+def GetCachedIndex(build_dir):
+  """Returns the in-memory index of a build if it is up to date, else None."""
+  with _index_cache_lock:
+    index = _index_cache.get(build_dir)
+  if not index:
+    return None
+  try:
+    if index.mtime == os.path.getmtime(_GetIndexPath(build_dir)):
+      return index
+  except OSError:
+    pass
+  return None
+
+
+def GetIndex(build_dir):
+  """Returns the control file index of a build, loading it if necessary.
+
+  Builds staged before indexing existed have no index file; one is generated
+  for them on first use.
+
+  Args:
+    build_dir: Directory the build is staged in.
+  Returns:
+    A ControlFileIndex.
+  Raises:
+    ControlFileUtilError: If the index has to be generated but the build has
+        no autotest dir.
+  """
+  index = GetCachedIndex(build_dir)
+  if index:
+    return index
+
+  index_path = _GetIndexPath(build_dir)
+  if not os.path.exists(index_path):
+    return GenerateIndex(build_dir)
+
+  try:
+    index = _LoadIndex(index_path)
+  except (IOError, OSError, ValueError, KeyError), e:
+    _Log('Regenerating unreadable index %s: %s', index_path, e)
+    return GenerateIndex(build_dir)
+
+  with _index_cache_lock:
+    _index_cache[build_dir] = index
+  return index
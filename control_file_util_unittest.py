@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for control_file_util module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+import control_file_util
+
+
+# Control files of the fake build, mapped to their contents.
+CONTROL_FILES = {
+    'client/site_tests/dummy_Pass/control': "SUITE = 'bvt, smoke'\n",
+    'client/site_tests/dummy_Pass/control.wifi': 'SUITE = "wifi"\n',
+    'server/site_tests/network_VPN/control': 'NAME = "network_VPN"\n',
+    'test_suites/control.bvt': 'NAME = "bvt"\n',
+}
+
+
+class ControlFileUtilTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._build_dir = tempfile.mkdtemp('control_file_util_unittest')
+    autotest_dir = os.path.join(self._build_dir,
+                                control_file_util.AUTOTEST_DIR)
+    for path, contents in CONTROL_FILES.iteritems():
+      full_path = os.path.join(autotest_dir, path)
+      if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+      with open(full_path, 'w') as f:
+        f.write(contents)
+    with open(os.path.join(autotest_dir, 'server', 'not_a_control'), 'w') as f:
+      f.write("SUITE = 'bvt'\n")
+
+  def tearDown(self):
+    shutil.rmtree(self._build_dir)
+
+  def testGenerateIndex(self):
+    """Tests that the index lists control files and their suites."""
+    index = control_file_util.GenerateIndex(self._build_dir)
+    self.assertEqual(index.List(), sorted(CONTROL_FILES))
+    self.assertEqual(index.List(suite='bvt'),
+                     ['client/site_tests/dummy_Pass/control'])
+    self.assertEqual(index.List(suite='wifi'),
+                     ['client/site_tests/dummy_Pass/control.wifi'])
+    self.assertEqual(index.List(suite='unknown'), [])
+    self.assertEqual(index.List(prefix='client/'),
+                     ['client/site_tests/dummy_Pass/control',
+                      'client/site_tests/dummy_Pass/control.wifi'])
+    self.assertEqual(index.List(prefix='server/', suite='bvt'), [])
+    self.assertTrue(os.path.exists(os.path.join(
+        self._build_dir, control_file_util.CONTROL_FILE_INDEX)))
+
+  def testGenerateIndexWithoutAutotest(self):
+    shutil.rmtree(os.path.join(self._build_dir,
+                               control_file_util.AUTOTEST_DIR))
+    self.assertRaises(control_file_util.ControlFileUtilError,
+                      control_file_util.GenerateIndex, self._build_dir)
+
+  def testGetIndexServesFromMemory(self):
+    """Tests that an up-to-date index isn't walked or read again."""
+    control_file_util.GenerateIndex(self._build_dir)
+    self.mox.StubOutWithMock(control_file_util, 'GenerateIndex')
+    self.mox.StubOutWithMock(control_file_util, '_LoadIndex')
+    self.mox.ReplayAll()
+    self.assertEqual(control_file_util.GetIndex(self._build_dir).List(),
+                     sorted(CONTROL_FILES))
+    self.mox.VerifyAll()
+
+  def testGetIndexLoadsPersistedIndex(self):
+    """Tests that a persisted index is used without walking the build."""
+    control_file_util.GenerateIndex(self._build_dir)
+    control_file_util._index_cache.clear()
+    self.mox.StubOutWithMock(control_file_util, 'GenerateIndex')
+    self.mox.ReplayAll()
+    self.assertEqual(control_file_util.GetIndex(self._build_dir).List(),
+                     sorted(CONTROL_FILES))
+    self.mox.VerifyAll()
+    self.assertTrue(control_file_util.GetCachedIndex(self._build_dir))
+
+  def testGetIndexGeneratesMissingIndex(self):
+    """Tests that builds staged without an index get one on first use."""
+    self.assertEqual(control_file_util.GetCachedIndex(self._build_dir), None)
+    self.assertEqual(control_file_util.GetIndex(self._build_dir).List(),
+                     sorted(CONTROL_FILES))
+    self.assertTrue(os.path.exists(os.path.join(
+        self._build_dir, control_file_util.CONTROL_FILE_INDEX)))
+
+
+if __name__ == '__main__':
+  unittest.main()
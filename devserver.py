@@ -12,17 +12,28 @@ import logging
 import optparse
 import os
 import re
+import shutil
 import socket
 import sys
 import subprocess
 import tempfile
 import threading
+import time
 import types
 
 import autoupdate
 import common_util
-import downloader
+import executor_util
+import fs_util
+import host_info
+import lock_util
 import log_util
+import metrics
+import trace_util
+
+# Modules only needed by some options or routes, such as prefork and
+# shared_state for --workers, or downloader for staging builds, are imported
+# where they are used, so that they don't slow down startup.
 
 
 # Module-local log function.
@@ -35,29 +46,148 @@ CACHED_ENTRIES = 12
 # Sets up global to share between classes.
 updater = None
 
+# State shared by worker processes, if there are several.
+shared_store = None
+
+# Number of request threads CherryPy runs by default and in production, not
+# counting those waiting on route executors. These are always available for
+# update checks.
+_DEFAULT_THREAD_POOL = 10
+_PRODUCTION_THREAD_POOL = 75
+
+# Values of --log_level.
+_LOG_LEVELS = {
+    'debug': log_util.DEBUG,
+    'info': log_util.INFO,
+    'warning': log_util.WARNING,
+    'error': log_util.ERROR,
+}
+
+# Retry-After seconds suggested for a route whose executor has no history yet.
+_DEFAULT_RETRY_AFTER = 30
+
+# Longest request id taken from the X-Request-Id header of a request.
+_MAX_REQUEST_ID = 64
+
+# Executors of the routes configured with tools.executor, keyed by name; see
+# _RunOnExecutor.
+_executors = {}
+_executors_lock = threading.Lock()
+
+_LOCK_DICT_WAIT_SECONDS = metrics.Histogram(
+    'devserver_lock_dict_wait_seconds',
+    'Time taken to acquire a lock of a LockDict, by dictionary name.',
+    ('name',))
+
 
 class DevServerError(Exception):
   """Exception class used by this module."""
   pass
 
 
+class _StartupTasks(object):
+  """Startup work run in the background once the server is listening.
+
+  Tasks run one after the other, in the order they were added, so that the
+  devserver answers requests while it cleans its cache or pre-generates a
+  payload. /api/ready reports whether they are done.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._tasks = []
+    self._pending = []
+    self._errors = {}
+
+  def Add(self, name, func, *args):
+    """Adds a task calling func(*args), named name."""
+    with self._lock:
+      self._tasks.append((name, func, args))
+      self._pending.append(name)
+
+  def RunAll(self):
+    """Runs the tasks added so far on the calling thread.
+
+    Returns:
+      A dictionary of the errors of the tasks that failed, by name.
+    """
+    with self._lock:
+      tasks, self._tasks = self._tasks, []
+    errors = {}
+    for name, func, args in tasks:
+      start = time.time()
+      try:
+        func(*args)
+        _Log('Startup task %s done in %.1fs', name, time.time() - start)
+      except Exception, e:
+        errors[name] = str(e) or e.__class__.__name__
+        _Log('Startup task %s failed: %s', name, errors[name])
+      with self._lock:
+        self._pending.remove(name)
+        self._errors.update(errors)
+    return errors
+
+  def Start(self):
+    """Runs the tasks added so far on a background thread."""
+    thread = threading.Thread(target=self.RunAll, name='startup_tasks')
+    thread.daemon = True
+    thread.start()
+
+  # Run once the HTTP server listens, which it does at priority 75.
+  Start.priority = 80
+
+  def GetStatus(self):
+    """Returns the names of the pending tasks and the errors of failed ones."""
+    with self._lock:
+      return list(self._pending), dict(self._errors)
+
+
+startup_tasks = _StartupTasks()
+
+
+class _TimedLock(object):
+  """A lock that records the time taken to acquire it as a 'with' statement."""
+
+  def __init__(self, lock, name):
+    self._lock = lock
+    self._label_values = (name,)
+
+  def __enter__(self):
+    with _LOCK_DICT_WAIT_SECONDS.Time(self._label_values):
+      self._lock.acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._lock.release()
+
+  def acquire(self, blocking=True):
+    return self._lock.acquire(blocking)
+
+  def release(self):
+    self._lock.release()
+
+
 class LockDict(object):
   """A dictionary of locks.
 
   This class provides a thread-safe store of threading.Lock objects, which can
   be used to regulate access to any set of hashable resources.  Usage:
 
-    foo_lock_dict = LockDict()
+    foo_lock_dict = LockDict('foo')
     ...
     with foo_lock_dict.lock('bar'):
       # Critical section for 'bar'
+
+  Time spent waiting to enter a critical section is recorded in the
+  devserver_lock_dict_wait_seconds metric, under the name of the dictionary.
   """
-  def __init__(self):
-    self._lock = self._new_lock()
+  def __init__(self, name='default'):
+    self._name = name
+    self._lock = threading.Lock()
     self._dict = {}
 
   def _new_lock(self):
-    return threading.Lock()
+    return _TimedLock(threading.Lock(), self._name)
 
   def lock(self, key):
     with self._lock:
@@ -126,6 +256,7 @@ def _GetConfig(options):
                     'server.socket_timeout': 60,
                     'tools.staticdir.root':
                       os.path.dirname(os.path.abspath(sys.argv[0])),
+                    'tools.trace.on': True,
                   },
                   '/api':
                   {
@@ -149,12 +280,135 @@ def _GetConfig(options):
                     'response.timeout': 10000,
                   },
                 }
-  if options.production:
-    base_config['global'].update({'server.thread_pool': 75})
+  # Routes blocking for minutes each run on their own bounded executor, so
+  # that they are limited independently of each other.
+  for path, max_workers, max_queued in (('/build', 2, 2),
+                                        ('/download', 8, 16),
+                                        ('/stage_debug', 4, 8),
+                                        ('/stage_images', 4, 8)):
+    base_config.setdefault(path, {}).update(
+        _ExecutorConfig(path.lstrip('/'), max_workers, max_queued))
+
+  # Requests to routes with executors hold a thread while they wait on it, so
+  # add as many threads as those can take up; see _RunOnExecutor(). The rest
+  # remain for update checks and everything else.
+  thread_pool = (_PRODUCTION_THREAD_POOL if options.production else
+                 _DEFAULT_THREAD_POOL)
+  for section in base_config.itervalues():
+    if section.get('tools.executor.on'):
+      thread_pool += (section['tools.executor.max_workers'] +
+                      section['tools.executor.max_queued'])
+  base_config['global'].update({'server.thread_pool': thread_pool})
 
   return base_config
 
 
+def _ExecutorConfig(name, max_workers, max_queued):
+  """Returns the config of a route running on its own executor.
+
+  Args:
+    name: name of the executor, as shown by /api/executorstats.
+    max_workers: number of requests to the route handled at once.
+    max_queued: number of requests waiting for a worker, beyond which
+                requests are refused with a 503.
+  """
+  return {'tools.executor.on': True,
+          'tools.executor.name': name,
+          'tools.executor.max_workers': max_workers,
+          'tools.executor.max_queued': max_queued}
+
+
+def _RunOnExecutor(name, max_workers, max_queued):
+  """Runs the handler of the current request on the route's executor.
+
+  This is the before_handler hook of tools.executor. The request thread waits
+  for the handler's result. Requests beyond the capacity of the executor get
+  a 503 right away, with a Retry-After header estimating when it will have
+  room again.
+
+  A request running on the executor thus takes up two threads, and a queued
+  one a request thread. _GetConfig() adds a request thread for each request
+  an executor can take, running or queued, so that slow routes can't take
+  the threads update checks need. The cost is, per route, max_workers
+  executor threads on top of max_workers + max_queued request threads, most
+  of them idle most of the time.
+  """
+  with _executors_lock:
+    executor = _executors.get(name)
+    if not executor:
+      executor = _executors[name] = executor_util.BoundedExecutor(
+          name, max_workers, max_queued)
+
+  request, response = cherrypy.serving.request, cherrypy.serving.response
+  handler = request.handler
+
+  def Run(trace):
+    # Hand the request and its trace down to the executor thread, for
+    # handlers using them.
+    cherrypy.serving.load(request, response)
+    try:
+      with trace_util.Resume(trace):
+        with trace_util.Span('executor_run'):
+          return handler()
+    finally:
+      cherrypy.serving.clear()
+
+  def RunOnExecutor():
+    try:
+      return executor.Call(Run, trace_util.GetCurrentTrace())
+    except executor_util.ExecutorError, e:
+      _Log('Refusing request for %s: %s', request.path_info, e)
+      # Not raised as an HTTPError, which would drop the Retry-After header.
+      response.status = 503
+      response.headers['Retry-After'] = str(executor.EstimateWait() or
+                                            _DEFAULT_RETRY_AFTER)
+      return str(e)
+
+  request.handler = RunOnExecutor
+
+
+cherrypy.tools.executor = cherrypy.Tool('before_handler', _RunOnExecutor)
+
+
+def _TraceRequest():
+  """Traces the handling of the current request; see trace_util.
+
+  This is the before_handler hook of tools.trace. The request id is taken
+  from the X-Request-Id header of the request, if set, and returned in the
+  same header of the response. The hook runs after tools.executor, so that
+  traces include the time spent waiting for an executor.
+  """
+  request, response = cherrypy.serving.request, cherrypy.serving.response
+  handler = request.handler
+  # Static files are served by tools.staticdir, before any handler.
+  if handler is None:
+    return
+
+  request_id = (request.headers.get('X-Request-Id', '')[:_MAX_REQUEST_ID] or
+                trace_util.NewRequestId())
+  response.headers['X-Request-Id'] = request_id
+
+  def TraceHandler():
+    with trace_util.Trace(request.path_info, request_id):
+      return handler()
+
+  request.handler = TraceHandler
+
+
+cherrypy.tools.trace = cherrypy.Tool('before_handler', _TraceRequest,
+                                     priority=60)
+
+
+def _PublishDownloadStatus(archive_url, downloader_instance):
+  """Records the outcome of a background download for other workers."""
+  try:
+    downloader_instance.GetStatusOfBackgroundDownloads()
+    error = None
+  except Exception, e:
+    error = str(e) or e.__class__.__name__
+  shared_store.FinishJob(archive_url, error)
+
+
 def _PrepareToServeUpdatesOnly(image_dir, static_dir):
   """Sets up symlink to image_dir for serving purposes."""
   assert os.path.exists(image_dir), '%s must exist.' % image_dir
@@ -239,6 +493,30 @@ def _FindExposedMethods(root, prefix, unlisted=None):
   return method_list
 
 
+def _ReadJsonBody():
+  """Returns the decoded JSON body of the current request.
+
+  Raises:
+    cherrypy.HTTPError: 400 if the body is missing or not valid JSON.
+  """
+  body_length = int(cherrypy.request.headers.get('Content-Length', 0))
+  try:
+    return json.loads(cherrypy.request.rfile.read(body_length))
+  except ValueError:
+    raise cherrypy.HTTPError(400, 'Request body is not valid JSON.')
+
+
+def _ETagMatches(etag):
+  """Returns whether the current request's If-None-Match matches an ETag.
+
+  The header is a comma separated list of ETags, any of which may be weak
+  (W/"..."), or "*" to match any.
+  """
+  header = cherrypy.request.headers.get('If-None-Match', '')
+  tags = [tag.strip() for tag in header.split(',')]
+  return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
 class ApiRoot(object):
   """RESTful API for Dev Server information."""
   exposed = True
@@ -266,20 +544,250 @@ class ApiRoot(object):
     return updater.HandleHostInfoPing(ip)
 
   @cherrypy.expose
-  def hostlog(self, ip):
+  def batchhostinfo(self):
+    """Returns information about several hosts at once.
+
+    Takes a JSON encoded list of IPs as the request body.
+
+    Returns:
+      A JSON dictionary mapping each IP to a dictionary as returned by
+      /api/hostinfo, or to null if the host is unknown. All dictionaries are
+      taken at the same instant.
+
+    Example:
+      curl -d '["192.168.1.5", "192.168.1.6"]' http://myhost/api/batchhostinfo
+    """
+    ips = _ReadJsonBody()
+    if (not isinstance(ips, list) or
+        not all(isinstance(ip, basestring) and ip for ip in ips)):
+      raise cherrypy.HTTPError(400, 'Expected a JSON list of IPs.')
+    return updater.HandleHostInfoBatchPing(ips)
+
+  @cherrypy.expose
+  def hostlog(self, ip, since=None, limit=None, cursor=None, format=None):
     """Returns a JSON object containing a log of host event.
 
     Args:
       ip: address of host whose event log is requested, or `all'
+      since: only return events logged at or after this time, in seconds since
+        the epoch. Optional.
+      limit: for `all', the maximum number of hosts to return; otherwise the
+        maximum number of events. Optional.
+      cursor: for `all', the cursor returned with the previous page of hosts.
+        Optional.
+      format: set to `ndjson' to stream events as newline-delimited JSON, one
+        event per line with an additional `ip' field. Optional.
     Returns:
       A JSON encoded list (log) of dictionaries (events), each of which
       containing a `timestamp' and other event fields, as described under
-      /api/hostinfo.
+      /api/hostinfo. For `all', a dictionary of such logs keyed by IP. If any
+      of since, limit or cursor are given for `all', a dictionary with the
+      logs under `log' and the cursor of the next page (or null) under
+      `cursor'.
 
     Example URL:
       http://myhost/api/hostlog?ip=192.168.1.5
+      http://myhost/api/hostlog?ip=all&since=1349000000&limit=100
+      http://myhost/api/hostlog?ip=all&format=ndjson
+    """
+    try:
+      since = int(since) if since is not None else None
+      limit = int(limit) if limit is not None else None
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'since and limit must be integers.')
+
+    if format == 'ndjson':
+      cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+      cherrypy.response.stream = True
+      return updater.StreamHostLog(ip, since=since, limit=limit,
+                                   cursor=cursor)
+
+    return updater.HandleHostLogPing(ip, since=since, limit=limit,
+                                     cursor=cursor)
+
+  @cherrypy.expose
+  def hoststats(self):
+    """Returns a JSON dictionary describing the host table and its memory use.
+
+    Returns:
+      A JSON dictionary with the following fields:
+        hosts (int):            number of hosts currently recorded
+        max_hosts (int):        number of hosts that fit into the memory budget
+        expired_hosts (int):    number of idle hosts dropped to stay in budget
+        events (int):           number of host events currently recorded
+        log_size (int):         maximum number of events recorded per host
+        memory_budget (int):    memory budget of the host table in bytes
+        estimated_memory (int): estimated memory in use by the table in bytes
+
+    Example URL:
+      http://myhost/api/hoststats
+    """
+    return updater.HandleHostStatsPing()
+
+  @cherrypy.expose
+  def updatestats(self, window=None, board=None, version=None):
+    """Returns counts of recent update checks and events across all hosts.
+
+    Args:
+      window: number of seconds to look back. Optional; defaults to (and is
+        capped at) the hour of activity kept.
+      board: only count activity of this board. Optional.
+      version: only count activity of this version. Optional.
+    Returns:
+      A JSON dictionary with the following fields:
+        window (int):         number of seconds looked back
+        bucket_seconds (int): granularity of the counts in seconds
+        stats (list):         dictionaries with board, version, event_type,
+                              event_result and count fields. Update checks
+                              have a null event_type and event_result.
+
+    Example URL:
+      http://myhost/api/updatestats?window=3600&board=x86-alex
+    """
+    try:
+      window = int(window) if window is not None else None
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'window must be an integer.')
+
+    try:
+      return updater.HandleUpdateStatsPing(window=window, board=board,
+                                           version=version)
+    except autoupdate.AutoupdateError, e:
+      raise cherrypy.HTTPError(400, str(e))
+
+  @cherrypy.expose
+  def executorstats(self):
+    """Returns the load of the executors running slow routes.
+
+    Returns:
+      A JSON list of dictionaries, one per executor that handled a request,
+      with the following fields:
+        name (str):                executor name, after its route
+        max_workers (int):         number of requests handled at once
+        max_queued (int):          number of requests allowed to wait
+        running (int):             number of requests being handled
+        queued (int):              number of requests waiting
+        completed (int):           number of requests handled so far
+        rejected (int):            number of requests refused with a 503
+        mean_wait_seconds (float): mean time handled requests waited
+        max_wait_seconds (float):  longest time a handled request waited
+        mean_run_seconds (float):  mean time taken to handle a request
+
+      The same are exported on /metrics, as the devserver_executor_* metrics.
+
+    Example URL:
+      http://myhost/api/executorstats
+    """
+    with _executors_lock:
+      executors = sorted(_executors.values(), key=lambda e: e.name)
+    return json.dumps([executor.GetStats() for executor in executors])
+
+  @cherrypy.expose
+  def traces(self, name=None, request_id=None, min_seconds=None,
+             limit='100'):
+    """Returns timings of recent requests, by stage.
+
+    Args:
+      name: only include requests whose path starts with this.
+      request_id: only include the request with this id (as passed in, or
+                  returned by, the X-Request-Id header), and its background
+                  downloads.
+      min_seconds: only include requests taking at least this many seconds.
+      limit: maximum number of requests to include (default: 100).
+
+    Returns:
+      A JSON list of dictionaries, newest request first, with the following
+      fields:
+        request_id (str):    id of the request
+        name (str):          path of the request, or background_download
+        start (float):       time the request started, in seconds since the
+                             epoch
+        duration (float):    seconds taken to handle the request
+        error (str):         name of the exception raised, if any
+        spans (list):        stages of the request, as dictionaries of their
+                             name, offset and duration in seconds, and
+                             nesting depth
+        dropped_spans (int): number of spans not recorded
+
+    Example URL:
+      http://myhost/api/traces?name=/update&min_seconds=1
+    """
+    try:
+      min_seconds = float(min_seconds) if min_seconds is not None else None
+      limit = int(limit)
+    except ValueError:
+      raise cherrypy.HTTPError(
+          400, 'min_seconds must be a number and limit an integer.')
+    return json.dumps(trace_util.GetTraces(
+        name=name, request_id=request_id, min_seconds=min_seconds,
+        limit=limit))
+
+  @cherrypy.expose
+  def ready(self):
+    """Returns whether the devserver is done starting up.
+
+    The devserver answers requests as soon as it listens, and cleans its cache
+    and pre-generates the update payload (-p) in the background after that.
+    Poll this to wait for them, e.g. before sending update checks.
+
+    Returns:
+      A JSON dictionary with the following fields, with status 200 once
+      startup is done, 503 while it is in progress (with a Retry-After header)
+      and 500 if part of it failed:
+        ready (bool):   whether startup is done and succeeded
+        pending (list): names of the startup tasks yet to finish
+        errors (dict):  errors of the startup tasks that failed, by name
+
+    Example URL:
+      http://myhost/api/ready
     """
-    return updater.HandleHostLogPing(ip)
+    pending, errors = startup_tasks.GetStatus()
+    if pending:
+      # Not raised as an HTTPError, which would drop the Retry-After header.
+      cherrypy.response.status = 503
+      cherrypy.response.headers['Retry-After'] = '1'
+    elif errors:
+      cherrypy.response.status = 500
+    return json.dumps({'ready': not pending and not errors,
+                       'pending': pending, 'errors': errors})
+
+  @cherrypy.expose
+  def profile(self, seconds='10', interval=None, idle=None, threads=None):
+    """Profiles the devserver by sampling the stacks of all its threads.
+
+    The request returns once the profile is taken. Only one profile is taken
+    at a time. With several worker processes, only the worker serving the
+    request is profiled.
+
+    Args:
+      seconds: how long to profile for (default: 10, at most 300).
+      interval: seconds between samples (default: 0.01).
+      idle: set to 1 to include threads waiting for work.
+      threads: set to 1 to start each stack with the name of its thread.
+
+    Returns:
+      Stacks and the number of samples they were seen in, one per line, most
+      frequent first, in the collapsed format of flame graph tools.
+
+    Example:
+      curl http://myhost/api/profile?seconds=30 | flamegraph.pl > profile.svg
+    """
+    import profile_util
+    try:
+      seconds = float(seconds)
+      interval = (float(interval) if interval is not None else
+                  profile_util.DEFAULT_INTERVAL)
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'seconds and interval must be numbers.')
+
+    try:
+      profile = profile_util.Profile(seconds, interval,
+                                     include_idle=idle == '1',
+                                     by_thread=threads == '1')
+    except profile_util.ProfileError, e:
+      raise cherrypy.HTTPError(400, str(e))
+    cherrypy.response.headers['Content-Type'] = 'text/plain'
+    return profile
 
   @cherrypy.expose
   def setnextupdate(self, ip):
@@ -297,6 +805,30 @@ class ApiRoot(object):
         return updater.HandleSetUpdatePing(ip, label)
     raise cherrypy.HTTPError(400, 'No label provided.')
 
+  @cherrypy.expose
+  def batchsetnextupdate(self):
+    """Sets the response to the next update ping of several hosts at once.
+
+    Takes a JSON encoded dictionary mapping host IPs to update labels, as
+    normally provided to the /update command, as the request body. Either all
+    or none of the labels are set.
+
+    Returns:
+      A JSON dictionary of the labels set, keyed by IP.
+
+    Example:
+      curl -d '{"192.168.1.5": "x86-alex-release/R21-2438.0.0"}' \\
+          http://myhost/api/batchsetnextupdate
+    """
+    labels = _ReadJsonBody()
+    if not isinstance(labels, dict):
+      raise cherrypy.HTTPError(400, 'Expected a JSON dictionary of labels.')
+    for ip, label in labels.items():
+      if not isinstance(label, basestring) or not label.strip() or not ip:
+        raise cherrypy.HTTPError(400, 'No label provided for %r.' % ip)
+      labels[ip] = label.strip()
+    return updater.HandleSetUpdateBatchPing(labels)
+
 
   @cherrypy.expose
   def fileinfo(self, *path_args):
@@ -311,6 +843,11 @@ class ApiRoot(object):
         sha1 (string):   a base64 encoded SHA1 hash
         sha256 (string): a base64 encoded SHA256 hash
 
+      The response carries an ETag derived from the file's inode, size and
+      modification time, to the microsecond. If it matches the request's
+      If-None-Match header, the hashes aren't recomputed and 304 Not Modified
+      is returned instead.
+
     Example URL:
       http://myhost/api/fileinfo/some/path/to/file
     """
@@ -318,7 +855,17 @@ class ApiRoot(object):
     if not os.path.exists(file_path):
       raise DevServerError('file not found: %s' % file_path)
     try:
-      file_size = os.path.getsize(file_path)
+      file_stat = os.stat(file_path)
+      # A regenerated file is a new inode, but may well have the same size
+      # and be modified within the same second.
+      etag = '"%x-%x-%x"' % (file_stat.st_ino, file_stat.st_size,
+                             int(file_stat.st_mtime * 1000000))
+      cherrypy.response.headers['ETag'] = etag
+      if _ETagMatches(etag):
+        cherrypy.response.status = 304
+        return ''
+
+      file_size = file_stat.st_size
       file_sha1 = common_util.GetFileSha1(file_path)
       file_sha256 = common_util.GetFileSha256(file_path)
     except os.error, e:
@@ -345,7 +892,7 @@ class DevServerRoot(object):
 
   def __init__(self):
     self._builder = None
-    self._download_lock_dict = LockDict()
+    self._download_lock_dict = LockDict('download')
     self._downloader_dict = {}
 
   @cherrypy.expose
@@ -384,6 +931,7 @@ class DevServerRoot(object):
       http://myhost/download?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338
     """
+    import downloader
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
 
     # Guarantees that no two downloads for the same url can run this code
@@ -398,9 +946,32 @@ class DevServerRoot(object):
           _Log('Build %s has already been processed.' % archive_url)
           return 'Success'
 
+        # Another worker process may be about to download the same build.
+        if shared_store and not shared_store.StartJob(archive_url):
+          _Log('Build %s is being processed by another worker.' % archive_url)
+          # Return once the foreground artifacts are staged, as the worker
+          # processing it does.
+          error = shared_store.WaitForJob(archive_url, foreground=True)
+          if error:
+            raise DevServerError(error)
+          return 'Success'
+
         downloader_instance = downloader.Downloader(updater.static_dir)
         self._downloader_dict[archive_url] = downloader_instance
-        return downloader_instance.Download(archive_url, background=True)
+        if not shared_store:
+          return downloader_instance.Download(archive_url, background=True)
+
+        try:
+          status = downloader_instance.Download(archive_url, background=True)
+        except Exception, e:
+          shared_store.FinishJob(archive_url, str(e) or e.__class__.__name__)
+          raise
+        shared_store.FinishJobForeground(archive_url)
+        thread = threading.Thread(target=_PublishDownloadStatus,
+                                  args=(archive_url, downloader_instance))
+        thread.daemon = True
+        thread.start()
+        return status
 
       except:
         # On any exception, reset the state of the downloader_dict.
@@ -418,6 +989,7 @@ class DevServerRoot(object):
       http://myhost/wait_for_status?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338
     """
+    import downloader
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
     downloader_instance = self._downloader_dict.get(archive_url)
     if downloader_instance:
@@ -425,6 +997,14 @@ class DevServerRoot(object):
       self._downloader_dict[archive_url] = None
       return status
     else:
+      # The download may have been started by another worker process.
+      if shared_store:
+        error = shared_store.WaitForJob(archive_url)
+        if error:
+          raise DevServerError(error)
+        elif error is not None:
+          return 'Success'
+
       # We may have previously downloaded but removed the downloader instance
       # from the cache.
       if downloader.Downloader.BuildStaged(archive_url, updater.static_dir):
@@ -448,6 +1028,7 @@ class DevServerRoot(object):
       http://myhost/stage_debug?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338
     """
+    import downloader
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
     return downloader.SymbolDownloader(updater.static_dir).Download(archive_url)
 
@@ -493,16 +1074,33 @@ class DevServerRoot(object):
     Args:
       target: The build target, typically a combination of the board and the
           type of build e.g. x86-mario-release.
+      targets: A comma-separated list of build targets, to look up several
+          targets at once. Either target or targets must be provided.
       milestone: The milestone to filter builds on. E.g. R16. Optional, if not
           provided the latest RXX build will be returned.
     Returns:
       A string representation of the latest build if one exists, i.e.
           R19-1993.0.0-a1-b1480.
       An empty string if no latest could be found.
+      If targets is provided, a JSON dictionary mapping each target to its
+          latest build, or to null if none could be found.
+
+    Example URL:
+      http://myhost/latestbuild?targets=x86-mario-release,x86-alex-release
     """
     if not params:
       return _PrintDocStringAsHTML(self.latestbuild)
 
+    if 'targets' in params:
+      latest_builds = {}
+      for target in filter(None, params['targets'].split(',')):
+        try:
+          latest_builds[target] = common_util.GetLatestBuildVersion(
+              updater.static_dir, target, milestone=params.get('milestone'))
+        except common_util.CommonUtilError:
+          latest_builds[target] = None
+      return json.dumps(latest_builds)
+
     if 'target' not in params:
       raise cherrypy.HTTPError('500 Internal Server Error',
                                'Error: target= is required!')
@@ -520,6 +1118,8 @@ class DevServerRoot(object):
     Example URL:
       To List all control files:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0
+      To List the control files of a suite, as a JSON list:
+      http://dev-server/controlfiles?build=x86-alex-release/R18-1514.0.0&suite=bvt&format=json
       To return the contents of a path:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0&control_path=client/sleeptest/control
 
@@ -528,6 +1128,12 @@ class DevServerRoot(object):
       control_path: If you want the contents of a control file set this
         to the path. E.g. client/site_tests/sleeptest/control
         Optional, if not provided return a list of control files is returned.
+      prefix: Only list control files whose path starts with this prefix,
+        e.g. server/site_tests/. Optional.
+      suite: Only list control files which declare this suite (via their
+        SUITE variable). Optional.
+      format: Set to `json' to get the list as a JSON encoded list instead of
+        newline separated paths. Optional.
     Returns:
       Contents of a control file if control_path is provided.
       A list of control files if no control_path is provided.
@@ -540,8 +1146,18 @@ class DevServerRoot(object):
                                'Error: build= is required!')
 
     if 'control_path' not in params:
+      prefix = params.get('prefix')
+      suite = params.get('suite')
+      if params.get('format') == 'json':
+        try:
+          return json.dumps(common_util.ListControlFiles(
+              updater.static_dir, params['build'], prefix=prefix,
+              suite=suite))
+        except common_util.CommonUtilError as errmsg:
+          raise cherrypy.HTTPError('500 Internal Server Error', str(errmsg))
+
       return common_util.GetControlFileList(
-          updater.static_dir, params['build'])
+          updater.static_dir, params['build'], prefix=prefix, suite=suite)
     else:
       return common_util.GetControlFile(
           updater.static_dir, params['build'], params['control_path'])
@@ -565,6 +1181,7 @@ class DevServerRoot(object):
     """
     # TODO(garnold) This needs to turn into an async operation, to avoid
     # unnecessary failure of concurrent secondary requests (chromium-os:34661).
+    import downloader
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
     image_types = kwargs.get('image_types').split(',')
     return (downloader.ImagesDownloader(
@@ -583,6 +1200,19 @@ class DevServerRoot(object):
                  for name in _FindExposedMethods(
                      self, '', unlisted=self._UNLISTED_METHODS)]))
 
+  @cherrypy.expose
+  def metrics(self):
+    """Returns counters and latency histograms of the devserver's activity.
+
+    The response is in the Prometheus text exposition format. With several
+    worker processes, each reports only on the requests it served.
+
+    Example URL:
+      http://myhost/metrics
+    """
+    cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return metrics.Render()
+
   @cherrypy.expose
   def doc(self, *args):
     """Shows the documentation for available methods / URLs.
@@ -614,26 +1244,70 @@ class DevServerRoot(object):
     return updater.HandleUpdatePing(data, label)
 
 
+def _PurgeTrash(trash_dir):
+  """Deletes the trash left in the trash dir by previous runs.
+
+  Every tree removed on the file system of the static dir, such as a build or
+  a cache entry, is renamed into the trash dir; trees elsewhere, such as the
+  staging dirs in /tmp, are deleted in place. See fs_util.Remove().
+  """
+  fs_util.PurgeTrash(trash_dir)
+
+
+def _RemoveCacheEntry(entry):
+  """Removes an entry of the cache and its lock file, unless it is in use.
+
+  Args:
+    entry: path of the cache entry; it may be gone already, leaving its lock.
+  """
+  lock_path = autoupdate.GetCacheLockPath(entry)
+  fs_util.MakeDirs(os.path.dirname(lock_path))
+  try:
+    lock_util.Acquire(lock_path, timeout=0)
+  except lock_util.LockTimeout:
+    _Log('Not removing %s from the cache, as it is in use', entry)
+    return
+  try:
+    fs_util.Remove(entry)
+    # Removed under the lock; lock_util tells waiters their lock file went.
+    os.remove(lock_path)
+  finally:
+    lock_util.Release(lock_path)
+
+
 def _CleanCache(cache_dir, wipe):
   """Wipes any excess cached items in the cache_dir.
 
+  Items are renamed aside and deleted in the background; see fs_util.
+
   Args:
     cache_dir: the directory we are wiping from.
     wipe: If True, wipe all the contents -- not just the excess.
+
+  Raises:
+    DevServerError: if the cache could not be cleaned.
   """
-  if wipe:
-    # Clear the cache and exit on error.
-    cmd = 'rm -rf %s/*' % cache_dir
-    if os.system(cmd) != 0:
-      _Log('Failed to clear the cache with %s' % cmd)
-      sys.exit(1)
-  else:
-    # Clear all but the last N cached updates
-    cmd = ('cd %s; ls -tr | head --lines=-%d | xargs rm -rf' %
-           (cache_dir, CACHED_ENTRIES))
-    if os.system(cmd) != 0:
-      _Log('Failed to clean up old delta cache files with %s' % cmd)
-      sys.exit(1)
+  try:
+    # Hidden entries, such as trash directories, are left alone, as by ls.
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if not name.startswith('.')]
+    if not wipe:
+      # Clear all but the last N cached updates
+      entries.sort(key=lambda entry: os.lstat(entry).st_mtime)
+      entries = entries[:-CACHED_ENTRIES]
+    for entry in entries:
+      _RemoveCacheEntry(entry)
+
+    # Lock files of entries removed otherwise, e.g. by failed generations.
+    lock_dir = os.path.join(cache_dir, autoupdate.CACHE_LOCK_DIR)
+    if os.path.isdir(lock_dir):
+      for name in os.listdir(lock_dir):
+        entry = os.path.join(cache_dir, name)
+        if not os.path.exists(entry):
+          _RemoveCacheEntry(entry)
+  except OSError, e:
+    raise DevServerError('Failed to clean up the cache in %s: %s' %
+                         (cache_dir, e))
 
 
 def main():
@@ -647,6 +1321,11 @@ def main():
   parser.add_option('--clear_cache',
                     action='store_true', default=False,
                     help='clear out all cached updates and exit')
+  parser.add_option('--client_deltas',
+                    action='store_true', default=False,
+                    help='serve clients delta payloads from their current '
+                         'version when its image is around, generating them '
+                         'in the background on first request')
   parser.add_option('--critical_update',
                     action='store_true', default=False,
                     help='present update payload as critical')
@@ -663,11 +1342,36 @@ def main():
   parser.add_option('--host_log',
                     action='store_true', default=False,
                     help='record history of host update events (/api/hostlog)')
+  parser.add_option('--host_journal_dir',
+                    metavar='PATH',
+                    help='persist host records in this directory and restore '
+                         'them on startup')
+  parser.add_option('--host_log_size',
+                    metavar='NUM', default=host_info.DEFAULT_LOG_SIZE,
+                    type='int',
+                    help='number of most recent events recorded per host '
+                         '(default: %default)')
+  parser.add_option('--host_memory_budget',
+                    metavar='MB', default=(host_info.DEFAULT_MEMORY_BUDGET /
+                                           (1024 * 1024)),
+                    type='int',
+                    help='memory budget for host records in MB; the least '
+                         'recently active hosts are dropped beyond it '
+                         '(default: %default)')
   parser.add_option('--image',
                     metavar='FILE',
                     help='Force update using this image. Can only be used when '
                     'not in serve-only mode as it is used to generate a '
                     'payload.')
+  parser.add_option('--log_json',
+                    action='store_true', default=False,
+                    help='log one JSON object per line instead of text')
+  parser.add_option('--log_level',
+                    metavar='LEVEL', default='info',
+                    type='choice', choices=_LOG_LEVELS.keys(),
+                    help='minimum level of messages logged, one of %s '
+                         '(default: %%default)' %
+                         ', '.join(sorted(_LOG_LEVELS)))
   parser.add_option('--logfile',
                     metavar='PATH',
                     help='log output to this file instead of stdout')
@@ -683,6 +1387,15 @@ def main():
   parser.add_option('--payload',
                     metavar='PATH',
                     help='use update payload from specified directory')
+  parser.add_option('--prewarm_boards',
+                    metavar='BOARDS',
+                    help='comma separated boards whose newly built images get '
+                         'their update payloads generated in the background')
+  parser.add_option('--prewarm_deltas',
+                    metavar='NUM', default=0, type='int',
+                    help='number of delta payloads generated for each new '
+                         'image, from the client versions most reported '
+                         '(default: %default)')
   parser.add_option('--port',
                     default=8080, type='int',
                     help='port for the dev server to use (default: 8080)')
@@ -698,23 +1411,47 @@ def main():
   parser.add_option('--remote_payload',
                     action='store_true', default=False,
                     help='Payload is being served from a remote machine')
+  parser.add_option('--removal_rate',
+                    metavar='MB', type='int',
+                    default=(fs_util.DEFAULT_MAX_BYTES_PER_SECOND /
+                             (1024 * 1024)),
+                    help='maximum MB per second of removed builds and payloads '
+                         'deleted in the background, 0 for no limit '
+                         '(default: %default)')
   parser.add_option('--src_image',
                     metavar='PATH', default='',
                     help='source image for generating delta updates from')
   parser.add_option('-t', '--test_image',
                     action='store_true',
                     help='whether or not to use test images')
+  parser.add_option('--trace_slow_seconds',
+                    metavar='SECONDS', type='float',
+                    help='log the timings of requests taking at least this '
+                         'many seconds (default: none)')
   parser.add_option('-u', '--urlbase',
                     metavar='URL',
                     help='base URL for update images, other than the devserver')
+  parser.add_option('--workers',
+                    metavar='NUM', default=1, type='int',
+                    help='number of worker processes serving requests; with '
+                         'more than one, host records and download status are '
+                         'shared through a database, kept in '
+                         '--host_journal_dir if set (default: %default)')
   (options, _) = parser.parse_args()
+  # With several workers, which wouldn't see the progress of a background
+  # task in the parent, or when exiting right away, startup tasks run before
+  # serving instead.
+  run_tasks_first = options.exit or options.workers > 1
+  log_util.Configure(level=_LOG_LEVELS[options.log_level],
+                     json_format=options.log_json)
+  trace_util.Configure(slow_seconds=options.trace_slow_seconds)
 
   devserver_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
   root_dir = os.path.realpath('%s/../..' % devserver_dir)
   serve_only = False
 
   static_dir = os.path.realpath('%s/static' % options.data_dir)
-  os.system('mkdir -p %s' % static_dir)
+  fs_util.MakeDirs(static_dir)
 
   if options.archive_dir:
   # TODO(zbehan) Remove legacy support:
@@ -732,6 +1469,17 @@ def main():
     serve_only = True
 
   cache_dir = os.path.join(static_dir, 'cache')
+  trash_dir = os.path.join(static_dir, '.trash')
+  try:
+    fs_util.MakeDirs(trash_dir)
+  except OSError, e:
+    _Log('Removed trees will be deleted in place: %s', e)
+    trash_dir = None
+  fs_util.Configure(
+      max_bytes_per_second=options.removal_rate * 1024 * 1024 or None,
+      trash_dir=trash_dir)
+  if trash_dir:
+    startup_tasks.Add('purge_trash', _PurgeTrash, trash_dir)
   # If our devserver is only supposed to serve payloads, we shouldn't be mucking
   # with the cache at all. If the devserver hadn't previously generated a cache
   # and is expected, the caller is using it wrong.
@@ -742,7 +1490,16 @@ def main():
       parser.error('Incompatible flags detected for serve_only mode.')
 
   elif os.path.exists(cache_dir):
-    _CleanCache(cache_dir, options.clear_cache)
+    if options.clear_cache:
+      # Wiped before serving, so that no payload is served from a cache being
+      # wiped.
+      try:
+        _CleanCache(cache_dir, True)
+      except DevServerError, e:
+        _Log(str(e))
+        sys.exit(1)
+    else:
+      startup_tasks.Add('clean_cache', _CleanCache, cache_dir, False)
   else:
     os.makedirs(cache_dir)
 
@@ -772,13 +1529,65 @@ def main():
       remote_payload=options.remote_payload,
       max_updates=options.max_updates,
       host_log=options.host_log,
+      host_log_size=options.host_log_size,
+      host_memory_budget=options.host_memory_budget * 1024 * 1024,
+      client_deltas=options.client_deltas,
   )
 
   if options.pregenerate_update:
-    updater.PreGenerateUpdate()
+    startup_tasks.Add('pregenerate_update', updater.PreGenerateUpdate)
+
+  if run_tasks_first:
+    if startup_tasks.RunAll():
+      sys.exit(1)
+    if options.exit:
+      # Don't leave what the tasks removed half deleted.
+      fs_util.WaitForRemovals()
+  else:
+    cherrypy.engine.subscribe('start', startup_tasks.Start)
 
   # If the command line requested after setup, it's time to do it.
   if not options.exit:
+    state_dir = None
+    if options.workers > 1:
+      import shared_state
+      # Host records live in a database shared by the workers, which persists
+      # them itself.
+      global shared_store
+      state_dir = options.host_journal_dir or tempfile.mkdtemp(
+          prefix='devserver_state')
+      if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+      shared_store = shared_state.SharedStore(
+          os.path.join(state_dir, shared_state.DATABASE_FILE))
+      updater.host_infos = shared_state.SharedHostInfoTable(
+          shared_store, updater.host_infos.log_size,
+          updater.host_infos.max_hosts)
+      cherrypy.engine.subscribe('stop', updater.host_infos.Flush)
+    elif options.host_journal_dir:
+      import host_journal
+      host_infos = updater.host_infos
+      journal = host_journal.HostJournal(options.host_journal_dir,
+                                         host_infos.log_size,
+                                         host_infos.max_hosts)
+      host_infos.Load(journal.Replay())
+      host_infos.journal = journal
+      journal.Start()
+      cherrypy.engine.subscribe('stop', journal.Close)
+
+    prewarmer = None
+    if ((options.prewarm_boards or options.client_deltas) and
+        not serve_only and not options.remote_payload):
+      import payload_prewarmer
+      boards = []
+      if options.prewarm_boards:
+        boards = options.prewarm_boards.split(',')
+      prewarmer = payload_prewarmer.PayloadPrewarmer(
+          updater, boards, num_deltas=options.prewarm_deltas)
+      updater.payload_scheduler = prewarmer
+      cherrypy.engine.subscribe('start', prewarmer.Start)
+      cherrypy.engine.subscribe('stop', prewarmer.Stop)
+
     # Handle options that must be set globally in cherrypy.
     if options.production:
       cherrypy.config.update({'environment': 'production'})
@@ -788,7 +1597,25 @@ def main():
       cherrypy.config.update({'log.error_file': options.logfile,
                               'log.access_file': options.logfile})
 
-    cherrypy.quickstart(DevServerRoot(), config=_GetConfig(options))
+    config = _GetConfig(options)
+    if options.workers <= 1:
+      cherrypy.quickstart(DevServerRoot(), config=config)
+      return
+
+    import prefork
+    listen_socket = prefork.BindSocket(config['global']['server.socket_host'],
+                                       options.port)
+
+    def _ServeWorker(index):
+      # Only one worker watches for new images. Any of them may generate
+      # payloads, as the payload cache is locked across processes.
+      if prewarmer and index:
+        prewarmer.boards = []
+      prefork.ServeWorker(listen_socket, DevServerRoot(), config)
+
+    prefork.WorkerPool(options.workers, _ServeWorker).Run()
+    if not options.host_journal_dir:
+      shutil.rmtree(state_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
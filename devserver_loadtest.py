@@ -0,0 +1,715 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Load test of the devserver.
+
+Starts a devserver on a synthetic archive of builds and drives it with
+concurrent clients, one scenario at a time:
+
+  update:       Omaha 2.0 and 3.0 update checks, optionally at a fixed rate.
+  static:       range requests for parts of the payload, under /static.
+  fileinfo:     /api/fileinfo requests for the payload.
+  controlfiles: /controlfiles listings and control file contents.
+  download:     /download and /wait_for_status requests for builds in a fake
+                Google Storage, several clients racing for each build.
+
+For each scenario, the test reports the number of requests, errors,
+throughput and latency percentiles, and the peak resident memory and open
+file descriptors of the devserver (summed over its processes). With --json,
+the report is written as JSON instead, for comparing results across commits.
+
+Example:
+  ./devserver_loadtest.py --duration 30 --concurrency 16 --json results.json
+  ./devserver_loadtest.py --scenarios update --update_rate 200 \\
+      --devserver_args='--workers 4'
+"""
+
+import httplib
+import json
+import math
+import optparse
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+
+SCENARIOS = ('update', 'static', 'fileinfo', 'controlfiles', 'download')
+
+# Seconds to wait for the devserver to start answering.
+_STARTUP_TIMEOUT = 60
+
+# Seconds between samples of the devserver's memory and file descriptors.
+_SAMPLE_INTERVAL = 0.2
+
+_BOARD = 'x86-generic'
+_TARGET = 'x86-generic-release'
+_BUCKET = 'loadtest-archive'
+_PAYLOAD = 'update.gz'
+
+# Update checks of the Omaha protocols, by protocol version.
+_UPDATE_REQUEST = {}
+_UPDATE_REQUEST['2.0'] = """<?xml version="1.0" encoding="UTF-8"?>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" version="ChromeOSUpdateEngine-0.1.0.0" updaterversion="ChromeOSUpdateEngine-0.1.0.0" protocol="2.0" ismachine="1">
+    <o:os version="Indy" platform="Chrome OS" sp="%(version)s_i686"></o:os>
+    <o:app appid="{DEV-BUILD}" version="%(version)s" lang="en-US" track="developer-build" board="%(board)s" hardware_class="BETA DVT" delta_okay="true">
+        <o:updatecheck></o:updatecheck>
+    </o:app>
+</o:gupdate>
+"""
+_UPDATE_REQUEST['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="ChromeOSUpdateEngine-0.1.0.0" updaterversion="ChromeOSUpdateEngine-0.1.0.0" protocol="3.0" ismachine="1">
+    <os version="Indy" platform="Chrome OS" sp="%(version)s_i686"></os>
+    <app appid="{DEV-BUILD}" version="%(version)s" lang="en-US" track="developer-build" board="%(board)s" hardware_class="BETA DVT" delta_okay="true">
+        <updatecheck></updatecheck>
+    </app>
+</request>
+"""
+
+# A gsutil serving cat, ls and cp from a local directory standing in for
+# Google Storage, given by $LOADTEST_GS_ROOT, after sleeping
+# $LOADTEST_GS_LATENCY seconds.
+_FAKE_GSUTIL = """#!%(python)s
+import glob
+import os
+import shutil
+import sys
+import time
+
+def Local(url):
+  return os.path.join(os.environ['LOADTEST_GS_ROOT'], url[len('gs://'):])
+
+time.sleep(float(os.environ.get('LOADTEST_GS_LATENCY', 0)))
+command, args = sys.argv[1], sys.argv[2:]
+try:
+  if command == 'cat':
+    sys.stdout.write(open(Local(args[0])).read())
+  elif command == 'ls':
+    for path in sorted(glob.glob(Local(args[0]))):
+      print 'gs://' + os.path.relpath(path, os.environ['LOADTEST_GS_ROOT'])
+  elif command == 'cp':
+    shutil.copy(Local(args[0]), args[1])
+  else:
+    sys.exit('Unsupported command: %%s' %% command)
+except (IOError, OSError), e:
+  sys.exit(str(e))
+"""
+
+# Stands in for pbzip2, which staging tarballs requires, where it's missing.
+_FAKE_PBZIP2 = """#!/bin/sh
+exec bzip2 "$@"
+"""
+
+
+class LoadTestError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def _WriteFile(path, contents, mode=None):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with open(path, 'wb') as f:
+    f.write(contents)
+  if mode is not None:
+    os.chmod(path, mode)
+
+
+def _WriteRandomFile(path, size):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with open(path, 'wb') as f:
+    block = os.urandom(1024 * 1024)
+    while size > 0:
+      f.write(block[:size])
+      size -= len(block)
+
+
+def _WriteTarball(path, files, mode='w'):
+  """Writes a tarball holding the given contents, keyed by path."""
+  with tempfile.NamedTemporaryFile() as member:
+    tarball = tarfile.open(path, mode)
+    try:
+      for name, contents in sorted(files.iteritems()):
+        member.seek(0)
+        member.truncate()
+        member.write(contents)
+        member.flush()
+        tarball.add(member.name, arcname=name)
+    finally:
+      tarball.close()
+
+
+def _ControlFiles(num_tests):
+  """Returns control files of synthetic tests, keyed by autotest path."""
+  files = {}
+  for index in range(num_tests):
+    name = 'loadtest_%d' % index
+    suite = 'bvt' if index % 2 else 'regression'
+    files['server/site_tests/%s/control' % name] = (
+        'AUTHOR = "loadtest"\nNAME = "%s"\nSUITE = "%s"\n'
+        'TIME = "SHORT"\njob.run_test("%s")\n' % (name, suite, name))
+  return files
+
+
+class Fixture(object):
+  """A synthetic archive of builds, and a devserver serving it.
+
+  Members:
+    root: temporary directory holding everything.
+    archive_dir: directory served as the devserver's archive.
+    build: name of the staged build, relative to archive_dir.
+    control_paths: paths of its control files, relative to its autotest dir.
+    builds_to_download: URLs of builds in the fake Google Storage.
+    port: port the devserver listens on.
+    process: the devserver process.
+  """
+
+  def __init__(self, options):
+    self.options = options
+    self.root = tempfile.mkdtemp(prefix='devserver_loadtest')
+    self.archive_dir = os.path.join(self.root, 'archive')
+    self.build = '%s/R1-1.0.0-a1-b1' % _TARGET
+    self.control_paths = []
+    self.builds_to_download = []
+    self.port = None
+    self.process = None
+    self._bin_dir = os.path.join(self.root, 'bin')
+    self._gs_root = os.path.join(self.root, 'gs')
+
+  def Create(self):
+    """Writes the archive, the fake Google Storage and the fake tools."""
+    _WriteRandomFile(os.path.join(self.archive_dir, _PAYLOAD),
+                     self.options.payload_size * 1024 * 1024)
+
+    control_files = _ControlFiles(self.options.num_tests)
+    self.control_paths = sorted(control_files)
+    for path, contents in control_files.iteritems():
+      _WriteFile(os.path.join(self.archive_dir, self.build, 'autotest', path),
+                 contents)
+
+    self._CreateGoogleStorage(control_files)
+
+    _WriteFile(os.path.join(self._bin_dir, 'gsutil'),
+               _FAKE_GSUTIL % {'python': sys.executable}, 0755)
+    if not _FindExecutable('pbzip2'):
+      _WriteFile(os.path.join(self._bin_dir, 'pbzip2'), _FAKE_PBZIP2, 0755)
+
+  def _CreateGoogleStorage(self, control_files):
+    autotest_files = dict(('autotest/' + path, contents)
+                          for path, contents in control_files.iteritems())
+    autotest_files['autotest/packages/packages.checksum'] = ''
+    autotest_files['autotest/packages/test-loadtest.tar.bz2'] = ''
+
+    for index in range(self.options.download_builds):
+      build = 'R1-1.0.%d-a1-b%d' % (index, index + 2)
+      build_dir = os.path.join(self._gs_root, _BUCKET, _TARGET, build)
+      full_payload = 'chromeos_%s_%s_full_dev.bin' % (build, _BOARD)
+      _WriteRandomFile(os.path.join(build_dir, full_payload),
+                       self.options.payload_size * 1024 * 1024)
+      _WriteTarball(os.path.join(build_dir, 'stateful.tgz'),
+                    {'stateful/README': 'loadtest\n'}, 'w:gz')
+      _WriteTarball(os.path.join(build_dir, 'autotest.tar'), autotest_files)
+      _WriteTarball(os.path.join(build_dir, 'test_suites.tar.bz2'),
+                    {'autotest/test_suites/control.bvt': 'NAME = "bvt"\n'},
+                    'w:bz2')
+      _WriteFile(os.path.join(build_dir, 'UPLOADED'),
+                 '\n'.join(sorted(os.listdir(build_dir))) + '\n')
+      self.builds_to_download.append(
+          'gs://%s/%s/%s' % (_BUCKET, _TARGET, build))
+
+  def Start(self):
+    """Starts the devserver and waits until it answers.
+
+    Raises:
+      LoadTestError: if it doesn't start answering in time.
+    """
+    self.port = self.options.port or _FindFreePort()
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([self._bin_dir, env.get('PATH', '')])
+    env['LOADTEST_GS_ROOT'] = self._gs_root
+    env['LOADTEST_GS_LATENCY'] = str(self.options.gs_latency)
+
+    devserver = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'devserver.py')
+    # Like devserver_unittest, this serves the archive through the static/
+    # directory next to devserver.py, which is the only one /static serves.
+    log_path = os.path.join(self.root, 'devserver.log')
+    cmd = [sys.executable, devserver,
+           '--archive_dir', self.archive_dir,
+           '--port', str(self.port),
+           '--logfile', log_path,
+          ] + shlex.split(self.options.devserver_args)
+    with open(log_path, 'a') as log:
+      self.process = subprocess.Popen(cmd, env=env, stdout=log,
+                                      stderr=subprocess.STDOUT)
+
+    deadline = time.time() + _STARTUP_TIMEOUT
+    while time.time() < deadline:
+      if self.process.poll() is not None:
+        raise LoadTestError('Devserver exited with status %d; see %s' %
+                            (self.process.returncode, log_path))
+      try:
+        connection = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        connection.request('GET', '/')
+        if connection.getresponse().status == httplib.OK:
+          return
+      except (socket.error, httplib.HTTPException):
+        pass
+      time.sleep(0.2)
+    raise LoadTestError('Devserver did not answer within %d seconds' %
+                        _STARTUP_TIMEOUT)
+
+  def Stop(self):
+    """Stops the devserver, killing it if it doesn't exit in time."""
+    if self.process and self.process.poll() is None:
+      self.process.send_signal(signal.SIGTERM)
+      deadline = time.time() + 10
+      while self.process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+      if self.process.poll() is None:
+        self.process.kill()
+        self.process.wait()
+
+  def Remove(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+
+def _FindExecutable(name):
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+
+def _FindFreePort():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+  finally:
+    sock.close()
+
+
+def _GetProcessTree(pid):
+  """Returns the pids of a process and of all its descendants."""
+  children = {}
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % entry) as f:
+        # The command name, in parentheses, may contain spaces.
+        ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+    except (IOError, IndexError, ValueError):
+      continue
+    children.setdefault(ppid, []).append(int(entry))
+
+  pids = [pid]
+  for parent in pids:
+    pids.extend(children.get(parent, []))
+  return pids
+
+
+def _SampleResources(pid):
+  """Returns the resident KiB and open file descriptors of a process tree."""
+  rss_kb = 0
+  num_fds = 0
+  for tree_pid in _GetProcessTree(pid):
+    try:
+      with open('/proc/%d/status' % tree_pid) as f:
+        for line in f:
+          if line.startswith('VmRSS:'):
+            rss_kb += int(line.split()[1])
+      num_fds += len(os.listdir('/proc/%d/fd' % tree_pid))
+    except (IOError, OSError):
+      # The process exited, or isn't ours to inspect.
+      continue
+  return rss_kb, num_fds
+
+
+class ResourceSampler(object):
+  """Tracks the peak memory and file descriptors of the devserver."""
+
+  def __init__(self, pid):
+    self._pid = pid
+    self._stop = threading.Event()
+    self._thread = None
+    self.max_rss_kb = 0
+    self.max_fds = 0
+
+  def Start(self):
+    self.max_rss_kb = self.max_fds = 0
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    while not self._stop.is_set():
+      rss_kb, num_fds = _SampleResources(self._pid)
+      self.max_rss_kb = max(self.max_rss_kb, rss_kb)
+      self.max_fds = max(self.max_fds, num_fds)
+      self._stop.wait(_SAMPLE_INTERVAL)
+
+  def Stop(self):
+    self._stop.set()
+    self._thread.join()
+
+
+def _Percentile(sorted_values, percent):
+  """Returns a percentile of a sorted list, by the nearest-rank method."""
+  if not sorted_values:
+    return None
+  rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+  return sorted_values[max(0, rank - 1)]
+
+
+class Client(object):
+  """An HTTP client keeping its connection alive between requests.
+
+  Members:
+    latencies: seconds taken by each successful request, in order.
+    errors: number of failed requests.
+    num_bytes: bytes of response bodies received.
+  """
+
+  def __init__(self, port):
+    self._port = port
+    self._connection = None
+    self.latencies = []
+    self.errors = 0
+    self.num_bytes = 0
+
+  def Request(self, method, path, body=None, headers=None,
+              expected=(httplib.OK,)):
+    """Sends a request and records its outcome.
+
+    Returns:
+      The response body, or None if the request failed.
+    """
+    start = time.time()
+    try:
+      if not self._connection:
+        self._connection = httplib.HTTPConnection('127.0.0.1', self._port,
+                                                  timeout=600)
+      self._connection.request(method, path, body, headers or {})
+      response = self._connection.getresponse()
+      data = response.read()
+    except (socket.error, httplib.HTTPException):
+      self.errors += 1
+      if self._connection:
+        self._connection.close()
+      self._connection = None
+      return None
+
+    if response.status not in expected:
+      self.errors += 1
+      return None
+    self.latencies.append(time.time() - start)
+    self.num_bytes += len(data)
+    return data
+
+  def Close(self):
+    if self._connection:
+      self._connection.close()
+
+
+def _RunClients(port, concurrency, duration, rate, step):
+  """Runs clients calling step(client, index) until the duration is over.
+
+  Args:
+    port: port of the devserver.
+    concurrency: number of clients, each running on its own thread.
+    duration: seconds to run for.
+    rate: total requests per second to pace the clients to, or 0 to send
+          requests as fast as the devserver answers them.
+    step: function sending one request, given a client and the index of the
+          request among those of the client; it returns True once the
+          client has no more requests to send.
+
+  Returns:
+    The clients, once they have finished.
+  """
+  clients = [Client(port) for _ in range(concurrency)]
+  interval = float(concurrency) / rate if rate else 0
+  deadline = time.time() + duration
+
+  def Run(client):
+    index = 0
+    next_start = time.time() + random.uniform(0, interval)
+    while True:
+      now = time.time()
+      if now >= deadline:
+        break
+      if next_start > now:
+        time.sleep(next_start - now)
+      next_start += interval
+      if step(client, index):
+        break
+      index += 1
+    client.Close()
+
+  threads = [threading.Thread(target=Run, args=(client,))
+             for client in clients]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return clients
+
+
+def _UpdateScenario(fixture, options):
+  protocols = options.protocols.split(',')
+  versions = ['0.%d.0.2012_01_01_0000' % index for index in range(20)]
+
+  def Step(client, index):
+    body = _UPDATE_REQUEST[protocols[index % len(protocols)]] % {
+        'version': random.choice(versions), 'board': _BOARD}
+    response = client.Request('POST', '/update', body)
+    # Every check must be offered the payload.
+    if response is not None and _PAYLOAD not in response:
+      client.errors += 1
+
+  return _RunClients(fixture.port, options.concurrency, options.duration,
+                     options.update_rate, Step)
+
+
+def _StaticScenario(fixture, options):
+  size = options.payload_size * 1024 * 1024
+  path = '/static/archive/%s' % _PAYLOAD
+
+  def Step(client, _):
+    length = random.randint(64 * 1024, 1024 * 1024)
+    start = random.randint(0, max(0, size - length))
+    client.Request('GET', path,
+                   headers={'Range': 'bytes=%d-%d' % (start,
+                                                      start + length - 1)},
+                   expected=(httplib.PARTIAL_CONTENT,))
+
+  return _RunClients(fixture.port, options.concurrency, options.duration, 0,
+                     Step)
+
+
+def _FileInfoScenario(fixture, options):
+  def Step(client, _):
+    client.Request('GET', '/api/fileinfo/%s' % _PAYLOAD)
+
+  return _RunClients(fixture.port, options.concurrency, options.duration, 0,
+                     Step)
+
+
+def _ControlFilesScenario(fixture, options):
+  def Step(client, index):
+    if index % 2:
+      client.Request('GET', '/controlfiles?build=%s&control_path=%s' %
+                     (fixture.build, random.choice(fixture.control_paths)))
+    else:
+      client.Request('GET', '/controlfiles?build=%s&suite=bvt&format=json' %
+                     fixture.build)
+
+  return _RunClients(fixture.port, options.concurrency, options.duration, 0,
+                     Step)
+
+
+def _DownloadScenario(fixture, options):
+  """Races clients to download each build, and to wait for it."""
+  builds = list(fixture.builds_to_download)
+  lock = threading.Lock()
+  # The build being raced for, and how many clients have joined the race;
+  # clients move on to the next build once enough have.
+  race = {'build': None, 'racers': options.download_racers}
+
+  def Step(client, _):
+    with lock:
+      if race['racers'] >= options.download_racers:
+        if not builds:
+          return True
+        race['build'] = builds.pop(0)
+        race['racers'] = 0
+      race['racers'] += 1
+      archive_url = race['build']
+    client.Request('GET', '/download?archive_url=%s' % archive_url)
+    client.Request('GET', '/wait_for_status?archive_url=%s' % archive_url)
+
+  return _RunClients(fixture.port, options.concurrency,
+                     options.download_timeout, 0, Step)
+
+
+_SCENARIO_FUNCTIONS = {
+    'update': _UpdateScenario,
+    'static': _StaticScenario,
+    'fileinfo': _FileInfoScenario,
+    'controlfiles': _ControlFilesScenario,
+    'download': _DownloadScenario,
+}
+
+
+def RunScenario(name, fixture, options):
+  """Runs a scenario and returns its results as a dictionary."""
+  sampler = ResourceSampler(fixture.process.pid)
+  sampler.Start()
+  start = time.time()
+  try:
+    clients = _SCENARIO_FUNCTIONS[name](fixture, options)
+  finally:
+    sampler.Stop()
+  elapsed = time.time() - start
+
+  latencies = sorted(latency for client in clients
+                     for latency in client.latencies)
+  num_bytes = sum(client.num_bytes for client in clients)
+  return {
+      'name': name,
+      'requests': len(latencies),
+      'errors': sum(client.errors for client in clients),
+      'seconds': elapsed,
+      'requests_per_second': len(latencies) / elapsed,
+      'bytes_per_second': num_bytes / elapsed,
+      'latency_seconds': {
+          'p50': _Percentile(latencies, 50),
+          'p99': _Percentile(latencies, 99),
+          'max': latencies[-1] if latencies else None,
+          'mean': sum(latencies) / len(latencies) if latencies else None,
+      },
+      'max_rss_kb': sampler.max_rss_kb,
+      'max_fds': sampler.max_fds,
+  }
+
+
+def _GetCommit():
+  """Returns the commit of the devserver's checkout, if it is one."""
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _FormatSeconds(seconds):
+  return '-' if seconds is None else '%.1fms' % (seconds * 1000)
+
+
+def _PrintReport(report):
+  print 'commit %s, devserver args: %s' % (report['commit'],
+                                           report['devserver_args'] or '-')
+  print '%-13s %8s %7s %9s %9s %9s %9s %10s %6s' % (
+      'scenario', 'requests', 'errors', 'req/s', 'p50', 'p99', 'max',
+      'rss', 'fds')
+  for result in report['scenarios']:
+    latency = result['latency_seconds']
+    print '%-13s %8d %7d %9.1f %9s %9s %9s %8dMB %6d' % (
+        result['name'], result['requests'], result['errors'],
+        result['requests_per_second'], _FormatSeconds(latency['p50']),
+        _FormatSeconds(latency['p99']), _FormatSeconds(latency['max']),
+        result['max_rss_kb'] / 1024, result['max_fds'])
+  print 'after all scenarios: %dMB resident, %d open files' % (
+      report['final_rss_kb'] / 1024, report['final_fds'])
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--concurrency', type='int', default=8,
+                    help='number of concurrent clients (default: %default)')
+  parser.add_option('--devserver_args', default='',
+                    help='extra arguments to start the devserver with, e.g. '
+                         '"--workers 4 --production"')
+  parser.add_option('--download_builds', type='int', default=4,
+                    help='builds in the fake Google Storage for the download '
+                         'scenario (default: %default)')
+  parser.add_option('--download_racers', type='int', default=4,
+                    help='clients racing to download each build '
+                         '(default: %default)')
+  parser.add_option('--download_timeout', type='float', default=300,
+                    help='seconds allowed for the download scenario '
+                         '(default: %default)')
+  parser.add_option('--duration', type='float', default=10,
+                    help='seconds to run each other scenario for '
+                         '(default: %default)')
+  parser.add_option('--gs_latency', type='float', default=0,
+                    help='seconds each fake gsutil command takes '
+                         '(default: %default)')
+  parser.add_option('--json', metavar='FILE',
+                    help='write the results as JSON to FILE, or to stdout '
+                         'if FILE is -')
+  parser.add_option('--keep', action='store_true', default=False,
+                    help='keep the synthetic archive and devserver log')
+  parser.add_option('--num_tests', type='int', default=200,
+                    help='control files in the synthetic build '
+                         '(default: %default)')
+  parser.add_option('--payload_size', type='int', default=8,
+                    help='size of payloads in MiB (default: %default)')
+  parser.add_option('--port', type='int', default=0,
+                    help='port to run the devserver on (default: a free one)')
+  parser.add_option('--protocols', default='2.0,3.0',
+                    help='Omaha protocols of update checks, alternated '
+                         '(default: %default)')
+  parser.add_option('--scenarios', default=','.join(SCENARIOS),
+                    help='scenarios to run, in order (default: %default)')
+  parser.add_option('--update_rate', type='float', default=0,
+                    help='update checks per second, or 0 for as many as '
+                         'the devserver takes (default: %default)')
+  options, _ = parser.parse_args()
+
+  scenarios = options.scenarios.split(',')
+  for name in scenarios:
+    if name not in _SCENARIO_FUNCTIONS:
+      parser.error('Unknown scenario %s; choose from %s' %
+                   (name, ', '.join(SCENARIOS)))
+  for protocol in options.protocols.split(','):
+    if protocol not in _UPDATE_REQUEST:
+      parser.error('Unknown protocol %s' % protocol)
+
+  random.seed(0)
+  fixture = Fixture(options)
+  try:
+    fixture.Create()
+    fixture.Start()
+    report = {
+        'timestamp': time.time(),
+        'commit': _GetCommit(),
+        'devserver_args': options.devserver_args,
+        'options': vars(options),
+        'scenarios': [],
+    }
+    for name in scenarios:
+      print >> sys.stderr, 'Running %s...' % name
+      report['scenarios'].append(RunScenario(name, fixture, options))
+    report['final_rss_kb'], report['final_fds'] = _SampleResources(
+        fixture.process.pid)
+  except LoadTestError, e:
+    sys.exit(str(e))
+  finally:
+    fixture.Stop()
+    if options.keep:
+      print >> sys.stderr, 'Kept %s' % fixture.root
+    else:
+      fixture.Remove()
+
+  if options.json == '-':
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+  elif options.json:
+    with open(options.json, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    _PrintReport(report)
+
+
+if __name__ == '__main__':
+  main()
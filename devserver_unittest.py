@@ -6,11 +6,13 @@
 
 """Regression tests for devserver."""
 
+import httplib
 import json
 from xml.dom import minidom
 import os
 import shutil
 import signal
+import socket
 import subprocess
 import tempfile
 import time
@@ -58,7 +60,16 @@ API_SET_UPDATE_BAD_URL = 'http://127.0.0.1:8080/api/setnextupdate/'
 API_SET_UPDATE_URL = API_SET_UPDATE_BAD_URL + '127.0.0.1'
 
 API_SET_UPDATE_REQUEST = 'new_update-test/the-new-update'
-DEVSERVER_STARTUP_DELAY = 1
+
+API_BATCH_HOST_INFO_URL = 'http://127.0.0.1:8080/api/batchhostinfo'
+API_BATCH_SET_UPDATE_URL = 'http://127.0.0.1:8080/api/batchsetnextupdate'
+API_READY_URL = 'http://127.0.0.1:8080/api/ready'
+API_FILE_INFO_URL = 'http://127.0.0.1:8080/api/fileinfo/' + TEST_IMAGE_NAME
+
+# Longest time waited for the devserver to be ready, and the time between
+# checks of whether it is.
+DEVSERVER_STARTUP_TIMEOUT = 30
+DEVSERVER_STARTUP_POLL_INTERVAL = 0.05
 
 
 class DevserverTest(unittest.TestCase):
@@ -75,9 +86,15 @@ class DevserverTest(unittest.TestCase):
     self.image_src = os.path.join(self.src_dir, TEST_IMAGE)
     self.image = os.path.join(self.test_data_path, TEST_IMAGE_NAME)
     shutil.copy(self.image_src, self.image)
+    self.processes = []
 
   def tearDown(self):
-    """Removes testing files."""
+    """Stops the servers started and removes testing files."""
+    # Wait for servers to exit, so that the next test doesn't reach them.
+    for process in self.processes:
+      if process.poll() is None:
+        process.kill()
+      process.wait()
     shutil.rmtree(self.test_data_path)
 
   # Helper methods begin here.
@@ -93,9 +110,25 @@ class DevserverTest(unittest.TestCase):
         ]
 
     process = subprocess.Popen(cmd)
+    self.processes.append(process)
     # Wait for the server to start up.
-    time.sleep(DEVSERVER_STARTUP_DELAY)
-    return process.pid
+    deadline = time.time() + DEVSERVER_STARTUP_TIMEOUT
+    while True:
+      try:
+        urllib2.urlopen(API_READY_URL).close()
+        return process.pid
+      except urllib2.HTTPError, e:
+        if e.code != 503:
+          raise
+      # Connections may be refused or dropped until the server listens.
+      except (urllib2.URLError, httplib.HTTPException, socket.error):
+        pass
+      if process.poll() is not None:
+        self.fail('Devserver exited with status %d' % process.returncode)
+      if time.time() > deadline:
+        os.kill(process.pid, signal.SIGKILL)
+        self.fail('Devserver did not start up')
+      time.sleep(DEVSERVER_STARTUP_POLL_INTERVAL)
 
   def VerifyHandleUpdate(self, protocol):
     """Tests running the server and getting an update for the given protocol."""
@@ -226,6 +259,71 @@ class DevserverTest(unittest.TestCase):
     finally:
       os.kill(pid, signal.SIGKILL)
 
+  def testApiBatchHostInfoAndSetNextUpdate(self):
+    """Tests the batch variants of the setnextupdate and hostinfo commands."""
+    pid = self._StartServer()
+    try:
+      labels = {'127.0.0.1': API_SET_UPDATE_REQUEST,
+                '127.0.0.2': API_SET_UPDATE_REQUEST + '2'}
+      request = urllib2.Request(API_BATCH_SET_UPDATE_URL, json.dumps(labels))
+      connection = urllib2.urlopen(request)
+      self.assertEqual(json.loads(connection.read()), labels)
+      connection.close()
+
+      request = urllib2.Request(API_BATCH_HOST_INFO_URL,
+                                json.dumps(['127.0.0.1', '127.0.0.2',
+                                            '127.0.0.3']))
+      connection = urllib2.urlopen(request)
+      response = json.loads(connection.read())
+      connection.close()
+      self.assertEqual(response['127.0.0.2']['forced_update_label'],
+                       labels['127.0.0.2'])
+      self.assertEqual(response['127.0.0.3'], None)
+
+      # A batch with an empty label is refused as a whole.
+      request = urllib2.Request(API_BATCH_SET_UPDATE_URL,
+                                json.dumps({'127.0.0.4': 'label',
+                                            '127.0.0.5': ''}))
+      self.assertRaises(urllib2.HTTPError, urllib2.urlopen, request)
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
+  def testApiFileInfoETag(self):
+    """Tests that fileinfo's ETag changes when the file is regenerated."""
+    pid = self._StartServer()
+    try:
+      connection = urllib2.urlopen(API_FILE_INFO_URL)
+      etag = connection.info().getheader('ETag')
+      self.assertEqual(json.loads(connection.read())['sha1'], EXPECTED_HASH)
+      connection.close()
+
+      for if_none_match in (etag, '*', '"other",%s' % etag,
+                            ' "other" ,  %s ' % etag, 'W/%s' % etag):
+        request = urllib2.Request(API_FILE_INFO_URL,
+                                  headers={'If-None-Match': if_none_match})
+        try:
+          urllib2.urlopen(request)
+          self.fail('Expected 304 Not Modified for %r' % if_none_match)
+        except urllib2.HTTPError, e:
+          self.assertEqual(e.code, 304)
+
+      request = urllib2.Request(API_FILE_INFO_URL,
+                                headers={'If-None-Match': '"other", %s' % etag})
+
+      # Regenerate the file with the same size, within the same second.
+      file_stat = os.stat(self.image)
+      new_image = self.image + '.new'
+      with open(new_image, 'w') as f:
+        f.write('x' * file_stat.st_size)
+      os.utime(new_image, (file_stat.st_atime, file_stat.st_mtime))
+      os.rename(new_image, self.image)
+      connection = urllib2.urlopen(request)
+      self.assertNotEqual(connection.info().getheader('ETag'), etag)
+      self.assertNotEqual(json.loads(connection.read())['sha1'], EXPECTED_HASH)
+      connection.close()
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
 
 if __name__ == '__main__':
   unittest.main()
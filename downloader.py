@@ -6,12 +6,13 @@
 
 import Queue
 import os
-import shutil
 import tempfile
 import threading
 
 import common_util
+import fs_util
 import log_util
+import trace_util
 
 
 class Downloader(log_util.Loggable):
@@ -107,8 +108,9 @@ class Downloader(log_util.Loggable):
       # instances we have processed this build. Note that during normal
       # execution, this lock is only released in the actual downloading
       # procedure called below.
-      self._build_dir = common_util.AcquireLock(
-          static_dir=self._static_dir, tag=self._lock_tag)
+      with trace_util.Span('acquire_lock'):
+        self._build_dir = common_util.AcquireLock(
+            static_dir=self._static_dir, tag=self._lock_tag)
 
       # Replace '/' with '_' in rel_path because it may contain multiple levels
       # which would not be qualified as part of the suffix.
@@ -116,8 +118,9 @@ class Downloader(log_util.Loggable):
           [rel_path.replace('/', '_'), short_build]))
       Downloader._TouchTimestampForStaged(self._build_dir)
       self._Log('Gathering download requirements %s' % archive_url)
-      artifacts = self.GatherArtifactDownloads(
-          self._staging_dir, archive_url, self._build_dir, short_build)
+      with trace_util.Span('gather_artifacts'):
+        artifacts = self.GatherArtifactDownloads(
+            self._staging_dir, archive_url, self._build_dir, short_build)
       common_util.PrepareBuildDirectory(self._build_dir)
 
       self._Log('Downloading foreground artifacts from %s' % archive_url)
@@ -147,22 +150,26 @@ class Downloader(log_util.Loggable):
     return 'Success'
 
   def _Cleanup(self):
-    """Cleans up the staging dir for this downloader instanfce."""
+    """Cleans up the staging dir for this downloader instanfce.
+
+    The directory is deleted in the background; see fs_util.Remove().
+    """
     if self._staging_dir:
       self._Log('Cleaning up staging directory %s' % self._staging_dir)
-      shutil.rmtree(self._staging_dir)
+      fs_util.Remove(self._staging_dir)
 
     self._staging_dir = None
 
   def _DownloadArtifactsSerially(self, artifacts):
     """Simple function to download all the given artifacts serially."""
     self._Log('Downloading artifacts serially.')
+    status = None
     try:
       for artifact in artifacts:
         artifact.Download()
         artifact.Stage()
     except Exception, e:
-      self._status_queue.put(e)
+      status = e
 
       # Release processing lock, which will remove build components directory
       # so future runs can retry.
@@ -173,15 +180,30 @@ class Downloader(log_util.Loggable):
       # Release processing lock, keeping directory intact.
       if self._build_dir:
         common_util.ReleaseLock(static_dir=self._static_dir, tag=self._lock_tag)
-      self._status_queue.put('Success')
+      # The build is complete, so have latest build lookups pick it up.
+      common_util.InvalidateLatestBuildVersion(
+          self._static_dir, os.path.dirname(self._lock_tag))
+      status = 'Success'
     finally:
-      self._Cleanup()
+      # Cleaning up only renames the staging dir aside, so it is done before
+      # reporting the status, for callers to find it done.
+      try:
+        self._Cleanup()
+      finally:
+        self._status_queue.put(status)
 
   def _DownloadArtifactsInBackground(self, artifacts):
     """Downloads |artifacts| in the background and signals when complete."""
     self._Log('Invoking background download of artifacts')
-    thread = threading.Thread(target=self._DownloadArtifactsSerially,
-                              args=(artifacts,))
+    # The background download is traced separately, under the id of the
+    # request starting it, as that request finishes first.
+    request_id = trace_util.GetRequestId()
+
+    def _DownloadArtifacts():
+      with trace_util.Trace('background_download', request_id):
+        self._DownloadArtifactsSerially(artifacts)
+
+    thread = threading.Thread(target=_DownloadArtifacts)
     thread.start()
 
   def GatherArtifactDownloads(self, main_staging_dir, archive_url, build_dir,
@@ -326,6 +348,9 @@ class ImagesDownloader(Downloader):
   """
   _DONE_FLAG = 'staged'
 
+  # Seconds to wait for another request staging images of the same build.
+  _LOCK_TIMEOUT = 600
+
   # List of images to be staged; empty (default) means all.
   _image_list = []
 
@@ -383,23 +408,32 @@ class ImagesDownloader(Downloader):
     try:
       # Create a static target directory and lock it for processing. We permit
       # the directory to preexist, as different images might be downloaded and
-      # extracted at different times.
+      # extracted at different times. If another request is staging images for
+      # this build, wait for it and then skip whatever it has staged.
       self._build_dir = common_util.AcquireLock(
           static_dir=self._static_dir, tag=self._lock_tag,
-          create_once=False)
-
-      # Replace '/' with '_' in rel_path because it may contain multiple levels
-      # which would not be qualified as part of the suffix.
-      self._staging_dir = tempfile.mkdtemp(suffix='_'.join(
-          [rel_path.replace('/', '_'), short_build]))
-      self._Log('Downloading image archive from %s' % archive_url)
-      dest_static_dir = os.path.join(self._static_dir, self._lock_tag)
-      [image_archive_artifact] = self.GatherArtifactDownloads(
-          self._staging_dir, archive_url, dest_static_dir)
-      image_archive_artifact.Download()
-      self._Log('Staging images to %s' % dest_static_dir)
-      image_archive_artifact.Stage()
-      self._MarkStagedImages(unstaged_image_list)
+          create_once=False, timeout=self._LOCK_TIMEOUT)
+      staged_image_list = self._CheckStagedImages(archive_url,
+                                                  self._static_dir)
+      self._image_list = [image for image in self._image_list
+                          if image not in staged_image_list]
+
+      if self._image_list:
+        # Replace '/' with '_' in rel_path because it may contain multiple
+        # levels which would not be qualified as part of the suffix.
+        self._staging_dir = tempfile.mkdtemp(suffix='_'.join(
+            [rel_path.replace('/', '_'), short_build]))
+        self._Log('Downloading image archive from %s' % archive_url)
+        dest_static_dir = os.path.join(self._static_dir, self._lock_tag)
+        [image_archive_artifact] = self.GatherArtifactDownloads(
+            self._staging_dir, archive_url, dest_static_dir)
+        image_archive_artifact.Download()
+        self._Log('Staging images to %s' % dest_static_dir)
+        image_archive_artifact.Stage()
+        self._MarkStagedImages(self._image_list)
+      else:
+        self._Log('Images for build %s were staged concurrently.' %
+                  self._lock_tag)
 
     except Exception:
       # Release processing "lock", which will indicate to future runs that we
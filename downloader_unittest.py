@@ -17,6 +17,7 @@ import build_artifact
 import common_util
 import devserver
 import downloader
+import fs_util
 
 
 # Fake Dev Server Layout:
@@ -54,6 +55,7 @@ class DownloaderTestBase(mox.MoxTestBase):
     self.mox.StubOutWithMock(common_util, 'GatherArtifactDownloads')
     self.mox.StubOutWithMock(common_util, 'ReleaseLock')
     self.mox.StubOutWithMock(tempfile, 'mkdtemp')
+    self.mox.StubOutWithMock(fs_util, 'Remove')
 
     lock_tag = self._ClassUnderTest().GenerateLockTag(board, self.build)
     common_util.AcquireLock(
@@ -62,6 +64,7 @@ class DownloaderTestBase(mox.MoxTestBase):
     common_util.ReleaseLock(static_dir=self._work_dir, tag=lock_tag)
 
     tempfile.mkdtemp(suffix=mox.IgnoreArg()).AndReturn(self._work_dir)
+    fs_util.Remove(self._work_dir)
     return self._GenerateArtifacts(ignore_background)
 
   def _CreateArtifactDownloader(self, artifacts):
@@ -0,0 +1,193 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Bounded executors for running slow work off the server's request threads.
+
+The devserver serves each request on a thread of a fixed pool. Handlers that
+stage builds or run builds block their thread for minutes, and enough of them
+leave none for update checks. Running such handlers on a BoundedExecutor
+caps how many of them run, and how many wait, at once; calls beyond that fail
+right away instead of queueing up behind the server's threads.
+
+The calls queued and running, the calls rejected and the time calls wait
+for a thread are exported as metrics, by executor name, so that saturated
+executors show on /metrics.
+"""
+
+import Queue
+import math
+import sys
+import threading
+import time
+
+import metrics
+
+
+_CALLS = metrics.Gauge(
+    'devserver_executor_calls',
+    'Calls on a route executor, by executor and state (queued or running).',
+    ('executor', 'state'))
+_CALLS_DONE = metrics.Counter(
+    'devserver_executor_calls_total',
+    'Calls to a route executor, by executor and result (completed or '
+    'rejected).', ('executor', 'result'))
+_WAIT_SECONDS = metrics.Histogram(
+    'devserver_executor_wait_seconds',
+    'Time calls waited for a thread of a route executor, by executor.',
+    ('executor',))
+_RUN_SECONDS = metrics.Histogram(
+    'devserver_executor_run_seconds',
+    'Time calls ran on a route executor, by executor.', ('executor',))
+
+
+class ExecutorError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+class _Call(object):
+  """A call waiting for or running on an executor, and its outcome."""
+  __slots__ = ('func', 'args', 'kwargs', 'queued_at', 'done', 'result',
+               'exc_info')
+
+  def __init__(self, func, args, kwargs):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.queued_at = time.time()
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+
+class BoundedExecutor(object):
+  """Runs calls on a fixed number of threads, with a bounded queue.
+
+  Threads are started on first use, so an executor may be created before
+  forking worker processes.
+
+  Members:
+    name: name of the executor, used for its threads.
+    max_workers: number of calls run at once.
+    max_queued: number of calls waiting for a thread beyond which new ones
+                are refused.
+  """
+
+  def __init__(self, name, max_workers, max_queued):
+    self.name = name
+    self.max_workers = max_workers
+    self.max_queued = max_queued
+    self._calls = Queue.Queue()
+    self._lock = threading.Lock()
+    self._threads = []
+    # Calls queued or running, and totals since creation.
+    self._num_pending = 0
+    self._num_running = 0
+    self._num_completed = 0
+    self._num_rejected = 0
+    # Seconds completed calls spent queued and running.
+    self._total_wait = 0.0
+    self._max_wait = 0.0
+    self._total_run = 0.0
+
+  def GetCapacity(self):
+    """Returns the maximum number of calls queued or running at once."""
+    return self.max_workers + self.max_queued
+
+  def _StartThreads(self):
+    # Called with the lock held.
+    for index in range(self.max_workers):
+      thread = threading.Thread(target=self._WorkLoop,
+                                name='%s-%d' % (self.name, index))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _WorkLoop(self):
+    while True:
+      call = self._calls.get()
+      started_at = time.time()
+      with self._lock:
+        self._num_running += 1
+      _CALLS.Dec((self.name, 'queued'))
+      _CALLS.Inc((self.name, 'running'))
+      try:
+        call.result = call.func(*call.args, **call.kwargs)
+      except:
+        call.exc_info = sys.exc_info()
+      wait = started_at - call.queued_at
+      run = time.time() - started_at
+      with self._lock:
+        self._num_running -= 1
+        self._num_pending -= 1
+        self._num_completed += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._total_run += run
+      _CALLS.Dec((self.name, 'running'))
+      _CALLS_DONE.Inc((self.name, 'completed'))
+      _WAIT_SECONDS.Observe(wait, (self.name,))
+      _RUN_SECONDS.Observe(run, (self.name,))
+      call.done.set()
+
+  def Call(self, func, *args, **kwargs):
+    """Runs a function on the executor and returns its result.
+
+    The caller blocks until the function returns. Exceptions raised by the
+    function are re-raised to the caller, with their traceback.
+
+    Raises:
+      ExecutorError: if the executor is running and queueing as many calls
+                     as it can.
+    """
+    with self._lock:
+      if self._num_pending >= self.GetCapacity():
+        self._num_rejected += 1
+        _CALLS_DONE.Inc((self.name, 'rejected'))
+        raise ExecutorError('Too many %s requests (%d running, %d queued)' %
+                            (self.name, self._num_running,
+                             self._num_pending - self._num_running))
+      self._num_pending += 1
+      if not self._threads:
+        self._StartThreads()
+    _CALLS.Inc((self.name, 'queued'))
+
+    call = _Call(func, args, kwargs)
+    self._calls.put(call)
+    call.done.wait()
+    if call.exc_info:
+      raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+    return call.result
+
+  def EstimateWait(self):
+    """Estimates the seconds until the executor could take another call.
+
+    Returns:
+      The estimate, rounded up to at least a second, or None if no call has
+      completed yet to base it on.
+    """
+    with self._lock:
+      if not self._num_completed:
+        return None
+      mean_run = self._total_run / self._num_completed
+      queued = self._num_pending - self._num_running
+      return max(1, int(math.ceil(mean_run * (queued + 1) /
+                                  self.max_workers)))
+
+  def GetStats(self):
+    """Returns a dictionary describing the load of the executor."""
+    with self._lock:
+      num_completed = max(1, self._num_completed)
+      return {
+          'name': self.name,
+          'max_workers': self.max_workers,
+          'max_queued': self.max_queued,
+          'running': self._num_running,
+          'queued': self._num_pending - self._num_running,
+          'completed': self._num_completed,
+          'rejected': self._num_rejected,
+          'mean_wait_seconds': self._total_wait / num_completed,
+          'max_wait_seconds': self._max_wait,
+          'mean_run_seconds': self._total_run / num_completed,
+      }
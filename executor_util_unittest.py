@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for executor_util module."""
+
+import threading
+import unittest
+
+import executor_util
+import metrics
+
+
+class BoundedExecutorTest(unittest.TestCase):
+
+  def setUp(self):
+    # Metrics are kept by executor name, across tests.
+    self._executor = executor_util.BoundedExecutor(self._testMethodName,
+                                                   max_workers=1,
+                                                   max_queued=1)
+
+  def _GetMetric(self, metric, *label_values):
+    return metric.Collect().get((self._executor.name,) + label_values)
+
+  def _CallInBackground(self, func):
+    thread = threading.Thread(target=self._executor.Call, args=(func,))
+    thread.start()
+    return thread
+
+  def testCall(self):
+    self.assertEqual(self._executor.EstimateWait(), None)
+    self.assertEqual(self._executor.Call(lambda x, y: x + y, 1, y=2), 3)
+    self.assertEqual(self._executor.GetStats()['completed'], 1)
+    self.assertEqual(self._executor.EstimateWait(), 1)
+
+  def testCallRaises(self):
+    def Fail():
+      raise ValueError('oops')
+    self.assertRaises(ValueError, self._executor.Call, Fail)
+
+  def testCallsBeyondCapacityAreRejected(self):
+    """Tests that calls fail fast once all threads and queue slots are used."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def Block():
+      started.set()
+      release.wait()
+
+    threads = [self._CallInBackground(Block)]
+    started.wait()
+    threads.append(self._CallInBackground(Block))
+    while self._executor.GetStats()['queued'] < 1:
+      release.wait(0.01)
+
+    self.assertRaises(executor_util.ExecutorError, self._executor.Call, Block)
+    stats = self._executor.GetStats()
+    self.assertEqual((stats['running'], stats['queued'], stats['rejected']),
+                     (1, 1, 1))
+    self.assertEqual(self._GetMetric(executor_util._CALLS, 'running'), 1)
+    self.assertEqual(self._GetMetric(executor_util._CALLS, 'queued'), 1)
+    self.assertEqual(
+        self._GetMetric(executor_util._CALLS_DONE, 'rejected'), 1)
+
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self._executor.Call(lambda: 'done'), 'done')
+    self.assertEqual(self._GetMetric(executor_util._CALLS, 'running'), 0)
+    self.assertEqual(self._GetMetric(executor_util._CALLS, 'queued'), 0)
+    self.assertEqual(
+        self._GetMetric(executor_util._CALLS_DONE, 'completed'), 3)
+    # Counts of the wait time histogram, after its buckets and sum.
+    self.assertEqual(self._GetMetric(executor_util._WAIT_SECONDS)[-1], 3)
+    self.assertTrue('devserver_executor_calls{executor="%s",state="queued"} 0'
+                    % self._executor.name in metrics.Render())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,319 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""File system operations done in process, instead of by forking shells.
+
+Remove() renames a directory tree aside, into a trash directory, and deletes
+it on a background thread. A rename within a file system takes no time
+whatever the size of the tree, so callers never wait on deleting a multi-GB
+tree, and the path is free for reuse, e.g. to retry staging a build, as soon
+as Remove() returns. Trash directories are hidden, named with TRASH_PREFIX,
+so that listings skip them like ls does. They are made in the directory set
+with Configure(trash_dir=...), for trees on its file system, so that
+PurgeTrash() on it deletes all those left over by a process that exited
+before it got to them; without one, they are made next to the trees removed.
+
+The background thread runs at the lowest CPU priority, which also lowers its
+I/O priority under the CFQ and BFQ schedulers, and deletes at most
+max_bytes_per_second bytes a second (see Configure()), so that deleting large
+trees doesn't starve requests of disk I/O. Usage:
+
+  fs_util.Remove(payload_dir)
+  fs_util.CopyFiles(packages_dir, autotest_dir)
+"""
+
+import Queue
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args, **kwargs):
+  return log_util.LogWithTag('FS_UTIL', message, *args, **kwargs)
+
+
+# Prefix of the names of trash directories.
+TRASH_PREFIX = '.trash.'
+
+# Number of files CopyFiles() copies at once by default.
+DEFAULT_COPY_THREADS = 4
+
+# Bytes deleted per second by the background thread by default.
+DEFAULT_MAX_BYTES_PER_SECOND = 256 * 1024 * 1024
+
+# Bytes each deleted file or directory counts for at least, as deleting one
+# costs I/O however small it is.
+_MIN_ENTRY_BYTES = 4096
+
+# Niceness of the background thread. On Linux, nice() only applies to the
+# calling thread.
+_REMOVER_NICENESS = 19
+
+# Bytes deleted per second by the background thread; None for no limit.
+_max_bytes_per_second = DEFAULT_MAX_BYTES_PER_SECOND
+
+# Directory trash is made in, for trees on its file system; see Configure().
+_trash_dir = None
+
+# The remover of the current process, started on first use; a forked child
+# starts its own.
+_remover = None
+_remover_lock = threading.Lock()
+
+
+class FsUtilError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def MakeDirs(path):
+  """Creates a directory and any missing parents, like mkdir -p."""
+  try:
+    os.makedirs(path)
+  except OSError, e:
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+
+def _RemoveNow(path):
+  """Removes a file or directory tree right away, ignoring missing paths."""
+  try:
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path)
+    else:
+      os.remove(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+def Configure(max_bytes_per_second=DEFAULT_MAX_BYTES_PER_SECOND,
+              trash_dir=None):
+  """Sets how trees are deleted in the background.
+
+  Args:
+    max_bytes_per_second: bytes deleted per second at most, counting each
+                          file for its size; None for no limit.
+    trash_dir: existing directory that trees on its file system are renamed
+               into when removed; trees on other file systems are deleted
+               where they are. None to rename trees into trash next to them.
+  """
+  # pylint: disable=W0603
+  global _max_bytes_per_second, _trash_dir
+  _max_bytes_per_second = max_bytes_per_second
+  _trash_dir = trash_dir
+
+
+class _Remover(object):
+  """Deletes trash directories, or other trees, on a background thread."""
+
+  def __init__(self):
+    self.pid = os.getpid()
+    self._queue = Queue.Queue()
+    self._thread = threading.Thread(target=self._RemoveLoop, name='fs_remover')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Put(self, trash_dir):
+    self._queue.put(trash_dir)
+
+  def Wait(self):
+    """Waits until the trash directories queued so far are deleted."""
+    self._queue.join()
+
+  def _RemoveLoop(self):
+    try:
+      os.nice(_REMOVER_NICENESS)
+    except OSError, e:
+      _Log('Failed to lower the priority of removals: %s', e)
+    while True:
+      trash_dir = self._queue.get()
+      try:
+        start = time.time()
+        num_bytes = self._RemoveThrottled(trash_dir)
+        _Log('Removed %s (%d bytes) in %.1fs', trash_dir, num_bytes,
+             time.time() - start, level=log_util.DEBUG)
+      except OSError, e:
+        _Log('Failed to remove %s: %s', trash_dir, e, level=log_util.WARNING)
+      finally:
+        self._queue.task_done()
+
+  def _RemoveThrottled(self, trash_dir):
+    """Deletes a tree, bottom up, at most _max_bytes_per_second fast.
+
+    Returns:
+      The number of bytes deleted, as counted for throttling.
+    """
+    start = time.time()
+    num_bytes = 0
+
+    def _OnError(e):
+      _Log('Failed to list %s: %s', e.filename, e, level=log_util.WARNING)
+
+    for dir_path, dir_names, file_names in os.walk(trash_dir, topdown=False,
+                                                   onerror=_OnError):
+      # Subdirectories are empty by now, as the walk is bottom up.
+      for name in file_names + dir_names:
+        path = os.path.join(dir_path, name)
+        try:
+          size = os.lstat(path).st_size
+          if name in dir_names and not os.path.islink(path):
+            os.rmdir(path)
+          else:
+            os.remove(path)
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            raise
+          continue
+        num_bytes += max(size, _MIN_ENTRY_BYTES)
+        max_bytes_per_second = _max_bytes_per_second
+        if max_bytes_per_second:
+          delay = (start + float(num_bytes) / max_bytes_per_second -
+                   time.time())
+          if delay > 0:
+            time.sleep(delay)
+    _RemoveNow(trash_dir)
+    return num_bytes
+
+
+def _GetRemover():
+  """Returns the remover of the current process, starting it if needed."""
+  global _remover
+  remover = _remover
+  if remover is None or remover.pid != os.getpid():
+    with _remover_lock:
+      remover = _remover
+      if remover is None or remover.pid != os.getpid():
+        remover = _remover = _Remover()
+  return remover
+
+
+def Remove(path, background=True):
+  """Removes a file or directory tree, like rm -rf.
+
+  Args:
+    path: path to remove; nothing is done if it doesn't exist.
+    background: if True, a directory tree is renamed into a trash directory
+                and deleted on a background thread; otherwise, it is deleted
+                before returning. Files are always deleted right away. A tree
+                on another file system than the configured trash_dir can't
+                be renamed into it, and is deleted where it is, in the
+                background; its path is only free once it is deleted.
+
+  Raises:
+    OSError: if path could not be removed, or renamed aside.
+  """
+  if (not background or not os.path.isdir(path) or
+      os.path.islink(path)):
+    _RemoveNow(path)
+    return
+
+  path = os.path.abspath(path)
+  trash_parent = _trash_dir
+  if trash_parent is None:
+    trash_parent = os.path.dirname(path)
+  elif os.stat(trash_parent).st_dev != os.stat(path).st_dev:
+    _GetRemover().Put(path)
+    return
+  trash_dir = tempfile.mkdtemp(prefix=TRASH_PREFIX, dir=trash_parent)
+  try:
+    os.rename(path, os.path.join(trash_dir, os.path.basename(path)))
+  except OSError, e:
+    os.rmdir(trash_dir)
+    # Removed by someone else in the meantime.
+    if e.errno == errno.ENOENT:
+      return
+    # On another mount of the same file system.
+    if e.errno == errno.EXDEV:
+      _GetRemover().Put(path)
+      return
+    raise
+  _GetRemover().Put(trash_dir)
+
+
+def PurgeTrash(directory):
+  """Deletes in the background the trash directories left in a directory.
+
+  These are left by processes that exited before deleting them.
+  """
+  try:
+    names = os.listdir(directory)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+  for name in names:
+    if name.startswith(TRASH_PREFIX):
+      _GetRemover().Put(os.path.join(directory, name))
+
+
+def WaitForRemovals():
+  """Waits until the trees removed so far in the background are deleted."""
+  remover = _remover
+  if remover is not None and remover.pid == os.getpid():
+    remover.Wait()
+
+
+def CopyFiles(src_dir, dst_dir, num_threads=DEFAULT_COPY_THREADS):
+  """Copies the files of a directory into another, like cp src_dir/* dst_dir.
+
+  Files are copied with their permission bits, num_threads at a time. As
+  with cp, hidden files are left out, and subdirectories are not copied but
+  make the copy fail once the files are copied.
+
+  Args:
+    src_dir: directory to copy the files of.
+    dst_dir: existing directory to copy them into.
+    num_threads: number of files copied at once.
+
+  Raises:
+    FsUtilError: if a file could not be copied, src_dir has subdirectories
+                 or dst_dir is not a directory.
+  """
+  if not os.path.isdir(dst_dir):
+    raise FsUtilError('Not a directory: %s' % dst_dir)
+  try:
+    names = sorted(name for name in os.listdir(src_dir)
+                   if not name.startswith('.'))
+  except OSError, e:
+    raise FsUtilError('Cannot list %s: %s' % (src_dir, e))
+
+  files = Queue.Queue()
+  directories = []
+  for name in names:
+    src_path = os.path.join(src_dir, name)
+    if os.path.isdir(src_path):
+      directories.append(src_path)
+    else:
+      files.put(src_path)
+
+  errors = []
+
+  def _CopyLoop():
+    while True:
+      try:
+        src_path = files.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        shutil.copy(src_path, dst_dir)
+      except (IOError, OSError), e:
+        errors.append('Failed to copy %s to %s: %s' % (src_path, dst_dir, e))
+
+  threads = [threading.Thread(target=_CopyLoop, name='fs_copy')
+             for _ in range(min(num_threads, files.qsize()))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  errors.extend('Omitting directory %s' % path for path in directories)
+  if errors:
+    raise FsUtilError('; '.join(errors))
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for fs_util module."""
+
+import errno
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import fs_util
+
+
+class FsUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self._work_dir = tempfile.mkdtemp('fs_util_unittest')
+
+  def tearDown(self):
+    fs_util.WaitForRemovals()
+    fs_util.Configure()
+    shutil.rmtree(self._work_dir)
+
+  def _StubRemover(self):
+    """Returns the list that paths queued for removal are appended to."""
+    removed = []
+
+    class _FakeRemover(object):
+      Put = removed.append
+
+    get_remover = fs_util._GetRemover
+    fs_util._GetRemover = _FakeRemover
+    self.addCleanup(setattr, fs_util, '_GetRemover', get_remover)
+    return removed
+
+  def _MakeFile(self, *path):
+    path = os.path.join(self._work_dir, *path)
+    fs_util.MakeDirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(os.path.basename(path))
+    return path
+
+  def testMakeDirs(self):
+    """Creates missing parents, and accepts existing directories only."""
+    path = os.path.join(self._work_dir, 'a', 'b')
+    fs_util.MakeDirs(path)
+    fs_util.MakeDirs(path)
+    self.assertTrue(os.path.isdir(path))
+    self.assertRaises(OSError, fs_util.MakeDirs, self._MakeFile('file'))
+
+  def testRemoveRenamesTreeAside(self):
+    """Frees the path right away, and deletes the tree in the background."""
+    self._MakeFile('tree', 'sub', 'file')
+    tree = os.path.join(self._work_dir, 'tree')
+    fs_util.Remove(tree)
+    self.assertFalse(os.path.exists(tree))
+    # The path can be reused before the tree is deleted.
+    fs_util.MakeDirs(tree)
+
+    fs_util.WaitForRemovals()
+    self.assertEqual(['tree'], os.listdir(self._work_dir))
+    self.assertEqual([], os.listdir(tree))
+
+  def testRemoveFilesAndMissingPaths(self):
+    """Removes files and symlinks right away, and ignores missing paths."""
+    path = self._MakeFile('file')
+    link = os.path.join(self._work_dir, 'link')
+    os.symlink(self._work_dir, link)
+    fs_util.Remove(path)
+    fs_util.Remove(link)
+    fs_util.Remove(os.path.join(self._work_dir, 'missing'))
+    fs_util.Remove(self._MakeFile('tree', 'file'), background=False)
+    self.assertEqual(['tree'], os.listdir(self._work_dir))
+
+  def testRemoveThrottled(self):
+    """Deletes at the configured rate, at a low priority of its own."""
+    niceness = os.nice(0)
+    for i in range(10):
+      self._MakeFile('tree', 'file%d' % i)
+    # Each file counts for at least 4096 bytes.
+    fs_util.Configure(max_bytes_per_second=10 * 4096 / 0.2)
+    start = time.time()
+    fs_util.Remove(os.path.join(self._work_dir, 'tree'))
+    fs_util.WaitForRemovals()
+    self.assertTrue(time.time() - start >= 0.15)
+    self.assertEqual([], os.listdir(self._work_dir))
+    self.assertEqual(niceness, os.nice(0))
+
+  def testRemoveIntoTrashDir(self):
+    """Renames trees into the configured trash directory."""
+    trash_dir = os.path.join(self._work_dir, '.trash')
+    fs_util.MakeDirs(trash_dir)
+    fs_util.Configure(trash_dir=trash_dir)
+    self._MakeFile('a', 'tree', 'file')
+    removed = self._StubRemover()
+    fs_util.Remove(os.path.join(self._work_dir, 'a', 'tree'))
+    self.assertEqual([], os.listdir(os.path.join(self._work_dir, 'a')))
+    self.assertEqual(1, len(removed))
+    self.assertEqual(trash_dir, os.path.dirname(removed[0]))
+    self.assertEqual(['tree'], os.listdir(removed[0]))
+
+  def testRemoveOnOtherFileSystem(self):
+    """Deletes trees that can't be renamed into the trash dir in place."""
+    trash_dir = os.path.join(self._work_dir, '.trash')
+    fs_util.MakeDirs(trash_dir)
+    fs_util.Configure(trash_dir=trash_dir)
+    tree = os.path.dirname(self._MakeFile('tree', 'file'))
+    removed = self._StubRemover()
+    rename = os.rename
+
+    def _Rename(src, dst):
+      if src == tree:
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+      rename(src, dst)
+
+    os.rename = _Rename
+    try:
+      fs_util.Remove(tree)
+    finally:
+      os.rename = rename
+    self.assertEqual([tree], removed)
+    self.assertEqual([], os.listdir(trash_dir))
+
+  def testPurgeTrash(self):
+    """Deletes trash directories left over, and nothing else."""
+    self._MakeFile(fs_util.TRASH_PREFIX + 'old', 'tree', 'file')
+    self._MakeFile('.hidden')
+    fs_util.PurgeTrash(self._work_dir)
+    fs_util.PurgeTrash(os.path.join(self._work_dir, 'missing'))
+    fs_util.WaitForRemovals()
+    self.assertEqual(['.hidden'], os.listdir(self._work_dir))
+
+  def testCopyFiles(self):
+    """Copies files with their modes, leaving hidden files out."""
+    names = ['file%d' % i for i in range(10)]
+    for name in names:
+      self._MakeFile('src', name)
+    self._MakeFile('src', '.hidden')
+    os.chmod(os.path.join(self._work_dir, 'src', 'file0'), 0755)
+    dst_dir = os.path.join(self._work_dir, 'dst')
+    fs_util.MakeDirs(dst_dir)
+
+    fs_util.CopyFiles(os.path.join(self._work_dir, 'src'), dst_dir,
+                      num_threads=3)
+    self.assertEqual(names, sorted(os.listdir(dst_dir)))
+    for name in names:
+      with open(os.path.join(dst_dir, name)) as f:
+        self.assertEqual(name, f.read())
+    self.assertEqual(0755, stat.S_IMODE(
+        os.stat(os.path.join(dst_dir, 'file0')).st_mode))
+
+  def testCopyFilesFailures(self):
+    """Copies the files, then fails on subdirectories, as cp does."""
+    self._MakeFile('src', 'file')
+    self._MakeFile('src', 'sub', 'file')
+    dst_dir = os.path.join(self._work_dir, 'dst')
+    fs_util.MakeDirs(dst_dir)
+    self.assertRaises(fs_util.FsUtilError, fs_util.CopyFiles,
+                      os.path.join(self._work_dir, 'src'), dst_dir)
+    self.assertEqual(['file'], os.listdir(dst_dir))
+
+    shutil.rmtree(os.path.join(self._work_dir, 'src', 'sub'))
+    self.assertRaises(fs_util.FsUtilError, fs_util.CopyFiles,
+                      os.path.join(self._work_dir, 'src'),
+                      os.path.join(self._work_dir, 'missing'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,379 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Compact, bounded records of hosts engaging in update activity."""
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+
+# Default number of events kept per host.
+DEFAULT_LOG_SIZE = 100
+
+# Default memory budget for the host table, in bytes.
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Default number of independently locked shards of the host table.
+DEFAULT_NUM_SHARDS = 16
+
+# Fields of a log entry other than its timestamp, in the order they are packed.
+# Absent fields are packed as None.
+_LOG_FIELDS = ('event_type', 'event_result', 'version', 'track', 'board',
+               'previous_version')
+_INT_LOG_FIELDS = ('event_type', 'event_result')
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Kinds of changes recorded to a host journal, see host_journal.
+JOURNAL_SET_ATTRS = 'a'
+JOURNAL_POP_ATTR = 'p'
+JOURNAL_LOG_ENTRY = 'e'
+
+def _Intern(value):
+  """Returns a canonical copy of a string recurring across hosts and events.
+
+  Versions, boards and tracks are ASCII, so they are interned as byte
+  strings; interned strings are freed once no host refers to them any more.
+  Other strings are returned as they are.
+  """
+  if isinstance(value, unicode):
+    try:
+      value = value.encode('ascii')
+    except UnicodeEncodeError:
+      return value
+  if isinstance(value, str):
+    return intern(value)
+  return value
+
+
+def PackLogEntry(entry, timestamp=None):
+  """Packs a log entry dictionary into a tuple.
+
+  Args:
+    entry: dictionary with any of the keys in _LOG_FIELDS.
+    timestamp: seconds since the epoch; defaults to now.
+  Returns:
+    A tuple of (int timestamp, event_type, event_result, version, track,
+    board, previous_version).
+  """
+  assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
+  if timestamp is None:
+    timestamp = time.time()
+  packed = [int(timestamp)]
+  for field in _LOG_FIELDS:
+    value = entry.get(field)
+    if value is not None:
+      value = int(value) if field in _INT_LOG_FIELDS else _Intern(value)
+    packed.append(value)
+  return tuple(packed)
+
+
+def UnpackLogEntry(packed):
+  """Returns the dictionary form of a packed log entry.
+
+  The dictionary contains a formatted `timestamp' and only those fields that
+  were present in the original entry.
+  """
+  entry = {'timestamp': time.strftime(_TIMESTAMP_FORMAT,
+                                      time.localtime(packed[0]))}
+  for field, value in zip(_LOG_FIELDS, packed[1:]):
+    if value is not None:
+      entry[field] = value
+  return entry
+
+
+class HostInfo(object):
+  """Records information about an individual host.
+
+  Members:
+    attrs: Static attributes (legacy). Within a HostInfoTable this dictionary
+           is copy-on-write: it is replaced rather than modified, so readers
+           may use it without locking.
+    log: Ring buffer of the most recent packed log entries (see PackLogEntry)
+    last_seen: Time of the last update activity of the host
+  """
+  __slots__ = ('attrs', 'log', 'last_seen')
+
+  def __init__(self, log_size=DEFAULT_LOG_SIZE):
+    # A dictionary of current attributes pertaining to the host.
+    self.attrs = {}
+    self.log = collections.deque(maxlen=log_size)
+    self.last_seen = time.time()
+
+  def __repr__(self):
+    return 'attrs=%s, log=%s' % (self.attrs, self.GetLog())
+
+  def AddLogEntry(self, entry):
+    """Append a new log entry, dropping the oldest one if the log is full."""
+    self.log.append(PackLogEntry(entry))
+
+  def GetLog(self, since=None):
+    """Returns the log as a list of dictionaries, oldest entry first.
+
+    Args:
+      since: if set, only return entries logged at or after this time, in
+             seconds since the epoch.
+    """
+    # Copying the deque is atomic, so concurrent appends can't interfere.
+    log = list(self.log)
+    if since is not None:
+      log = [packed for packed in log if packed[0] >= since]
+    return [UnpackLogEntry(packed) for packed in log]
+
+
+def _EstimateHostSize(log_size):
+  """Estimates the worst-case memory footprint of a host record in bytes."""
+  host = HostInfo(log_size)
+  attrs = {'last_known_version': '', 'last_event_status': 0,
+           'last_event_type': 0, 'forced_update_label': ''}
+  entry = PackLogEntry({})
+  ip = '255.255.255.255'
+  return (sys.getsizeof(host) + sys.getsizeof(attrs) +
+          sys.getsizeof(host.log) + sys.getsizeof(ip) +
+          # Table slot and linked list node of the OrderedDict.
+          2 * sys.getsizeof([None] * 4) +
+          log_size * (sys.getsizeof(entry) + sys.getsizeof(0) * 2))
+
+
+class _Shard(object):
+  """A lock and the hosts guarded by it, least recently active first."""
+  __slots__ = ('lock', 'hosts', 'num_expired')
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.hosts = collections.OrderedDict()
+    self.num_expired = 0
+
+
+class HostInfoTable(object):
+  """Records information about a set of hosts who engage in update activity.
+
+  The table is bounded: it holds at most as many hosts as fit into the memory
+  budget, assuming full event logs, and drops the least recently active host
+  when a new one is added beyond that.
+
+  The table is safe for concurrent use. Hosts are spread across shards by id,
+  each guarded by its own lock, so that pings from different hosts rarely
+  contend. Expiry is per shard, each holding an equal part of max_hosts.
+  Looking up a host and reading its attrs and log takes no lock at all.
+
+  Members:
+    log_size: Number of events kept per host.
+    memory_budget: Memory budget of the table in bytes.
+    max_hosts: Maximum number of hosts the table holds.
+    journal: If set, a host_journal.HostJournal that changes are recorded to.
+  """
+
+  def __init__(self, log_size=DEFAULT_LOG_SIZE,
+               memory_budget=DEFAULT_MEMORY_BUDGET,
+               num_shards=DEFAULT_NUM_SHARDS):
+    self._shards = [_Shard() for _ in range(num_shards)]
+    self.log_size = log_size
+    self.memory_budget = memory_budget
+    self._host_size = _EstimateHostSize(log_size)
+    self.max_hosts = max(1, memory_budget // self._host_size)
+    self.journal = None
+
+  def __repr__(self):
+    return '%s' % dict((host_id, self.GetHostInfo(host_id))
+                       for host_id in self.GetHostIds())
+
+  def _GetShard(self, host_id):
+    return self._shards[hash(host_id) % len(self._shards)]
+
+  def _GetInitHostInfoLocked(self, shard, host_id, keep=()):
+    """Implements GetInitHostInfo(); the shard's lock must be held.
+
+    Hosts in keep are not expired to make room, even if that leaves the shard
+    over its share of max_hosts; the next host added trims it back.
+    """
+    host_info = shard.hosts.pop(host_id, None)
+    if host_info is None:
+      host_info = HostInfo(self.log_size)
+      max_shard_hosts = max(1, -(-self.max_hosts // len(self._shards)))
+      while len(shard.hosts) >= max_shard_hosts:
+        # Hosts kept were all made the most recently active ones, so once the
+        # least recently active host is kept, so are all others.
+        oldest = next(iter(shard.hosts))
+        if oldest in keep:
+          break
+        del shard.hosts[oldest]
+        shard.num_expired += 1
+    else:
+      host_info.last_seen = time.time()
+    shard.hosts[host_id] = host_info
+    return host_info
+
+  def GetInitHostInfo(self, host_id):
+    """Return a host's info object, or create a new one if none exists.
+
+    This marks the host as the most recently active one.
+    """
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      return self._GetInitHostInfoLocked(shard, host_id)
+
+  @contextlib.contextmanager
+  def _LockShards(self, host_ids):
+    """Holds the locks of all shards of the given hosts.
+
+    Locks are taken in shard order, so that concurrent callers can't deadlock.
+    """
+    shards = sorted(set(hash(host_id) % len(self._shards)
+                        for host_id in host_ids))
+    locked = []
+    try:
+      for index in shards:
+        self._shards[index].lock.acquire()
+        locked.append(self._shards[index].lock)
+      yield
+    finally:
+      for lock in reversed(locked):
+        lock.release()
+
+  def GetHostInfo(self, host_id):
+    """Return an info object for given host, if such exists."""
+    # A single dictionary lookup is atomic, so this needs no lock.
+    return self._GetShard(host_id).hosts.get(host_id)
+
+  def UpdateHost(self, host_id, attrs=None, log_entry=None):
+    """Records update activity of a host.
+
+    Args:
+      host_id: id of the host, normally its IP address.
+      attrs: dictionary of attributes to set on the host.
+      log_entry: if set, a dictionary to append to the host's event log.
+    Returns:
+      The host's info object.
+    """
+    packed = PackLogEntry(log_entry) if log_entry is not None else None
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      curr_host_info = self._GetInitHostInfoLocked(shard, host_id)
+      if attrs:
+        new_attrs = dict(curr_host_info.attrs)
+        new_attrs.update(attrs)
+        curr_host_info.attrs = new_attrs
+        self._Journal(JOURNAL_SET_ATTRS, host_id, attrs)
+      if packed is not None:
+        curr_host_info.log.append(packed)
+        self._Journal(JOURNAL_LOG_ENTRY, host_id, packed)
+    return curr_host_info
+
+  def SetAttr(self, host_id, key, value):
+    """Sets a single attribute of a host, creating the host if needed."""
+    self.UpdateHost(host_id, attrs={key: value})
+
+  def PopAttr(self, host_id, key):
+    """Removes an attribute from a host and returns it, or None if unset.
+
+    This is atomic: of several concurrent callers, only one gets the value.
+    """
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      curr_host_info = shard.hosts.get(host_id)
+      if not curr_host_info or key not in curr_host_info.attrs:
+        return None
+      new_attrs = dict(curr_host_info.attrs)
+      value = new_attrs.pop(key)
+      curr_host_info.attrs = new_attrs
+      self._Journal(JOURNAL_POP_ATTR, host_id, key)
+    return value
+
+  def SetAttrBatch(self, key, values):
+    """Sets an attribute on several hosts, as one write.
+
+    Other writers and GetAttrsBatch() see either none or all of the changes.
+    Lookups of single hosts take no lock, so they may see some hosts changed
+    and not others yet. Adding the hosts never expires any of them.
+
+    Args:
+      key: name of the attribute.
+      values: dictionary mapping host ids to the value to set on each.
+    """
+    with self._LockShards(values):
+      for host_id, value in values.iteritems():
+        shard = self._GetShard(host_id)
+        curr_host_info = self._GetInitHostInfoLocked(shard, host_id,
+                                                     keep=values)
+        new_attrs = dict(curr_host_info.attrs)
+        new_attrs[key] = value
+        curr_host_info.attrs = new_attrs
+        self._Journal(JOURNAL_SET_ATTRS, host_id, {key: value})
+
+  def GetAttrsBatch(self, host_ids):
+    """Returns a consistent snapshot of the attributes of several hosts.
+
+    Args:
+      host_ids: iterable of host ids.
+    Returns:
+      A dictionary mapping each host id to its attributes, or to None for
+      unknown hosts.
+    """
+    host_ids = list(host_ids)
+    with self._LockShards(host_ids):
+      host_infos = [(host_id, self.GetHostInfo(host_id))
+                    for host_id in host_ids]
+    return dict((host_id, curr_host_info.attrs if curr_host_info else None)
+                for host_id, curr_host_info in host_infos)
+
+  def _Journal(self, kind, host_id, payload):
+    # Called with the shard's lock held, so that the journal sees the changes
+    # of each host in order.
+    if self.journal:
+      self.journal.Record(kind, host_id, payload)
+
+  def Load(self, hosts):
+    """Populates the table, e.g. from a journal replay.
+
+    Args:
+      hosts: iterable of (host_id, attrs, packed log entries) tuples, least
+             recently active host first.
+    """
+    for host_id, attrs, log in hosts:
+      shard = self._GetShard(host_id)
+      with shard.lock:
+        curr_host_info = self._GetInitHostInfoLocked(shard, host_id)
+        new_attrs = dict(curr_host_info.attrs)
+        new_attrs.update(attrs)
+        curr_host_info.attrs = new_attrs
+        curr_host_info.log.extend(
+            tuple(packed[:3]) + tuple(_Intern(value) for value in packed[3:])
+            for packed in log)
+
+  def GetHostIds(self):
+    """Returns a list of the ids of all hosts in the table."""
+    host_ids = []
+    for shard in self._shards:
+      # Iterating an OrderedDict isn't atomic.
+      with shard.lock:
+        host_ids.extend(shard.hosts)
+    return host_ids
+
+  def GetStats(self):
+    """Returns a dictionary describing the size and memory use of the table."""
+    num_hosts = 0
+    num_expired = 0
+    num_events = 0
+    for shard in self._shards:
+      with shard.lock:
+        num_hosts += len(shard.hosts)
+        num_expired += shard.num_expired
+        num_events += sum(len(host_info.log)
+                          for host_info in shard.hosts.itervalues())
+    entry_size = sys.getsizeof(PackLogEntry({})) + sys.getsizeof(0) * 2
+    empty_host_size = _EstimateHostSize(0)
+    return {
+        'hosts': num_hosts,
+        'max_hosts': self.max_hosts,
+        'expired_hosts': num_expired,
+        'events': num_events,
+        'log_size': self.log_size,
+        'memory_budget': self.memory_budget,
+        'estimated_memory': num_hosts * empty_host_size +
+                            num_events * entry_size,
+    }
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_info module."""
+
+import sys
+import threading
+import unittest
+
+import host_info
+
+
+class HostInfoTest(unittest.TestCase):
+
+  def testPackLogEntry(self):
+    """Tests that log entries survive packing and unpacking."""
+    entry = {'version': u'1098.0.2011_09_28_1635', 'track': 'dev-channel',
+             'board': 'x86-alex', 'event_type': 3, 'event_result': '2'}
+    packed = host_info.PackLogEntry(dict(entry), timestamp=1349000000.5)
+    self.assertEqual(packed[0], 1349000000)
+    unpacked = host_info.UnpackLogEntry(packed)
+    self.assertTrue(unpacked.pop('timestamp'))
+    entry['event_result'] = 2
+    self.assertEqual(unpacked, entry)
+
+    # Version strings are shared between entries.
+    other = host_info.PackLogEntry({'version': u'1098.0.2011_09_28_1635'})
+    self.assertTrue(other[3] is packed[3])
+
+    # Strings that aren't ASCII are kept as they are.
+    self.assertEqual(host_info.PackLogEntry({'track': u'b\xeata'})[4],
+                     u'b\xeata')
+
+  def testInternedStringsAreFreed(self):
+    """Tests that strings no host refers to any more aren't kept."""
+    version = ''.join(['1098.0.', '2011_09_28_1635-unique'])
+    num_refs = sys.getrefcount(version)
+    packed = host_info.PackLogEntry({'version': version})
+    self.assertTrue(packed[3] is version)
+    del packed
+    self.assertEqual(sys.getrefcount(version), num_refs)
+
+  def testLogIsBounded(self):
+    curr_host_info = host_info.HostInfo(log_size=3)
+    for event_type in range(5):
+      curr_host_info.AddLogEntry({'event_type': event_type})
+    self.assertEqual([entry['event_type'] for entry in curr_host_info.GetLog()],
+                     [2, 3, 4])
+
+
+class HostInfoTableTest(unittest.TestCase):
+
+  def testExpiresLeastRecentlyActiveHost(self):
+    """Tests that the table stays within budget by dropping idle hosts."""
+    table = host_info.HostInfoTable(log_size=10, memory_budget=1, num_shards=1)
+    table.max_hosts = 2
+    table.GetInitHostInfo('1.1.1.1').attrs['x'] = 1
+    table.GetInitHostInfo('2.2.2.2')
+    # Touch the first host, so the second one is the least recently active.
+    table.GetInitHostInfo('1.1.1.1')
+    table.GetInitHostInfo('3.3.3.3')
+    self.assertEqual(table.GetHostInfo('2.2.2.2'), None)
+    self.assertEqual(table.GetHostInfo('1.1.1.1').attrs, {'x': 1})
+    self.assertEqual(table.GetStats()['expired_hosts'], 1)
+
+  def testMemoryBudget(self):
+    table = host_info.HostInfoTable(log_size=100,
+                                    memory_budget=10 * 1024 * 1024)
+    small_table = host_info.HostInfoTable(log_size=0,
+                                          memory_budget=10 * 1024 * 1024)
+    self.assertTrue(0 < table.max_hosts < small_table.max_hosts)
+
+    table.GetInitHostInfo('1.1.1.1').AddLogEntry({'event_type': 3})
+    stats = table.GetStats()
+    self.assertEqual(stats['hosts'], 1)
+    self.assertEqual(stats['events'], 1)
+    self.assertTrue(0 < stats['estimated_memory'] < stats['memory_budget'])
+
+  def testConcurrentPingsAndLabels(self):
+    """Tests that no label or event is lost or taken twice under contention.
+
+    For each host, a setter hands out labels one at a time, as with
+    /setnextupdate, while several threads ping as that host, each ping logging
+    an event and taking any pending label.
+    """
+    num_hosts = 8
+    num_labels = 200
+    pings_per_thread = 500
+    threads_per_host = 4
+    table = host_info.HostInfoTable(log_size=threads_per_host *
+                                    pings_per_thread, num_shards=4)
+    taken = dict(('host%d' % i, []) for i in range(num_hosts))
+    taken_lock = threading.Lock()
+
+    def _Ping(host_id):
+      for i in range(pings_per_thread):
+        table.UpdateHost(host_id, attrs={'last_known_version': str(i)},
+                         log_entry={'event_type': 3})
+        label = table.PopAttr(host_id, 'forced_update_label')
+        if label is not None:
+          with taken_lock:
+            taken[host_id].append(label)
+
+    def _SetLabels(host_id):
+      for label in range(num_labels):
+        table.SetAttr(host_id, 'forced_update_label', label)
+        # Wait for the label to be taken before handing out the next one,
+        # taking it here once the pingers are done.
+        while 'forced_update_label' in table.GetHostInfo(host_id).attrs:
+          if not any(thread.is_alive() for thread in pingers[host_id]):
+            label = table.PopAttr(host_id, 'forced_update_label')
+            if label is not None:
+              with taken_lock:
+                taken[host_id].append(label)
+
+    pingers = dict((host_id, [threading.Thread(target=_Ping, args=(host_id,))
+                              for _ in range(threads_per_host)])
+                   for host_id in taken)
+    setters = [threading.Thread(target=_SetLabels, args=(host_id,))
+               for host_id in taken]
+    threads = setters + sum(pingers.values(), [])
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for host_id, labels in taken.iteritems():
+      self.assertEqual(len(labels), num_labels)
+      self.assertEqual(labels, range(num_labels))
+      self.assertEqual(len(table.GetHostInfo(host_id).log),
+                       threads_per_host * pings_per_thread)
+    self.assertEqual(sorted(table.GetHostIds()), sorted(taken))
+
+  def testBatchOperations(self):
+    table = host_info.HostInfoTable(log_size=0)
+    table.SetAttr('1.1.1.1', 'last_known_version', '1.0')
+    table.SetAttrBatch('forced_update_label', {'1.1.1.1': 'a', '2.2.2.2': 'b'})
+    self.assertEqual(
+        table.GetAttrsBatch(['1.1.1.1', '2.2.2.2', '3.3.3.3']),
+        {'1.1.1.1': {'last_known_version': '1.0', 'forced_update_label': 'a'},
+         '2.2.2.2': {'forced_update_label': 'b'},
+         '3.3.3.3': None})
+
+  def testBatchKeepsItsHosts(self):
+    """Tests that a batch larger than the table doesn't expire itself."""
+    table = host_info.HostInfoTable(log_size=0, num_shards=1)
+    table.max_hosts = 2
+    table.GetInitHostInfo('1.1.1.1')
+    labels = {'2.2.2.2': 'a', '3.3.3.3': 'b', '4.4.4.4': 'c'}
+    table.SetAttrBatch('forced_update_label', labels)
+    self.assertEqual(sorted(table.GetHostIds()), sorted(labels))
+
+    # The next host added trims the table back.
+    table.GetInitHostInfo('5.5.5.5')
+    self.assertEqual(len(table.GetHostIds()), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,241 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent journal of host table changes.
+
+Changes to a host_info.HostInfoTable (attributes set or popped, events logged)
+are queued by the request threads and appended to a journal file in batches by
+a background writer, so that request handling never waits for disk I/O. Every
+so often the writer compacts the journal into a snapshot of the table. On
+startup the snapshot and the journal tail are replayed to rebuild the table.
+
+Both files are sequences of marshal records, which load considerably faster
+than JSON or pickle. They are a local cache tied to the Python version that
+wrote them; unreadable files are discarded.
+"""
+
+import Queue
+import collections
+import marshal
+import os
+import threading
+
+import host_info
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOST_JOURNAL', message, *args)
+
+
+JOURNAL_FILE = 'hosts.journal'
+SNAPSHOT_FILE = 'hosts.snapshot'
+
+# Seconds the writer waits for more records before flushing a batch.
+_FLUSH_INTERVAL = 1.0
+
+# Number of journal records after which the journal is compacted.
+_COMPACT_RECORDS = 100000
+
+# Sentinel record asking the writer to flush and exit.
+_STOP = object()
+
+
+class HostJournal(object):
+  """An append-only, periodically compacted journal of host table changes.
+
+  Usage:
+
+    journal = HostJournal(journal_dir, log_size, max_hosts)
+    table.Load(journal.Replay())
+    table.journal = journal
+    journal.Start()
+    ...
+    journal.Close()
+  """
+
+  def __init__(self, journal_dir, log_size, max_hosts,
+               flush_interval=_FLUSH_INTERVAL,
+               compact_records=_COMPACT_RECORDS):
+    """Args:
+      journal_dir: directory holding the journal and snapshot files.
+      log_size: number of events kept per host, as in the host table.
+      max_hosts: number of most recently active hosts kept on compaction.
+      flush_interval: seconds to batch records for before writing them.
+      compact_records: number of journal records that trigger compaction.
+    """
+    self._journal_path = os.path.join(journal_dir, JOURNAL_FILE)
+    self._snapshot_path = os.path.join(journal_dir, SNAPSHOT_FILE)
+    self._log_size = log_size
+    self._max_hosts = max_hosts
+    self._flush_interval = flush_interval
+    self._compact_records = compact_records
+    self._queue = Queue.Queue()
+    self._journal_file = None
+    self._num_records = 0
+    self._writer = None
+
+    if not os.path.isdir(journal_dir):
+      os.makedirs(journal_dir)
+
+  def Record(self, kind, host_id, payload):
+    """Queues a change for writing; never blocks on I/O.
+
+    Args:
+      kind: one of the host_info.JOURNAL_* constants.
+      host_id: id of the changed host.
+      payload: attributes set, attribute popped or packed log entry.
+    """
+    self._queue.put((kind, host_id, payload))
+
+  @staticmethod
+  def _ReadRecords(path):
+    """Yields marshal records from a file until its end or a torn record.
+
+    A record torn by a crash mid-write can only be the last one; it and
+    anything after it are dropped by the next compaction.
+    """
+    with open(path, 'rb') as f:
+      while True:
+        try:
+          yield marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+          return
+
+  def _NewHost(self):
+    return [{}, collections.deque(maxlen=self._log_size)]
+
+  def _Apply(self, hosts, record):
+    """Applies a journal record to an ordered dictionary of hosts."""
+    kind, host_id, payload = record
+    if kind == host_info.JOURNAL_POP_ATTR:
+      # Like the table, popping an attribute doesn't count as host activity.
+      if host_id in hosts:
+        hosts[host_id][0].pop(payload, None)
+      return
+
+    host = hosts.pop(host_id, None) or self._NewHost()
+    hosts[host_id] = host
+    if kind == host_info.JOURNAL_SET_ATTRS:
+      host[0].update(payload)
+    elif kind == host_info.JOURNAL_LOG_ENTRY:
+      host[1].append(payload)
+
+  def _LoadState(self):
+    """Replays the snapshot and journal files.
+
+    Returns:
+      An ordered dictionary mapping host ids to [attrs, log] pairs, least
+      recently active first.
+    """
+    hosts = collections.OrderedDict()
+    if os.path.exists(self._snapshot_path):
+      try:
+        with open(self._snapshot_path, 'rb') as f:
+          for host_id, attrs, log in marshal.load(f):
+            host = self._NewHost()
+            host[0].update(attrs)
+            host[1].extend(log)
+            hosts[host_id] = host
+      except (EOFError, ValueError, TypeError), e:
+        _Log('Ignoring unreadable snapshot %s: %s', self._snapshot_path, e)
+        hosts.clear()
+
+    if os.path.exists(self._journal_path):
+      for record in self._ReadRecords(self._journal_path):
+        self._Apply(hosts, record)
+
+    while len(hosts) > self._max_hosts:
+      hosts.popitem(last=False)
+    return hosts
+
+  def _WriteSnapshot(self, hosts):
+    """Atomically replaces the snapshot, then empties the journal."""
+    tmp_path = self._snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      marshal.dump([(host_id, host[0], list(host[1]))
+                    for host_id, host in hosts.iteritems()], f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_path, self._snapshot_path)
+
+    if self._journal_file:
+      self._journal_file.truncate(0)
+      self._journal_file.seek(0)
+    else:
+      open(self._journal_path, 'wb').close()
+    self._num_records = 0
+
+  def _Compact(self):
+    """Folds the journal into the snapshot."""
+    hosts = self._LoadState()
+    self._WriteSnapshot(hosts)
+    _Log('Compacted host journal into a snapshot of %d hosts', len(hosts))
+
+  def Replay(self):
+    """Replays the snapshot and journal, and compacts them.
+
+    Must be called before Start().
+
+    Returns:
+      A list of (host_id, attrs, packed log entries) tuples, least recently
+      active host first, as taken by host_info.HostInfoTable.Load().
+    """
+    hosts = self._LoadState()
+    self._WriteSnapshot(hosts)
+    _Log('Replayed %d hosts from the host journal', len(hosts))
+    return [(host_id, host[0], list(host[1]))
+            for host_id, host in hosts.iteritems()]
+
+  def _WriteBatch(self, batch):
+    for record in batch:
+      marshal.dump(record, self._journal_file)
+    self._journal_file.flush()
+    os.fsync(self._journal_file.fileno())
+    self._num_records += len(batch)
+
+  def _WriterLoop(self):
+    """Writes queued records in batches until asked to stop."""
+    stop = False
+    while not stop:
+      batch = [self._queue.get()]
+      # Gather everything that arrives within the flush interval.
+      try:
+        while True:
+          batch.append(self._queue.get(timeout=self._flush_interval))
+          if batch[-1] is _STOP:
+            break
+      except Queue.Empty:
+        pass
+
+      if batch[-1] is _STOP:
+        batch.pop()
+        stop = True
+
+      try:
+        if batch:
+          self._WriteBatch(batch)
+        if self._num_records >= self._compact_records:
+          self._Compact()
+      except (IOError, OSError), e:
+        _Log('Failed to write host journal: %s', e)
+
+  def Start(self):
+    """Starts the background writer."""
+    self._journal_file = open(self._journal_path, 'ab')
+    self._writer = threading.Thread(target=self._WriterLoop,
+                                    name='HostJournalWriter')
+    self._writer.daemon = True
+    self._writer.start()
+
+  def Close(self):
+    """Flushes pending records and stops the background writer."""
+    if self._writer:
+      self._queue.put(_STOP)
+      self._writer.join()
+      self._writer = None
+    if self._journal_file:
+      self._journal_file.close()
+      self._journal_file = None
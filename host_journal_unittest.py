@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_journal module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import host_info
+import host_journal
+
+
+class HostJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self._journal_dir = tempfile.mkdtemp('host_journal_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self._journal_dir)
+
+  def _NewJournal(self, max_hosts=10, **kwargs):
+    return host_journal.HostJournal(self._journal_dir, 5, max_hosts,
+                                    flush_interval=0.01, **kwargs)
+
+  def _NewTable(self, journal):
+    table = host_info.HostInfoTable(log_size=5)
+    table.Load(journal.Replay())
+    table.journal = journal
+    journal.Start()
+    return table
+
+  def testReplayRestoresTable(self):
+    """Tests that attributes and logs survive a restart."""
+    journal = self._NewJournal()
+    table = self._NewTable(journal)
+    table.UpdateHost('1.2.3.4', attrs={'last_known_version': '1.0.0'},
+                     log_entry={'event_type': 3, 'version': '1.0.0'})
+    table.SetAttr('1.2.3.4', 'forced_update_label', 'label')
+    table.UpdateHost('5.6.7.8', attrs={'last_known_version': '2.0.0'})
+    self.assertEqual(table.PopAttr('1.2.3.4', 'forced_update_label'), 'label')
+    journal.Close()
+
+    journal = self._NewJournal()
+    restored = self._NewTable(journal)
+    journal.Close()
+    self.assertEqual(sorted(restored.GetHostIds()), ['1.2.3.4', '5.6.7.8'])
+    host = restored.GetHostInfo('1.2.3.4')
+    self.assertEqual(host.attrs, {'last_known_version': '1.0.0'})
+    self.assertEqual(list(host.log),
+                     list(table.GetHostInfo('1.2.3.4').log))
+
+  def testCompaction(self):
+    """Tests that compaction keeps the most recently active hosts."""
+    journal = self._NewJournal(max_hosts=2, compact_records=3)
+    table = self._NewTable(journal)
+    for i in range(4):
+      table.SetAttr('host%d' % i, 'last_known_version', str(i))
+    journal.Close()
+
+    journal = self._NewJournal(max_hosts=2)
+    self.assertEqual(journal.Replay(),
+                     [('host2', {'last_known_version': '2'}, []),
+                      ('host3', {'last_known_version': '3'}, [])])
+    self.assertEqual(os.path.getsize(os.path.join(
+        self._journal_dir, host_journal.JOURNAL_FILE)), 0)
+
+  def testTornRecordIsDropped(self):
+    """Tests that a record cut short by a crash doesn't break replay."""
+    journal = self._NewJournal()
+    table = self._NewTable(journal)
+    table.SetAttr('1.2.3.4', 'last_known_version', '1.0.0')
+    journal.Close()
+    with open(os.path.join(self._journal_dir,
+                           host_journal.JOURNAL_FILE), 'ab') as f:
+      f.write('(\x03\x00')
+
+    journal = self._NewJournal()
+    self.assertEqual(journal.Replay(),
+                     [('1.2.3.4', {'last_known_version': '1.0.0'}, [])])
+
+
+if __name__ == '__main__':
+  unittest.main()
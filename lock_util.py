@@ -0,0 +1,227 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Shared/exclusive locks for devserver resources.
+
+Contention between threads of a single devserver process is resolved in memory,
+while an fcntl.flock() on a lock file keeps separate processes (e.g. several
+devservers sharing a static dir) from stepping on each other.
+
+The holder of a lock may remove its lock file before releasing it. A process
+that opened the file earlier and then gets the flock notices that the file is
+gone, and locks the file at the path instead.
+"""
+
+import errno
+import fcntl
+import os
+import threading
+import time
+
+
+# Interval between non-blocking flock() attempts while waiting on another
+# process.
+_FLOCK_POLL_INTERVAL = 0.05
+
+
+class LockUtilError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+class LockTimeout(LockUtilError):
+  """Raised when a lock could not be acquired within the given timeout."""
+  pass
+
+
+class _LockEntry(object):
+  """State of a single lock file, guarded by the owning manager's mutex."""
+
+  def __init__(self, mutex):
+    self.cond = threading.Condition(mutex)
+    self.fd = None
+    self.readers = 0
+    self.writer = False
+    self.pending = False
+    self.waiters = 0
+
+  def CanAcquire(self, shared):
+    """Returns True if the lock can be taken in the given mode right now."""
+    if self.pending or self.writer:
+      return False
+    return shared or not self.readers
+
+  def IsIdle(self):
+    return not (self.readers or self.writer or self.pending or self.waiters)
+
+
+class LockManager(object):
+  """Manages shared/exclusive locks keyed by lock file path.
+
+  Locks are not owned by a thread: a lock acquired in one thread may be
+  released in another, which is what the background staging code relies on.
+  Usage:
+
+    manager = LockManager()
+    manager.Acquire('/path/to/lockfile', shared=True, timeout=10)
+    try:
+      # Critical section.
+    finally:
+      manager.Release('/path/to/lockfile')
+  """
+
+  def __init__(self):
+    self._mutex = threading.Lock()
+    self._entries = {}
+
+  def _GetEntry(self, path):
+    entry = self._entries.get(path)
+    if not entry:
+      entry = _LockEntry(self._mutex)
+      self._entries[path] = entry
+    return entry
+
+  @staticmethod
+  def _FLock(path, shared, deadline):
+    """Opens |path| and flock()s it, polling until |deadline|.
+
+    Returns:
+      The file descriptor holding the lock.
+    Raises:
+      LockTimeout: if another process holds the lock past |deadline|.
+    """
+    flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+    while True:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+      try:
+        while True:
+          try:
+            fcntl.flock(fd, flags)
+            break
+          except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+              raise
+          if deadline is not None and time.time() >= deadline:
+            raise LockTimeout('Lock %s is held by another process' % path)
+          time.sleep(_FLOCK_POLL_INTERVAL)
+        if LockManager._IsFileAt(fd, path):
+          return fd
+      except:
+        os.close(fd)
+        raise
+      # The previous holder removed the lock file: lock its replacement.
+      os.close(fd)
+
+  @staticmethod
+  def _IsFileAt(fd, path):
+    """Returns True if |fd| is open on the file that |path| names."""
+    try:
+      path_stat = os.stat(path)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return False
+      raise
+    fd_stat = os.fstat(fd)
+    return (fd_stat.st_dev, fd_stat.st_ino) == (path_stat.st_dev,
+                                                path_stat.st_ino)
+
+  def Acquire(self, path, shared=False, timeout=None):
+    """Acquires the lock on |path|.
+
+    Args:
+      path:    Path of the lock file; it is created if missing.
+      shared:  Take a shared (reader) lock instead of an exclusive one.
+      timeout: Seconds to wait for the lock; None waits forever and 0 fails
+               immediately if the lock is taken.
+
+    Raises:
+      LockTimeout: If the lock could not be acquired in time.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with self._mutex:
+      entry = self._GetEntry(path)
+      entry.waiters += 1
+      try:
+        while not entry.CanAcquire(shared):
+          remaining = None if deadline is None else deadline - time.time()
+          if remaining is not None and remaining <= 0:
+            raise LockTimeout('Lock %s is held' % path)
+          entry.cond.wait(remaining)
+      finally:
+        entry.waiters -= 1
+
+      # Other readers in this process already hold the shared flock.
+      if shared and entry.readers:
+        entry.readers += 1
+        return
+
+      entry.pending = True
+
+    # Wait on other processes without blocking threads interested in
+    # unrelated locks.
+    fd = None
+    try:
+      fd = self._FLock(path, shared, deadline)
+    finally:
+      with self._mutex:
+        entry.pending = False
+        if fd is None:
+          if entry.IsIdle():
+            del self._entries[path]
+          entry.cond.notify_all()
+        else:
+          entry.fd = fd
+          if shared:
+            entry.readers += 1
+          else:
+            entry.writer = True
+
+  def Release(self, path):
+    """Releases one hold on the lock for |path|.
+
+    Raises:
+      LockUtilError: If the lock is not held.
+    """
+    with self._mutex:
+      entry = self._entries.get(path)
+      if not entry or not (entry.writer or entry.readers):
+        raise LockUtilError('Lock %s is not held' % path)
+
+      if entry.writer:
+        entry.writer = False
+      else:
+        entry.readers -= 1
+
+      if not entry.readers:
+        fcntl.flock(entry.fd, fcntl.LOCK_UN)
+        os.close(entry.fd)
+        entry.fd = None
+        if entry.IsIdle():
+          del self._entries[path]
+        entry.cond.notify_all()
+
+  def IsLocked(self, path):
+    """Returns True if this process holds the lock for |path| in any mode."""
+    with self._mutex:
+      entry = self._entries.get(path)
+      return bool(entry and (entry.writer or entry.readers))
+
+
+# Process-wide lock manager.
+_manager = LockManager()
+
+
+def Acquire(path, shared=False, timeout=None):
+  """Acquires the lock on |path| through the process-wide manager."""
+  _manager.Acquire(path, shared=shared, timeout=timeout)
+
+
+def Release(path):
+  """Releases the lock on |path| through the process-wide manager."""
+  _manager.Release(path)
+
+
+def IsLocked(path):
+  """Returns True if this process holds the lock on |path|."""
+  return _manager.IsLocked(path)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for lock_util module."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import lock_util
+
+
+# Holds an exclusive flock on argv[1] until stdin is closed.
+_HOLD_LOCK_SCRIPT = """
+import fcntl, sys
+f = open(sys.argv[1], 'w')
+fcntl.flock(f, fcntl.LOCK_EX)
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+
+class LockUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self._work_dir = tempfile.mkdtemp('lock_util_unittest')
+    self._lock_path = os.path.join(self._work_dir, 'lock')
+    self._manager = lock_util.LockManager()
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def testExclusiveLockExcludes(self):
+    """Tests that a held exclusive lock can't be taken in either mode."""
+    self._manager.Acquire(self._lock_path)
+    self.assertTrue(self._manager.IsLocked(self._lock_path))
+    self.assertRaises(lock_util.LockTimeout, self._manager.Acquire,
+                      self._lock_path, timeout=0)
+    self.assertRaises(lock_util.LockTimeout, self._manager.Acquire,
+                      self._lock_path, shared=True, timeout=0)
+    self._manager.Release(self._lock_path)
+    self.assertFalse(self._manager.IsLocked(self._lock_path))
+
+  def testSharedLocks(self):
+    """Tests that readers share the lock but keep writers out."""
+    self._manager.Acquire(self._lock_path, shared=True)
+    self._manager.Acquire(self._lock_path, shared=True, timeout=0)
+    self.assertRaises(lock_util.LockTimeout, self._manager.Acquire,
+                      self._lock_path, timeout=0)
+    self._manager.Release(self._lock_path)
+    self.assertRaises(lock_util.LockTimeout, self._manager.Acquire,
+                      self._lock_path, timeout=0)
+    self._manager.Release(self._lock_path)
+    self._manager.Acquire(self._lock_path, timeout=0)
+    self._manager.Release(self._lock_path)
+
+  def testReleaseUnheldLock(self):
+    self.assertRaises(lock_util.LockUtilError, self._manager.Release,
+                      self._lock_path)
+
+  def testBlockingAcquireWaitsForRelease(self):
+    """Tests that a blocked writer proceeds once released by another thread."""
+    self._manager.Acquire(self._lock_path, shared=True)
+    acquired = threading.Event()
+
+    def _Writer():
+      self._manager.Acquire(self._lock_path, timeout=10)
+      acquired.set()
+
+    writer = threading.Thread(target=_Writer)
+    writer.start()
+    time.sleep(0.1)
+    self.assertFalse(acquired.is_set())
+    self._manager.Release(self._lock_path)
+    writer.join()
+    self.assertTrue(acquired.is_set())
+    self._manager.Release(self._lock_path)
+
+  def testLockFileRemovedByHolder(self):
+    """Tests that a waiter locks the file replacing a removed lock file."""
+    # Managers don't share state, so they contend through flock() alone, as
+    # separate processes do.
+    holder = lock_util.LockManager()
+    holder.Acquire(self._lock_path)
+    acquired = threading.Event()
+
+    def _Waiter():
+      self._manager.Acquire(self._lock_path, timeout=10)
+      acquired.set()
+
+    waiter = threading.Thread(target=_Waiter)
+    waiter.start()
+    # Let the waiter open the lock file and poll it.
+    time.sleep(0.2)
+    os.remove(self._lock_path)
+    holder.Release(self._lock_path)
+    waiter.join()
+    self.assertTrue(acquired.is_set())
+    self.assertTrue(os.path.exists(self._lock_path))
+    self.assertRaises(lock_util.LockTimeout, lock_util.LockManager().Acquire,
+                      self._lock_path, timeout=0)
+    self._manager.Release(self._lock_path)
+
+  def testLockHeldByOtherProcess(self):
+    """Tests that flock() keeps us out while another process holds the lock."""
+    holder = subprocess.Popen(
+        [sys.executable, '-c', _HOLD_LOCK_SCRIPT, self._lock_path],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+      self.assertEqual(holder.stdout.readline(), 'locked\n')
+      self.assertRaises(lock_util.LockTimeout, self._manager.Acquire,
+                        self._lock_path, shared=True, timeout=0.2)
+      self.assertFalse(self._manager.IsLocked(self._lock_path))
+    finally:
+      holder.stdin.close()
+      holder.wait()
+
+    self._manager.Acquire(self._lock_path, timeout=10)
+    self._manager.Release(self._lock_path)
+
+
+if __name__ == '__main__':
+  unittest.main()
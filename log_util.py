@@ -2,24 +2,236 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Logging via CherryPy."""
+"""Logging via CherryPy.
 
+Logging a message only checks its level and queues a record; a background
+thread formats queued records and writes them to CherryPy's error log, so
+threads serving requests neither format messages that are filtered out nor
+wait for log I/O. Usage:
+
+  log_util.LogWithTag('TAG', 'Staged %s in %.1fs', build, seconds)
+  log_util.LogWithTag('TAG', 'Using %s', url, level=log_util.DEBUG)
+
+Records are written as text, like cherrypy.log() writes them, or as one JSON
+object per line; see Configure().
+"""
+
+import Queue
+import atexit
+import datetime
+import json
+import logging
+import os
 import re
+import threading
+import time
 
 import cherrypy
 
 
+# Levels of log records, as in the logging module.
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# Records queued for the writer beyond which new ones are dropped, rather than
+# letting a stalled log grow memory without bound.
+_MAX_QUEUED_RECORDS = 10000
+
+_MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+                'Oct', 'Nov', 'Dec')
+
+# Records below this level are dropped unformatted.
+_level = INFO
+_json_format = False
+_asynchronous = True
+
+# The writer of the current process, started on first use; a forked child
+# starts its own.
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class _Record(object):
+  """A message to log, with its arguments not yet formatted in."""
+  __slots__ = ('created', 'level', 'tag', 'message', 'args', 'fields',
+               'thread_name')
+
+  def __init__(self, level, tag, message, args, fields):
+    self.created = time.time()
+    self.level = level
+    self.tag = tag
+    self.message = message
+    self.args = args
+    self.fields = fields
+    self.thread_name = threading.current_thread().name
+
+  def GetMessage(self):
+    """Returns the message with its arguments formatted in."""
+    if not self.args:
+      return self.message
+    try:
+      return self.message % self.args
+    except (TypeError, ValueError), e:
+      return '%s %r (bad log arguments: %s)' % (self.message, self.args, e)
+
+
+def _FormatTime(created):
+  """Formats a time like cherrypy.log() does (Apache Common Log Format)."""
+  now = datetime.datetime.fromtimestamp(created)
+  return ('[%02d/%s/%04d:%02d:%02d:%02d]' %
+          (now.day, _MONTH_NAMES[now.month - 1], now.year, now.hour,
+           now.minute, now.second))
+
+
+def _Format(record):
+  """Returns the line to log for a record."""
+  if _json_format:
+    entry = {
+        'time': record.created,
+        'level': logging.getLevelName(record.level),
+        'tag': record.tag,
+        'message': record.GetMessage(),
+        'pid': os.getpid(),
+        'thread': record.thread_name,
+    }
+    entry.update(record.fields)
+    return json.dumps(entry, default=str, sort_keys=True)
+
+  line = ' '.join((_FormatTime(record.created), record.tag,
+                   record.GetMessage()))
+  if record.fields:
+    line += ' ' + ' '.join('%s=%s' % item
+                           for item in sorted(record.fields.iteritems()))
+  return line
+
+
+def _Write(record):
+  cherrypy.log.error_log.log(record.level, _Format(record))
+
+
+class _Writer(object):
+  """Formats and writes queued records on a background thread."""
+
+  def __init__(self):
+    self.pid = os.getpid()
+    self._queue = Queue.Queue(_MAX_QUEUED_RECORDS)
+    self._num_dropped = 0
+    self._thread = threading.Thread(target=self._WriteLoop, name='log_writer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Put(self, record):
+    try:
+      self._queue.put_nowait(record)
+    except Queue.Full:
+      self._num_dropped += 1
+
+  def Flush(self):
+    """Waits until the records queued so far are written."""
+    done = threading.Event()
+    self._queue.put(done)
+    # Waiting with a timeout keeps the wait interruptible.
+    while not done.wait(60):
+      pass
+
+  def _WriteLoop(self):
+    while True:
+      record = self._queue.get()
+      if not isinstance(record, _Record):
+        # An event set by Flush().
+        record.set()
+        continue
+      try:
+        if self._num_dropped:
+          num_dropped, self._num_dropped = self._num_dropped, 0
+          _Write(_Record(WARNING, 'LOG', 'Dropped %d log records',
+                         (num_dropped,), {}))
+        _Write(record)
+      # Nothing reports failures of the log better than the log, so keep
+      # the thread alive whatever happens.
+      # pylint: disable=W0702
+      except:
+        pass
+
+
+def _GetWriter():
+  """Returns the writer of the current process, starting it if needed."""
+  global _writer
+  writer = _writer
+  if writer is None or writer.pid != os.getpid():
+    with _writer_lock:
+      writer = _writer
+      if writer is None or writer.pid != os.getpid():
+        writer = _writer = _Writer()
+  return writer
+
+
+def Configure(level=INFO, json_format=False, asynchronous=True):
+  """Sets how records are logged.
+
+  Args:
+    level: records below this level are dropped. CherryPy's error log is set
+           to the same level, as it drops records below INFO by default.
+    json_format: if True, write records as JSON objects instead of text.
+    asynchronous: if True, write records on a background thread; otherwise,
+                  write them before returning from each log call.
+  """
+  # pylint: disable=W0603
+  global _level, _json_format, _asynchronous
+  if asynchronous != _asynchronous:
+    Flush()
+  _level = level
+  _json_format = json_format
+  _asynchronous = asynchronous
+  cherrypy.log.error_log.setLevel(level)
+
+
+def Flush():
+  """Waits until the records logged so far are written.
+
+  Call this before forking, so that the child doesn't inherit a log handler
+  locked by the writer.
+  """
+  writer = _writer
+  if writer is not None and writer.pid == os.getpid():
+    writer.Flush()
+
+
+atexit.register(Flush)
+
+
 class Loggable(object):
   """Provides a log method, with automatic log tag generation."""
   _CAMELCASE_RE = re.compile('(?<=.)([A-Z])')
+  # Log tags by class, computed on first use.
+  _log_tags = {}
+
+  def _Log(self, message, *args, **kwargs):
+    cls = self.__class__
+    tag = Loggable._log_tags.get(cls)
+    if tag is None:
+      tag = self._CAMELCASE_RE.sub(r'_\1', cls.__name__).upper()
+      Loggable._log_tags[cls] = tag
+    return LogWithTag(tag, message, *args, **kwargs)
 
-  def _Log(self, message, *args):
-    return LogWithTag(
-        self._CAMELCASE_RE.sub(r'_\1', self.__class__.__name__).upper(),
-        message, *args)
 
+def LogWithTag(tag, message, *args, **kwargs):
+  """Logs a message, formatting args into it only if it is written.
 
-def LogWithTag(tag, message, *args):
-  # CherryPy log doesn't seem to take any optional args, so we just handle
-  # args by formatting them into message.
-  return cherrypy.log(message % args, context=tag)
+  Args:
+    tag: identifies the component logging, e.g. its module.
+    message: message, with printf-style conversions for args.
+    args: arguments of the message.
+    kwargs: 'level', the level of the record (INFO by default); any other
+            keyword arguments are written with the record as fields.
+  """
+  level = kwargs.pop('level', INFO)
+  if level < _level:
+    return
+  record = _Record(level, tag, message, args, kwargs)
+  if _asynchronous:
+    _GetWriter().Put(record)
+  else:
+    _Write(record)
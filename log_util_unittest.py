@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for log_util module."""
+
+import json
+import logging
+import unittest
+
+import cherrypy
+
+import log_util
+
+
+class _ListHandler(logging.Handler):
+  """A log handler keeping the messages it is given."""
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class _UnformattableArg(object):
+  """An argument failing the test if it is ever formatted."""
+
+  def __str__(self):
+    raise AssertionError('Formatted a filtered log message')
+
+
+class FooBarBaz(log_util.Loggable):
+  """A class logging with a generated tag."""
+
+  def Hello(self):
+    self._Log('Hello %s', 'world')
+
+
+class LogUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self._handler = _ListHandler()
+    self._old_level = cherrypy.log.error_log.level
+    cherrypy.log.error_log.addHandler(self._handler)
+
+  def tearDown(self):
+    log_util.Flush()
+    log_util.Configure()
+    cherrypy.log.error_log.removeHandler(self._handler)
+    cherrypy.log.error_log.setLevel(self._old_level)
+
+  def testLogWithTag(self):
+    log_util.LogWithTag('TAG', 'Staged %s in %d seconds', 'R1-1.0.0', 3)
+    log_util.Flush()
+    self.assertEqual(len(self._handler.messages), 1)
+    self.assertTrue(
+        self._handler.messages[0].endswith(' TAG Staged R1-1.0.0 in 3 seconds'))
+
+  def testLevelFilteredBeforeFormatting(self):
+    log_util.Configure(level=log_util.WARNING)
+    log_util.LogWithTag('TAG', 'Not logged %s', _UnformattableArg())
+    log_util.LogWithTag('TAG', 'Logged', level=log_util.ERROR)
+    log_util.Flush()
+    self.assertEqual(len(self._handler.messages), 1)
+    self.assertTrue(self._handler.messages[0].endswith(' TAG Logged'))
+
+  def testDebugLevel(self):
+    """Tests that debug records reach CherryPy's error log when asked for."""
+    log_util.Configure(asynchronous=False)
+    log_util.LogWithTag('TAG', 'Not logged', level=log_util.DEBUG)
+    log_util.Configure(level=log_util.DEBUG, asynchronous=False)
+    log_util.LogWithTag('TAG', 'Logged', level=log_util.DEBUG)
+    self.assertEqual(len(self._handler.messages), 1)
+    self.assertTrue(self._handler.messages[0].endswith(' TAG Logged'))
+
+  def testJson(self):
+    log_util.Configure(json_format=True, asynchronous=False)
+    log_util.LogWithTag('TAG', 'Served %s', 'update.gz', ip='127.0.0.1')
+    entry = json.loads(self._handler.messages[0])
+    self.assertEqual(entry['tag'], 'TAG')
+    self.assertEqual(entry['level'], 'INFO')
+    self.assertEqual(entry['message'], 'Served update.gz')
+    self.assertEqual(entry['ip'], '127.0.0.1')
+
+  def testBadArguments(self):
+    """Tests that a message not matching its arguments is still logged."""
+    log_util.Configure(asynchronous=False)
+    log_util.LogWithTag('TAG', 'Two %s %s', 'one')
+    self.assertTrue('bad log arguments' in self._handler.messages[0])
+
+  def testLoggable(self):
+    log_util.Configure(asynchronous=False)
+    FooBarBaz().Hello()
+    FooBarBaz().Hello()
+    self.assertTrue(self._handler.messages[1].endswith(
+        ' FOO_BAR_BAZ Hello world'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Counters, gauges and histograms of devserver activity, for /metrics.
+
+Metrics are declared once at module level and updated on hot paths, so
+updating one is cheap: each metric's values are spread across stripes by
+thread, each guarded by its own lock, so that concurrent request threads
+rarely contend. Render() merges the stripes into the Prometheus text
+exposition format.
+
+Usage:
+
+  _PINGS = metrics.Counter('devserver_pings_total', 'Pings handled.',
+                           ('result',))
+  _PING_SECONDS = metrics.Histogram('devserver_ping_seconds',
+                                    'Time taken to handle a ping.')
+  ...
+  with _PING_SECONDS.Time():
+    ...
+  _PINGS.Inc(('ok',))
+
+Each process has its own metrics; with several worker processes, each
+reports on the requests it served.
+"""
+
+import bisect
+import collections
+import contextlib
+import thread
+import threading
+import time
+
+
+# Number of independently locked stripes of each metric.
+_NUM_STRIPES = 16
+
+# Default upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300,
+                   600, 1800)
+
+# Registered metrics by name, in order of registration.
+_registry = collections.OrderedDict()
+_registry_lock = threading.Lock()
+
+
+class MetricsError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def _FormatValue(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _EscapeLabelValue(value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+          .replace('"', r'\"'))
+
+
+def _FormatLabels(names, values):
+  if not names:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _EscapeLabelValue(value))
+                           for name, value in zip(names, values))
+
+
+class _Metric(object):
+  """A metric with values per combination of label values.
+
+  Members:
+    name: name of the metric.
+    help: description of the metric.
+    labels: names of the labels distinguishing values.
+  """
+  _TYPE = None
+
+  def __init__(self, name, help_text, labels=()):
+    self.name = name
+    self.help = help_text
+    self.labels = tuple(labels)
+    self._stripes = [(threading.Lock(), {}) for _ in range(_NUM_STRIPES)]
+    with _registry_lock:
+      if name in _registry:
+        raise MetricsError('Metric %s already registered' % name)
+      _registry[name] = self
+
+  def _GetStripe(self):
+    return self._stripes[thread.get_ident() % _NUM_STRIPES]
+
+  def _NewValue(self):
+    raise NotImplementedError()
+
+  def _MergeValue(self, total, value):
+    raise NotImplementedError()
+
+  def Collect(self):
+    """Returns a dictionary mapping tuples of label values to values."""
+    merged = {}
+    for lock, values in self._stripes:
+      with lock:
+        for label_values, value in values.iteritems():
+          total = merged.get(label_values)
+          if total is None:
+            total = merged[label_values] = self._NewValue()
+          merged[label_values] = self._MergeValue(total, value)
+    return merged
+
+  def _RenderSamples(self, label_values, value):
+    raise NotImplementedError()
+
+  def Render(self):
+    """Returns the metric in the Prometheus text format, as a list of lines."""
+    lines = ['# HELP %s %s' % (self.name, self.help),
+             '# TYPE %s %s' % (self.name, self._TYPE)]
+    for label_values, value in sorted(self.Collect().iteritems()):
+      lines.extend(self._RenderSamples(label_values, value))
+    return lines
+
+
+class Counter(_Metric):
+  """A monotonically increasing count."""
+  _TYPE = 'counter'
+
+  def Inc(self, label_values=(), amount=1):
+    """Adds to the count of the given label values."""
+    lock, values = self._GetStripe()
+    with lock:
+      values[label_values] = values.get(label_values, 0) + amount
+
+  def _NewValue(self):
+    return 0
+
+  def _MergeValue(self, total, value):
+    return total + value
+
+  def _RenderSamples(self, label_values, value):
+    return ['%s%s %s' % (self.name, _FormatLabels(self.labels, label_values),
+                         _FormatValue(value))]
+
+
+class Gauge(Counter):
+  """A value going up and down, such as the number of calls in progress."""
+  _TYPE = 'gauge'
+
+  def Dec(self, label_values=(), amount=1):
+    """Subtracts from the value of the given label values."""
+    self.Inc(label_values, -amount)
+
+
+class Histogram(_Metric):
+  """A distribution of observed values, such as latencies, in buckets.
+
+  Members:
+    buckets: sorted upper bounds of the buckets; larger values fall into an
+             implicit +Inf bucket.
+  """
+  _TYPE = 'histogram'
+
+  def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    super(Histogram, self).__init__(name, help_text, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def Observe(self, value, label_values=()):
+    """Records a value for the given label values."""
+    index = bisect.bisect_left(self.buckets, value)
+    lock, values = self._GetStripe()
+    with lock:
+      # Per-bucket counts, then the sum and count of values.
+      counts = values.get(label_values)
+      if counts is None:
+        counts = values[label_values] = self._NewValue()
+      counts[index] += 1
+      counts[-2] += value
+      counts[-1] += 1
+
+  @contextlib.contextmanager
+  def Time(self, label_values=()):
+    """Observes the seconds taken by a block, even if it raises."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.Observe(time.time() - start, label_values)
+
+  def _NewValue(self):
+    return [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+  def _MergeValue(self, total, value):
+    for index, count in enumerate(value):
+      total[index] += count
+    return total
+
+  def _RenderSamples(self, label_values, value):
+    label_names = self.labels + ('le',)
+    lines = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float('inf'),), value):
+      cumulative += count
+      lines.append('%s_bucket%s %d' % (
+          self.name,
+          _FormatLabels(label_names, label_values + (_FormatValue(bound),)),
+          cumulative))
+    labels = _FormatLabels(self.labels, label_values)
+    lines.append('%s_sum%s %s' % (self.name, labels, _FormatValue(value[-2])))
+    lines.append('%s_count%s %d' % (self.name, labels, value[-1]))
+    return lines
+
+
+def Render():
+  """Returns all registered metrics in the Prometheus text format."""
+  with _registry_lock:
+    registered = _registry.values()
+  lines = []
+  for metric in registered:
+    lines.extend(metric.Render())
+  return '\n'.join(lines) + '\n'
+
+
+# Lookups of the caches of the devserver, by cache and whether they hit.
+CACHE_LOOKUPS = Counter('devserver_cache_lookups_total',
+                        'Cache lookups, by cache and result (hit or miss).',
+                        ('cache', 'result'))
+
+
+def RecordCacheLookup(cache, hit):
+  """Counts a lookup of one of the devserver's caches."""
+  CACHE_LOOKUPS.Inc((cache, 'hit' if hit else 'miss'))
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for metrics module."""
+
+import threading
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+  def testCounter(self):
+    counter = metrics.Counter('test_counter_total', 'A "test" counter.',
+                              ('name',))
+    counter.Inc(('a',))
+    counter.Inc(('a',), 2)
+    counter.Inc(('b\n"c"',))
+    self.assertEqual(counter.Render(), [
+        '# HELP test_counter_total A "test" counter.',
+        '# TYPE test_counter_total counter',
+        'test_counter_total{name="a"} 3',
+        'test_counter_total{name="b\\n\\"c\\""} 1',
+    ])
+
+  def testCounterFromThreads(self):
+    """Tests that increments from many threads are all counted."""
+    counter = metrics.Counter('test_threaded_total', 'Threaded counter.')
+    def IncMany():
+      for _ in range(1000):
+        counter.Inc()
+    threads = [threading.Thread(target=IncMany) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(counter.Collect(), {(): 8000})
+
+  def testGauge(self):
+    gauge = metrics.Gauge('test_gauge', 'A test gauge.', ('name',))
+    gauge.Inc(('a',), 3)
+    gauge.Dec(('a',))
+    gauge.Inc(('b',))
+    gauge.Dec(('b',))
+    self.assertEqual(gauge.Render(), [
+        '# HELP test_gauge A test gauge.',
+        '# TYPE test_gauge gauge',
+        'test_gauge{name="a"} 2',
+        'test_gauge{name="b"} 0',
+    ])
+
+  def testHistogram(self):
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.',
+                                  buckets=(1, 0.1))
+    histogram.Observe(0.05)
+    histogram.Observe(0.1)
+    histogram.Observe(5)
+    self.assertEqual(histogram.Render(), [
+        '# HELP test_seconds A test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.15',
+        'test_seconds_count 3',
+    ])
+
+  def testDuplicateName(self):
+    metrics.Counter('test_duplicate_total', 'First.')
+    self.assertRaises(metrics.MetricsError, metrics.Counter,
+                      'test_duplicate_total', 'Second.')
+
+  def testRender(self):
+    self.assertTrue('# TYPE devserver_cache_lookups_total counter\n' in
+                    metrics.Render())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,172 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Background generation of update payloads for newly built images.
+
+Generating a payload takes minutes, which the first host to ask for a new
+build otherwise spends waiting. The prewarmer watches the latest image of each
+of a set of boards, and as soon as a new one appears it generates the full
+payload into the updater's cache, optionally along with deltas from the client
+versions most reported by hosts of that board. Generators run one at a time,
+at the lowest CPU priority, so that serving isn't slowed down.
+
+The updater also schedules deltas requested by update checks here (see
+Autoupdate.client_deltas).
+"""
+
+import Queue
+import os
+import threading
+
+import autoupdate
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREWARM', message, *args)
+
+
+# Default seconds between checks for new images.
+DEFAULT_POLL_INTERVAL = 60
+
+# Sentinel job asking the worker to exit.
+_STOP = object()
+
+
+class PayloadPrewarmer(object):
+  """Watches for new images and generates their payloads in the background.
+
+  Members:
+    boards: list of boards whose latest images are watched.
+    poll_interval: seconds between checks for new images.
+    num_deltas: number of delta payloads generated per new image, from the
+                most reported client versions.
+  """
+
+  def __init__(self, updater, boards, poll_interval=DEFAULT_POLL_INTERVAL,
+               num_deltas=0):
+    """Args:
+      updater: the autoupdate.Autoupdate instance serving update pings.
+    """
+    self._updater = updater
+    self.boards = boards
+    self.poll_interval = poll_interval
+    self.num_deltas = num_deltas
+    # Latest image path seen per board.
+    self._latest_images = {}
+    # Pending (src_image, image_path, static_image_dir) jobs, and the set of
+    # them for dedup.
+    self._jobs = Queue.Queue()
+    self._pending = set()
+    self._pending_lock = threading.Lock()
+    self._stop = threading.Event()
+    self._threads = []
+
+  def Schedule(self, src_image, image_path, static_image_dir=None):
+    """Queues generation of a payload, unless already queued.
+
+    Args:
+      src_image: image to generate a delta from; empty for a full payload.
+      image_path: image to generate the payload for.
+      static_image_dir: directory holding the cache to generate into;
+                        defaults to the updater's static dir.
+    """
+    job = (src_image, image_path, static_image_dir or self._updater.static_dir)
+    with self._pending_lock:
+      if job in self._pending:
+        return
+      self._pending.add(job)
+    _Log('Scheduling payload for %s%s', image_path,
+         ' from %s' % src_image if src_image else '')
+    self._jobs.put(job)
+
+  def _GetDeltaSources(self, board, image_path):
+    """Returns images of the client versions most reported for a board.
+
+    Versions are ranked by the number of update checks and events received
+    from hosts of the board in the last hour (see update_stats). Only versions
+    whose image is still around next to the new image are considered.
+    """
+    counts = {}
+    for stat in self._updater.update_stats.Query(board=board):
+      counts[stat['version']] = counts.get(stat['version'], 0) + stat['count']
+    if not counts:
+      return []
+
+    # Image dirs of a board are siblings, named after their versions.
+    images_dir = os.path.dirname(os.path.dirname(image_path))
+    src_images = []
+    for version in sorted(counts, key=counts.get, reverse=True):
+      src_image = self._updater.FindVersionImage(images_dir, version)
+      if src_image and src_image != image_path:
+        src_images.append(src_image)
+        if len(src_images) == self.num_deltas:
+          break
+    return src_images
+
+  def Poll(self):
+    """Checks each board for a new latest image, scheduling its payloads."""
+    for board in self.boards:
+      latest = self._updater.GetLatestImage(board)
+      if not latest:
+        continue
+      _, image_path = latest
+      if (self._latest_images.get(board) == image_path or
+          not os.path.exists(image_path)):
+        continue
+
+      _Log('New image for %s: %s', board, image_path)
+      self._latest_images[board] = image_path
+      self.Schedule('', image_path)
+      if self.num_deltas:
+        for src_image in self._GetDeltaSources(board, image_path):
+          self.Schedule(src_image, image_path)
+
+  def _PollLoop(self):
+    while not self._stop.is_set():
+      try:
+        self.Poll()
+      except (OSError, IOError), e:
+        _Log('Failed to check for new images: %s', e)
+      self._stop.wait(self.poll_interval)
+
+  def RunJob(self, job):
+    """Generates the payload of a scheduled job into the cache."""
+    src_image, image_path, static_image_dir = job
+    try:
+      self._updater.GenerateCachedUpdateImage(
+          src_image, image_path, static_image_dir, low_priority=True)
+    except (autoupdate.AutoupdateError, IOError, OSError), e:
+      _Log('Failed to prewarm payload for %s: %s', image_path, e)
+    finally:
+      with self._pending_lock:
+        self._pending.discard(job)
+
+  def _WorkLoop(self):
+    while True:
+      job = self._jobs.get()
+      # Jobs still queued on shutdown are dropped.
+      if job is _STOP or self._stop.is_set():
+        return
+      self.RunJob(job)
+
+  def Start(self):
+    """Starts watching for images and generating payloads."""
+    loops = [(self._WorkLoop, 'PrewarmWorker')]
+    if self.boards:
+      loops.append((self._PollLoop, 'PrewarmPoller'))
+    for target, name in loops:
+      thread = threading.Thread(target=target, name=name)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def Stop(self):
+    """Stops watching, and waits for the payload being generated, if any."""
+    self._stop.set()
+    self._jobs.put(_STOP)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_prewarmer module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+import autoupdate
+import payload_prewarmer
+import update_stats
+
+
+IMAGE_NAME = 'chromiumos_image.bin'
+
+
+class PayloadPrewarmerTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._images_dir = tempfile.mkdtemp('payload_prewarmer_unittest')
+    self._updater = self.mox.CreateMock(autoupdate.Autoupdate)
+    self._updater.static_dir = '/static'
+    self._updater.update_stats = update_stats.UpdateStats()
+    self._prewarmer = payload_prewarmer.PayloadPrewarmer(
+        self._updater, ['x86-alex'], num_deltas=1)
+
+  def tearDown(self):
+    shutil.rmtree(self._images_dir)
+
+  def _MakeImage(self, version):
+    image_dir = os.path.join(self._images_dir, 'R21-%s-a1' % version)
+    os.makedirs(image_dir)
+    image_path = os.path.join(image_dir, IMAGE_NAME)
+    open(image_path, 'w').close()
+    return image_path
+
+  def _RunJobs(self):
+    while not self._prewarmer._jobs.empty():
+      self._prewarmer.RunJob(self._prewarmer._jobs.get())
+
+  def testNewImageIsPrewarmedOnce(self):
+    """Tests that payloads for a new image are generated once, in background."""
+    old_image = self._MakeImage('2.0.0')
+    new_image = self._MakeImage('3.0.0')
+    self._MakeImage('1.0.0')
+    for version in ['1.0.0', '2.0.0', '2.0.0']:
+      self._updater.update_stats.Record('x86-alex', version)
+    self._updater.update_stats.Record('lumpy', '2.0.0')
+
+    self._updater.GetLatestImage('x86-alex').AndReturn(('3.0.0', new_image))
+    self._updater.FindVersionImage(self._images_dir, '2.0.0').AndReturn(
+        old_image)
+    self._updater.GenerateCachedUpdateImage(
+        '', new_image, '/static', low_priority=True)
+    self._updater.GenerateCachedUpdateImage(
+        old_image, new_image, '/static', low_priority=True)
+    self._updater.GetLatestImage('x86-alex').AndReturn(('3.0.0', new_image))
+    self.mox.ReplayAll()
+
+    self._prewarmer.Poll()
+    self._RunJobs()
+    self._prewarmer.Poll()
+    self._RunJobs()
+    self.mox.VerifyAll()
+
+  def testJobsAreDeduplicated(self):
+    """Tests that queued jobs aren't queued twice, but failed ones can be."""
+    image = self._MakeImage('3.0.0')
+    self._updater.GenerateCachedUpdateImage(
+        '', image, '/static', low_priority=True).AndRaise(
+            autoupdate.AutoupdateError('Failed'))
+    self._updater.GenerateCachedUpdateImage(
+        '', image, '/static', low_priority=True)
+    self.mox.ReplayAll()
+
+    self._prewarmer.Schedule('', image)
+    self._prewarmer.Schedule('', image)
+    self._RunJobs()
+    self._prewarmer.Schedule('', image)
+    self._RunJobs()
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,205 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Serving the devserver from several worker processes.
+
+A single CherryPy process is bound by the global interpreter lock for the
+Python-heavy parts of update handling (parsing pings, JSON, hashing), however
+many threads it runs. WorkerPool binds the listening socket once, forks a
+number of workers that each run the CherryPy engine on the inherited socket,
+letting the kernel spread connections across them, and restarts workers that
+die. State that must be the same across workers lives in shared_state.
+"""
+
+import errno
+import os
+import signal
+import socket
+import time
+
+import cherrypy
+from cherrypy import _cpwsgi_server
+from cherrypy.process import servers
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREFORK', message, *args)
+
+
+# Minimum seconds between starts of the same worker, so that a worker failing
+# on startup doesn't make the parent spin.
+_MIN_RESTART_INTERVAL = 1.0
+
+# Signals on which the parent stops its workers and exits.
+_STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+
+class PreforkError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def BindSocket(host, port, backlog=socket.SOMAXCONN):
+  """Returns a socket listening on the given address, to share with workers.
+
+  This binds like CherryPy's server does, including dual-stack IPv6 and
+  TCP_NODELAY, which accepted connections inherit; without it, each response
+  on a keep-alive connection waits for the client's delayed ACK.
+
+  Raises:
+    PreforkError: if the address can't be bound.
+  """
+  error = None
+  for family, socktype, proto, _, addr in socket.getaddrinfo(
+      host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+    sock = socket.socket(family, socktype, proto)
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      if family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      if family == socket.AF_INET6 and host in ('::', '::0', '::0.0.0.0'):
+        try:
+          sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except (AttributeError, socket.error):
+          pass
+      sock.bind(addr)
+      sock.listen(backlog)
+      return sock
+    except socket.error, e:
+      sock.close()
+      error = e
+  raise PreforkError('Failed to bind %s:%s: %s' % (host, port, error))
+
+
+class _SharedSocketServer(_cpwsgi_server.CPWSGIServer):
+  """CherryPy's HTTP server, accepting connections on an inherited socket."""
+
+  def __init__(self, listen_socket):
+    _cpwsgi_server.CPWSGIServer.__init__(self, cherrypy.server)
+    self._listen_socket = listen_socket
+
+  def bind(self, family, type, proto=0):
+    # Workers compete in accept(); ones losing the race get EAGAIN, which the
+    # server ignores, as the socket is non-blocking with a timeout.
+    self.socket = self._listen_socket
+
+
+def ServeWorker(listen_socket, root, config):
+  """Runs the CherryPy engine of a worker until it is told to exit.
+
+  This is cherrypy.quickstart(), with the HTTP server accepting connections
+  on the listening socket of the pool instead of binding its own.
+  """
+  cherrypy.config.update(config)
+  cherrypy.tree.mount(root, '', config)
+
+  cherrypy.server.unsubscribe()
+  # Without a bind address, the adapter doesn't wait for the port to be free,
+  # which it never is.
+  server = servers.ServerAdapter(cherrypy.engine,
+                                 _SharedSocketServer(listen_socket))
+  server.subscribe()
+
+  # A worker re-executing itself, on SIGHUP or when the autoreloader sees a
+  # changed module, would start a whole new pool.
+  cherrypy.engine.autoreload.unsubscribe()
+  cherrypy.engine.signal_handler.handlers['SIGHUP'] = cherrypy.engine.exit
+  cherrypy.engine.signal_handler.subscribe()
+  cherrypy.engine.start()
+  cherrypy.engine.block()
+
+
+class WorkerPool(object):
+  """Forks and supervises worker processes.
+
+  Usage:
+
+    pool = WorkerPool(4, serve)
+    pool.Run()
+
+  where serve(worker_index) runs a worker until it should exit. Run() returns
+  once the parent receives SIGTERM, SIGINT or SIGHUP, and all workers, which
+  get sent SIGTERM, have exited.
+  """
+
+  def __init__(self, num_workers, serve):
+    if num_workers < 1:
+      raise PreforkError('Invalid number of workers: %d' % num_workers)
+    self.num_workers = num_workers
+    self._serve = serve
+    # Worker index by pid, and the last start time of each worker.
+    self._workers = {}
+    self._start_times = {}
+    self._stopping = False
+
+  def _StartWorker(self, index):
+    last_start = self._start_times.get(index)
+    if last_start is not None:
+      delay = last_start + _MIN_RESTART_INTERVAL - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    if self._stopping:
+      return
+    self._start_times[index] = time.time()
+
+    log_util.Flush()
+    pid = os.fork()
+    if pid:
+      self._workers[pid] = index
+      # The stop signal may have arrived while forking.
+      if self._stopping:
+        os.kill(pid, signal.SIGTERM)
+      return
+
+    status = 1
+    try:
+      for signum in _STOP_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+      self._serve(index)
+      status = 0
+    except Exception, e:
+      _Log('Worker %d failed: %s', index, e)
+    finally:
+      # Never return into the parent's code.
+      os._exit(status)
+
+  def _Stop(self, signum, _):
+    _Log('Received signal %d, stopping %d workers', signum, len(self._workers))
+    self._stopping = True
+    self._SignalWorkers(signal.SIGTERM)
+
+  def _SignalWorkers(self, signum):
+    for pid in self._workers:
+      try:
+        os.kill(pid, signum)
+      except OSError, e:
+        if e.errno != errno.ESRCH:
+          raise
+
+  def Run(self):
+    """Starts the workers and supervises them until told to stop."""
+    for signum in _STOP_SIGNALS:
+      signal.signal(signum, self._Stop)
+
+    _Log('Starting %d workers', self.num_workers)
+    for index in range(self.num_workers):
+      self._StartWorker(index)
+
+    while self._workers:
+      try:
+        pid, status = os.wait()
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      index = self._workers.pop(pid, None)
+      if index is None or self._stopping:
+        continue
+      _Log('Worker %d (pid %d) exited with status %d, restarting', index, pid,
+           status)
+      self._StartWorker(index)
+    _Log('All workers exited')
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for prefork module."""
+
+import socket
+import unittest
+
+import prefork
+
+
+class PreforkTest(unittest.TestCase):
+
+  def testBindSocket(self):
+    """Tests that connections accepted on the socket don't wait on Nagle."""
+    listen_socket = prefork.BindSocket('127.0.0.1', 0)
+    try:
+      self.assertTrue(listen_socket.getsockopt(socket.SOL_SOCKET,
+                                               socket.SO_REUSEADDR))
+      self.assertTrue(listen_socket.getsockopt(socket.IPPROTO_TCP,
+                                               socket.TCP_NODELAY))
+
+      client = socket.create_connection(listen_socket.getsockname())
+      connection, _ = listen_socket.accept()
+      try:
+        self.assertTrue(connection.getsockopt(socket.IPPROTO_TCP,
+                                              socket.TCP_NODELAY))
+      finally:
+        connection.close()
+        client.close()
+    finally:
+      listen_socket.close()
+
+  def testBindSocketFailure(self):
+    listen_socket = prefork.BindSocket('127.0.0.1', 0)
+    try:
+      self.assertRaises(prefork.PreforkError, prefork.BindSocket,
+                        '127.0.0.1', listen_socket.getsockname()[1])
+    finally:
+      listen_socket.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Sampling profiler of all threads of the process, for /api/profile.
+
+Profile() samples the Python stack of every other thread at a fixed interval
+for a number of seconds, and counts how often each stack was seen. Threads
+are never interrupted or instrumented, so the overhead is that of one thread
+walking the stacks, and a profile can be taken on a loaded production server.
+
+The result is in the collapsed stack format of flame graph tools: one line
+per distinct stack, with its frames from outermost to innermost separated by
+semicolons, followed by the number of samples it was seen in, e.g.
+
+  Thread.__bootstrap (threading.py);...;GetFileHashes (common_util.py) 42
+"""
+
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+
+DEFAULT_INTERVAL = 0.01
+
+# Longest profile taken, in seconds.
+MAX_SECONDS = 300
+
+# Innermost frames of threads waiting for work, such as request threads
+# waiting for a connection, by file name and function. CherryPy's background
+# tasks sleep in plugins.run, and its main thread in wspbus._wait.
+_IDLE_FRAMES = frozenset([
+    ('threading.py', 'wait'),
+    ('Queue.py', 'get'),
+    ('socket.py', 'accept'),
+    ('wsgiserver2.py', 'tick'),
+    ('plugins.py', 'run'),
+    ('wspbus.py', '_wait'),
+])
+
+# Strips the number off thread names such as 'CP Server Thread-12'.
+_THREAD_NUMBER_RE = re.compile(r'[-_ ]?\d+$')
+
+# Only one profile is taken at a time.
+_profile_lock = threading.Lock()
+
+
+class ProfileError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def _FrameName(frame):
+  code = frame.f_code
+  return '%s (%s)' % (code.co_name, os.path.basename(code.co_filename))
+
+
+def _CollapseStack(frame, include_idle):
+  """Returns the frame names of a stack, outermost first.
+
+  Returns None instead for the stack of a thread waiting for work, unless
+  include_idle is set.
+  """
+  code = frame.f_code
+  if (not include_idle and
+      (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES):
+    return None
+  names = []
+  while frame is not None:
+    names.append(_FrameName(frame))
+    frame = frame.f_back
+  names.reverse()
+  return names
+
+
+def Profile(seconds, interval=DEFAULT_INTERVAL, include_idle=False,
+            by_thread=False):
+  """Samples the stacks of all other threads and counts them.
+
+  Args:
+    seconds: how long to sample for.
+    interval: seconds between samples.
+    include_idle: also count threads waiting for work.
+    by_thread: start each stack with the name of its thread, without any
+               trailing number, so that pools of threads are grouped.
+
+  Returns:
+    The profile in the collapsed stack format, most frequent stack first.
+
+  Raises:
+    ProfileError: if the arguments are out of range, or another profile is
+                  being taken.
+  """
+  if not 0 < seconds <= MAX_SECONDS:
+    raise ProfileError('Profile duration must be within (0, %d] seconds' %
+                       MAX_SECONDS)
+  if not 0 < interval <= seconds:
+    raise ProfileError('Sampling interval must be within (0, %s] seconds' %
+                       seconds)
+  if not _profile_lock.acquire(False):
+    raise ProfileError('Another profile is being taken')
+
+  try:
+    counts = collections.defaultdict(int)
+    own_ident = threading.current_thread().ident
+    deadline = time.time() + seconds
+    next_sample = time.time()
+    while next_sample < deadline:
+      # Thread names are looked up once per sample, as threads come and go.
+      names = {}
+      if by_thread:
+        for thread in threading.enumerate():
+          names[thread.ident] = _THREAD_NUMBER_RE.sub('', thread.name)
+      for ident, frame in sys._current_frames().items():
+        if ident == own_ident:
+          continue
+        stack = _CollapseStack(frame, include_idle)
+        if stack is None:
+          continue
+        if by_thread:
+          stack.insert(0, names.get(ident, 'unknown'))
+        counts[';'.join(stack)] += 1
+      # Drop the reference to the frames before sleeping.
+      frame = None
+
+      next_sample += interval
+      delay = next_sample - time.time()
+      if delay > 0:
+        time.sleep(delay)
+  finally:
+    _profile_lock.release()
+
+  lines = ['%s %d' % (stack, count) for stack, count in
+           sorted(counts.iteritems(), key=lambda item: (-item[1], item[0]))]
+  return '\n'.join(lines) + '\n' if lines else ''
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for profile_util module."""
+
+import threading
+import unittest
+
+import profile_util
+
+
+def _SpinUntil(event):
+  while not event.is_set():
+    sum(range(100))
+
+
+class ProfileUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=_SpinUntil, args=(self._stop,),
+                                    name='spinner-3')
+    self._thread.start()
+
+  def tearDown(self):
+    self._stop.set()
+    self._thread.join()
+
+  def _ParseProfile(self, profile):
+    """Returns a dictionary of the sample counts of stacks in a profile."""
+    counts = {}
+    for line in profile.splitlines():
+      stack, count = line.rsplit(' ', 1)
+      counts[stack] = int(count)
+    return counts
+
+  def testProfile(self):
+    counts = self._ParseProfile(profile_util.Profile(0.2, 0.01))
+    spinning = [stack for stack in counts
+                if stack.endswith('_SpinUntil (profile_util_unittest.py)')]
+    self.assertEqual(len(spinning), 1)
+    self.assertTrue(spinning[0].startswith('__bootstrap (threading.py);'))
+    self.assertTrue(counts[spinning[0]] > 5)
+    # The profiling thread doesn't sample itself.
+    self.assertFalse([stack for stack in counts if 'testProfile' in stack])
+
+  def testProfileByThread(self):
+    counts = self._ParseProfile(profile_util.Profile(0.05, 0.01,
+                                                     by_thread=True))
+    self.assertTrue([stack for stack in counts
+                     if stack.startswith('spinner;')])
+
+  def testIdleThreads(self):
+    """Tests that threads waiting for work are only counted on request."""
+    waiter = threading.Thread(target=self._stop.wait)
+    waiter.start()
+    try:
+      counts = self._ParseProfile(profile_util.Profile(0.05, 0.01))
+      self.assertFalse([stack for stack in counts
+                        if stack.endswith('wait (threading.py)')])
+      counts = self._ParseProfile(profile_util.Profile(0.05, 0.01,
+                                                       include_idle=True))
+      self.assertTrue([stack for stack in counts
+                       if stack.endswith('wait (threading.py)')])
+    finally:
+      self._stop.set()
+      waiter.join()
+
+  def testInvalidArguments(self):
+    self.assertRaises(profile_util.ProfileError, profile_util.Profile, 0)
+    self.assertRaises(profile_util.ProfileError, profile_util.Profile,
+                      profile_util.MAX_SECONDS + 1)
+    self.assertRaises(profile_util.ProfileError, profile_util.Profile, 1, 2)
+
+  def testOneProfileAtATime(self):
+    thread = threading.Thread(target=profile_util.Profile, args=(0.3,))
+    thread.start()
+    try:
+      while not profile_util._profile_lock.locked():
+        pass
+      self.assertRaises(profile_util.ProfileError, profile_util.Profile, 0.1)
+    finally:
+      thread.join()
+
+
+if __name__ == '__main__':
+  unittest.main()
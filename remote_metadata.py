@@ -0,0 +1,218 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Cached retrieval of payload metadata from remote devservers.
+
+A devserver proxying update pings to payloads staged on another devserver
+needs the payload's hashes and size (from the remote /api/fileinfo) for every
+ping. This module keeps those responses for a while, revalidates them with
+If-None-Match once they go stale, reuses keep-alive connections to the remote
+devservers, and lets concurrent pings for the same payload share one fetch.
+"""
+
+import collections
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+import log_util
+import metrics
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('REMOTE_METADATA', message, *args)
+
+
+# Default number of seconds a response is used without revalidation.
+DEFAULT_TTL = 60
+
+# Default maximum number of responses kept.
+DEFAULT_MAX_ENTRIES = 1000
+
+# Seconds to wait for a remote devserver to respond.
+_TIMEOUT = 30
+
+# Maximum number of idle connections kept per remote devserver.
+_MAX_IDLE_CONNECTIONS = 4
+
+
+class RemoteMetadataError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+class ConnectionPool(object):
+  """A pool of idle keep-alive HTTP connections, per scheme, host and port."""
+
+  def __init__(self, max_idle=_MAX_IDLE_CONNECTIONS, timeout=_TIMEOUT):
+    self._max_idle = max_idle
+    self._timeout = timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def _NewConnection(self, scheme, netloc):
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self._timeout)
+    return httplib.HTTPConnection(netloc, timeout=self._timeout)
+
+  def _GetConnection(self, key):
+    with self._lock:
+      idle = self._idle.get(key)
+      if idle:
+        return idle.pop(), True
+    return self._NewConnection(*key), False
+
+  def _PutConnection(self, key, conn):
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self._max_idle:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def Request(self, url, headers=None):
+    """Issues a GET request.
+
+    If a pooled connection turns out to have been closed by the server while
+    idle, it is discarded and the request retried on another one.
+
+    Args:
+      url: http or https URL to get.
+      headers: dictionary of additional request headers.
+    Returns:
+      A tuple of the response status, a httplib.HTTPMessage of the response
+      headers and the response body.
+    Raises:
+      RemoteMetadataError: if the URL is not http(s) or the request fails.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if scheme not in ('http', 'https'):
+      raise RemoteMetadataError('Unsupported URL: %s' % url)
+    if query:
+      path = '%s?%s' % (path, query)
+    key = (scheme, netloc)
+
+    while True:
+      conn, reused = self._GetConnection(key)
+      try:
+        conn.request('GET', path or '/', headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error), e:
+        conn.close()
+        if reused:
+          continue
+        raise RemoteMetadataError('Request for %s failed: %s' % (url, e))
+
+      if response.will_close:
+        conn.close()
+      else:
+        self._PutConnection(key, conn)
+      return response.status, response.msg, body
+
+
+class _Entry(object):
+  """A cached response body, its ETag and when it goes stale."""
+  __slots__ = ('body', 'etag', 'expires')
+
+  def __init__(self, body, etag, expires):
+    self.body = body
+    self.etag = etag
+    self.expires = expires
+
+
+class _Fetch(object):
+  """An in-flight fetch that concurrent callers wait for."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.body = None
+    self.error = None
+
+
+class MetadataCache(object):
+  """A bounded cache of remote responses, keyed by URL."""
+
+  def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+               pool=None):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._pool = pool or ConnectionPool()
+    # Cached entries, least recently used first.
+    self._entries = collections.OrderedDict()
+    self._fetches = {}
+    self._lock = threading.Lock()
+
+  def Get(self, url):
+    """Returns the body of a response to a GET request for the URL.
+
+    Responses younger than the TTL are served from memory. Older ones are
+    revalidated with the remote server, which only sends the body if it
+    changed. Of concurrent callers missing the same URL, only one goes to the
+    remote server; the others wait for its result.
+
+    Raises:
+      RemoteMetadataError: if the response can't be retrieved.
+    """
+    with self._lock:
+      entry = self._entries.pop(url, None)
+      if entry:
+        self._entries[url] = entry
+        if entry.expires > time.time():
+          metrics.RecordCacheLookup('remote_metadata', True)
+          return entry.body
+
+      fetch = self._fetches.get(url)
+      owner = fetch is None
+      if owner:
+        fetch = self._fetches[url] = _Fetch()
+
+    metrics.RecordCacheLookup('remote_metadata', False)
+    if not owner:
+      fetch.done.wait()
+      if fetch.error:
+        raise fetch.error
+      return fetch.body
+
+    try:
+      fetch.body = self._Fetch(url, entry)
+    except Exception, e:
+      fetch.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._fetches[url]
+      fetch.done.set()
+    return fetch.body
+
+  def _Fetch(self, url, entry):
+    """Retrieves or revalidates a response and caches it."""
+    headers = {}
+    if entry and entry.etag:
+      headers['If-None-Match'] = entry.etag
+      _Log('Revalidating %s', url)
+    else:
+      _Log('Retrieving %s', url)
+
+    status, response_headers, body = self._pool.Request(url, headers)
+    if status == httplib.NOT_MODIFIED and entry:
+      body = entry.body
+      etag = entry.etag
+    elif status == httplib.OK:
+      etag = response_headers.getheader('ETag')
+    else:
+      with self._lock:
+        self._entries.pop(url, None)
+      raise RemoteMetadataError('Request for %s failed with status %d' %
+                                (url, status))
+
+    with self._lock:
+      self._entries.pop(url, None)
+      self._entries[url] = _Entry(body, etag, time.time() + self.ttl)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    return body
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for remote_metadata module."""
+
+import BaseHTTPServer
+import mimetools
+import StringIO
+import threading
+import time
+import unittest
+
+import mox
+
+import remote_metadata
+
+
+URL = 'http://remotehost:8080/api/fileinfo/path/to/update.gz'
+BODY = '{"size": 1, "sha1": "a", "sha256": "b"}'
+
+
+def _Headers(**headers):
+  """Returns an httplib.HTTPMessage-like object holding the given headers."""
+  return mimetools.Message(StringIO.StringIO(
+      ''.join('%s: %s\r\n' % item for item in headers.iteritems())))
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves BODY with an ETag, over keep-alive connections."""
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.connections.add(self.client_address)
+    if self.headers.getheader('If-None-Match') == '"1"':
+      self.send_response(304)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('ETag', '"1"')
+    self.send_header('Content-Length', str(len(BODY)))
+    self.end_headers()
+    self.wfile.write(BODY)
+
+  def log_message(self, *args):
+    pass
+
+
+class MetadataCacheTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._pool = self.mox.CreateMock(remote_metadata.ConnectionPool)
+    self._cache = remote_metadata.MetadataCache(ttl=60, pool=self._pool)
+
+  def testFreshResponsesAreCached(self):
+    self._pool.Request(URL, {}).AndReturn((200, _Headers(), BODY))
+    self.mox.ReplayAll()
+    self.assertEqual(self._cache.Get(URL), BODY)
+    self.assertEqual(self._cache.Get(URL), BODY)
+    self.mox.VerifyAll()
+
+  def testStaleResponsesAreRevalidated(self):
+    self._pool.Request(URL, {}).AndReturn((200, _Headers(ETag='"1"'), BODY))
+    self._pool.Request(URL, {'If-None-Match': '"1"'}).AndReturn(
+        (304, _Headers(), ''))
+    self._pool.Request(URL, {'If-None-Match': '"1"'}).AndReturn(
+        (404, _Headers(), ''))
+    self.mox.ReplayAll()
+    self._cache.ttl = 0
+    self.assertEqual(self._cache.Get(URL), BODY)
+    self.assertEqual(self._cache.Get(URL), BODY)
+    self.assertRaises(remote_metadata.RemoteMetadataError, self._cache.Get,
+                      URL)
+    self.mox.VerifyAll()
+
+  def testConcurrentMissesShareOneFetch(self):
+    """Tests that callers missing the same URL wait for a single fetch."""
+    release = threading.Event()
+    requests = []
+
+    class _SlowPool(object):
+      def Request(self, url, headers):
+        requests.append(url)
+        release.wait()
+        return 200, _Headers(), BODY
+
+    cache = remote_metadata.MetadataCache(pool=_SlowPool())
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.Get(URL)))
+               for _ in range(5)]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(requests, [URL])
+    self.assertEqual(results, [BODY] * 5)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+    self._server.connections = set()
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    self._url = 'http://127.0.0.1:%d/api/fileinfo/update.gz' % (
+        self._server.server_port)
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def testConnectionsAreReused(self):
+    pool = remote_metadata.ConnectionPool()
+    status, headers, body = pool.Request(self._url)
+    self.assertEqual((status, headers.getheader('ETag'), body),
+                     (200, '"1"', BODY))
+    status, _, body = pool.Request(self._url, {'If-None-Match': '"1"'})
+    self.assertEqual((status, body), (304, ''))
+    self.assertEqual(len(self._server.connections), 1)
+
+  def testUnsupportedUrl(self):
+    self.assertRaises(remote_metadata.RemoteMetadataError,
+                      remote_metadata.ConnectionPool().Request,
+                      'ftp://remotehost/update.gz')
+
+
+if __name__ == '__main__':
+  unittest.main()
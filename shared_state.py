@@ -0,0 +1,467 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""State shared by the worker processes of a devserver.
+
+With several worker processes (see prefork), each has its own updater, yet
+some state must not depend on which worker a request lands on: forced update
+labels are set by one request and consumed by a later update check, and a
+background download started by one request is waited for by another. This
+state lives in a SQLite database in WAL mode, where readers never block the
+writer and a commit is an append to the write-ahead log without an fsync.
+
+Per-process caches that are merely read through (payload metadata, latest
+build indexes) are not shared; each worker fills its own.
+
+Changes to hosts recorded by update pings are held by each worker and
+written in one transaction every HOST_FLUSH_INTERVAL seconds, rather than
+taking the database's single write lock on every ping.
+"""
+
+import collections
+import contextlib
+import errno
+import marshal
+import os
+import sqlite3
+import threading
+import time
+
+import host_info
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args, **kwargs):
+  return log_util.LogWithTag('SHARED_STATE', message, *args, **kwargs)
+
+
+# Name of the database file in a state directory.
+DATABASE_FILE = 'devserver_state.db'
+
+# Seconds a transaction waits for another process's write lock.
+_BUSY_TIMEOUT = 30
+
+# Seconds between checks of a job being run by another process.
+_JOB_POLL_INTERVAL = 0.5
+
+# Seconds changes to hosts by update pings are held before being written.
+HOST_FLUSH_INTERVAL = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+  host_id TEXT PRIMARY KEY,
+  attrs BLOB NOT NULL,
+  last_seen REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS hosts_by_last_seen ON hosts (last_seen);
+CREATE TABLE IF NOT EXISTS events (
+  id INTEGER PRIMARY KEY,
+  host_id TEXT NOT NULL,
+  entry BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS events_by_host ON events (host_id, id);
+CREATE TABLE IF NOT EXISTS counters (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (
+  key TEXT PRIMARY KEY,
+  pid INTEGER NOT NULL,
+  done INTEGER NOT NULL,
+  error TEXT,
+  foreground_done INTEGER NOT NULL DEFAULT 0);
+"""
+
+
+class SharedStateError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+def _Pack(value):
+  return buffer(marshal.dumps(value))
+
+
+def _Unpack(blob):
+  return marshal.loads(str(blob))
+
+
+def _ProcessExists(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno != errno.ESRCH
+  return True
+
+
+class SharedStore(object):
+  """A SQLite database shared by the processes of a devserver.
+
+  Each thread of each process uses its own connection, opened on first use,
+  so a store may be created before forking workers.
+
+  Besides holding a SharedHostInfoTable, the store keeps a registry of jobs,
+  such as background downloads, that one process runs and others wait for.
+  """
+
+  def __init__(self, path):
+    """Args:
+      path: path of the database file, created if needed.
+    """
+    self.path = path
+    self._local = threading.local()
+    _Log('Using shared state database %s', path)
+    try:
+      conn = self._GetConnection()
+      conn.executescript(_SCHEMA)
+      # Databases from before jobs had a foreground part.
+      columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+      if 'foreground_done' not in columns:
+        conn.execute('ALTER TABLE jobs ADD COLUMN '
+                     'foreground_done INTEGER NOT NULL DEFAULT 0')
+    except sqlite3.Error, e:
+      raise SharedStateError('Failed to open %s: %s' % (path, e))
+    # Don't hand this connection down to forked workers.
+    self._Close()
+
+  def _GetConnection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None or self._local.pid != os.getpid():
+      # Autocommit mode: transactions are delimited explicitly below.
+      conn = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT,
+                             isolation_level=None)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self._local.conn = conn
+      self._local.pid = os.getpid()
+    return conn
+
+  def _Close(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None and self._local.pid == os.getpid():
+      conn.close()
+    self._local.conn = None
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    """Runs a block in a write transaction, yielding a cursor.
+
+    The transaction takes the write lock up front, so its reads and writes
+    are atomic with respect to all other processes.
+    """
+    cursor = self._GetConnection().cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+      yield cursor
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+    cursor.execute('COMMIT')
+
+  def Query(self, sql, args=()):
+    """Runs a read-only statement and returns all rows of its result."""
+    return self._GetConnection().execute(sql, args).fetchall()
+
+  def StartJob(self, key):
+    """Registers a job as being run by this process.
+
+    Returns:
+      True if the caller should run the job, False if another process is
+      already running it.
+    """
+    with self.Transaction() as cursor:
+      row = cursor.execute('SELECT pid, done FROM jobs WHERE key = ?',
+                           (key,)).fetchone()
+      if row and not row[1] and _ProcessExists(row[0]):
+        return False
+      cursor.execute('INSERT OR REPLACE INTO jobs (key, pid, done) '
+                     'VALUES (?, ?, 0)', (key, os.getpid()))
+    return True
+
+  def FinishJobForeground(self, key):
+    """Records that the foreground part of a job is done.
+
+    That is the part its starter waits for, such as the artifacts a download
+    stages before returning; see WaitForJob().
+    """
+    with self.Transaction() as cursor:
+      cursor.execute('UPDATE jobs SET foreground_done = 1 WHERE key = ?',
+                     (key,))
+
+  def FinishJob(self, key, error=None):
+    """Records that a job finished, successfully unless an error is given."""
+    with self.Transaction() as cursor:
+      cursor.execute('UPDATE jobs SET done = 1, error = ? WHERE key = ?',
+                     (error, key))
+
+  def WaitForJob(self, key, foreground=False):
+    """Waits for a job, possibly run by another process, to finish.
+
+    Args:
+      key: the job.
+      foreground: only wait for the foreground part of the job.
+
+    Returns:
+      None if no such job was ever started, otherwise its error message, or
+      '' if it succeeded. A job whose process exited before finishing it
+      counts as failed.
+    """
+    while True:
+      rows = self.Query('SELECT pid, done, error, foreground_done FROM jobs '
+                        'WHERE key = ?', (key,))
+      if not rows:
+        return None
+      pid, done, error, foreground_done = rows[0]
+      if done or (foreground and foreground_done):
+        return error or ''
+      if not _ProcessExists(pid):
+        return 'Process %d exited while running %s' % (pid, key)
+      time.sleep(_JOB_POLL_INTERVAL)
+
+
+class SharedHostInfoTable(object):
+  """A host_info.HostInfoTable kept in a SharedStore.
+
+  Hosts are returned as host_info.HostInfo snapshots; changes go through the
+  table's methods, each of which is a single transaction, so they are atomic
+  across processes just as HostInfoTable's are across threads. Beyond
+  max_hosts, the least recently active hosts are dropped.
+
+  The exception is UpdateHost(), which update pings call: its changes are
+  held by the process and written together by a background thread, every
+  HOST_FLUSH_INTERVAL seconds. Reads through the table write the changes
+  held by their process first, so a process always sees its own changes;
+  other processes see them once written.
+
+  Members:
+    log_size: Number of events kept per host.
+    max_hosts: Maximum number of hosts the table holds.
+    journal: Always None; the database is persistent itself.
+  """
+
+  def __init__(self, store, log_size=host_info.DEFAULT_LOG_SIZE,
+               max_hosts=None):
+    """Args:
+      store: the SharedStore holding the table.
+      log_size: number of events kept per host.
+      max_hosts: maximum number of hosts; defaults to as many as the default
+                 memory budget of a HostInfoTable holds.
+    """
+    self._store = store
+    self.log_size = log_size
+    self.max_hosts = max_hosts or host_info.HostInfoTable(log_size).max_hosts
+    self.journal = None
+    # Changes held by UpdateHost(), as a dictionary mapping host ids to
+    # (attributes to set, packed log entries to append), in order of arrival.
+    self._pending = collections.OrderedDict()
+    self._pending_lock = threading.Lock()
+    # The process whose flusher thread is running, if any.
+    self._flusher_pid = None
+
+  def __repr__(self):
+    self.Flush()
+    return '%s' % dict((host_id, self.GetHostInfo(host_id))
+                       for host_id in self.GetHostIds())
+
+  def _AddToCounter(self, cursor, name, value):
+    cursor.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+    cursor.execute('UPDATE counters SET value = value + ? WHERE name = ?',
+                   (value, name))
+
+  def _GetAttrsLocked(self, cursor, host_id):
+    """Returns a host's attributes, or None if there is no such host."""
+    row = cursor.execute('SELECT attrs FROM hosts WHERE host_id = ?',
+                         (host_id,)).fetchone()
+    return _Unpack(row[0]) if row else None
+
+  def _PutHostLocked(self, cursor, host_id, attrs, keep=()):
+    """Creates or updates a host, marking it the most recently active one.
+
+    Hosts in keep are not expired to make room, even if that leaves the table
+    over max_hosts; the next host added trims it back.
+    """
+    cursor.execute('UPDATE hosts SET attrs = ?, last_seen = ? '
+                   'WHERE host_id = ?', (_Pack(attrs), time.time(), host_id))
+    if cursor.rowcount:
+      return
+
+    cursor.execute('INSERT INTO hosts VALUES (?, ?, ?)',
+                   (host_id, _Pack(attrs), time.time()))
+    self._AddToCounter(cursor, 'hosts', 1)
+    num_hosts = cursor.execute(
+        'SELECT value FROM counters WHERE name = ?', ('hosts',)).fetchone()[0]
+    if num_hosts > self.max_hosts:
+      num_expired = num_hosts - self.max_hosts
+      expired = [row[0] for row in cursor.execute(
+          'SELECT host_id FROM hosts ORDER BY last_seen LIMIT ?',
+          (num_expired + len(keep),)) if row[0] not in keep][:num_expired]
+      for expired_host_id in expired:
+        cursor.execute('DELETE FROM hosts WHERE host_id = ?',
+                       (expired_host_id,))
+        cursor.execute('DELETE FROM events WHERE host_id = ?',
+                       (expired_host_id,))
+      self._AddToCounter(cursor, 'hosts', -len(expired))
+      self._AddToCounter(cursor, 'expired_hosts', len(expired))
+
+  def _GetHostInfo(self, query, host_id):
+    rows = query('SELECT attrs, last_seen FROM hosts WHERE host_id = ?',
+                  (host_id,))
+    if not rows:
+      return None
+    curr_host_info = host_info.HostInfo(self.log_size)
+    curr_host_info.attrs = _Unpack(rows[0][0])
+    curr_host_info.last_seen = rows[0][1]
+    curr_host_info.log.extend(
+        _Unpack(row[0]) for row in query(
+            'SELECT entry FROM events WHERE host_id = ? ORDER BY id',
+            (host_id,)))
+    return curr_host_info
+
+  def GetInitHostInfo(self, host_id):
+    """Return a host's info, or create a new one if none exists.
+
+    This marks the host as the most recently active one.
+    """
+    self.Flush()
+    with self._store.Transaction() as cursor:
+      self._PutHostLocked(cursor, host_id,
+                          self._GetAttrsLocked(cursor, host_id) or {})
+    return self.GetHostInfo(host_id)
+
+  def GetHostInfo(self, host_id):
+    """Return a snapshot of the info of a given host, if such exists."""
+    self.Flush()
+    return self._GetHostInfo(self._store.Query, host_id)
+
+  def _UpdateHostLocked(self, cursor, host_id, attrs, log_entries):
+    """Sets attributes of a host and appends packed entries to its log."""
+    new_attrs = self._GetAttrsLocked(cursor, host_id) or {}
+    new_attrs.update(attrs)
+    self._PutHostLocked(cursor, host_id, new_attrs)
+    if log_entries:
+      cursor.executemany('INSERT INTO events (host_id, entry) VALUES (?, ?)',
+                         [(host_id, _Pack(entry)) for entry in log_entries])
+      cursor.execute(
+          'DELETE FROM events WHERE host_id = ? AND id <= '
+          '(SELECT id FROM events WHERE host_id = ? '
+          'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+          (host_id, host_id, self.log_size))
+
+  def UpdateHost(self, host_id, attrs=None, log_entry=None):
+    """Records update activity of a host.
+
+    The change is written in the background, with those of other update
+    pings; see Flush().
+
+    Args:
+      host_id: id of the host, normally its IP address.
+      attrs: dictionary of attributes to set on the host.
+      log_entry: if set, a dictionary to append to the host's event log.
+    """
+    with self._pending_lock:
+      pending = self._pending.get(host_id)
+      if pending is None:
+        pending = self._pending[host_id] = ({}, [])
+      pending[0].update(attrs or {})
+      if log_entry is not None and self.log_size:
+        pending[1].append(host_info.PackLogEntry(log_entry))
+
+      if self._flusher_pid != os.getpid():
+        self._flusher_pid = os.getpid()
+        flusher = threading.Thread(target=self._FlushLoop,
+                                   name='host_flusher')
+        flusher.daemon = True
+        flusher.start()
+
+  def Flush(self):
+    """Writes the changes held by UpdateHost() in one transaction."""
+    with self._pending_lock:
+      if not self._pending:
+        return
+      pending, self._pending = self._pending, collections.OrderedDict()
+    with self._store.Transaction() as cursor:
+      for host_id, (attrs, log_entries) in pending.iteritems():
+        self._UpdateHostLocked(cursor, host_id, attrs, log_entries)
+
+  def _FlushLoop(self):
+    while True:
+      time.sleep(HOST_FLUSH_INTERVAL)
+      try:
+        self.Flush()
+      except sqlite3.Error, e:
+        _Log('Failed to write host changes: %s', e, level=log_util.WARNING)
+
+  def SetAttr(self, host_id, key, value):
+    """Sets a single attribute of a host, creating the host if needed."""
+    with self._store.Transaction() as cursor:
+      self._UpdateHostLocked(cursor, host_id, {key: value}, [])
+
+  def PopAttr(self, host_id, key):
+    """Removes an attribute from a host and returns it, or None if unset.
+
+    This is atomic: of several concurrent callers, only one gets the value.
+    """
+    # Most hosts have nothing to pop; check without taking the write lock.
+    # Update pings don't set the attributes popped, so the changes they hold
+    # don't matter here.
+    rows = self._store.Query('SELECT attrs FROM hosts WHERE host_id = ?',
+                             (host_id,))
+    if not rows or key not in _Unpack(rows[0][0]):
+      return None
+
+    with self._store.Transaction() as cursor:
+      new_attrs = self._GetAttrsLocked(cursor, host_id)
+      if not new_attrs or key not in new_attrs:
+        return None
+      value = new_attrs.pop(key)
+      cursor.execute('UPDATE hosts SET attrs = ? WHERE host_id = ?',
+                     (_Pack(new_attrs), host_id))
+    return value
+
+  def SetAttrBatch(self, key, values):
+    """Atomically sets an attribute on several hosts.
+
+    Adding the hosts never expires any of them.
+
+    Args:
+      key: name of the attribute.
+      values: dictionary mapping host ids to the value to set on each.
+    """
+    with self._store.Transaction() as cursor:
+      for host_id, value in values.iteritems():
+        new_attrs = self._GetAttrsLocked(cursor, host_id) or {}
+        new_attrs[key] = value
+        self._PutHostLocked(cursor, host_id, new_attrs, keep=values)
+
+  def GetAttrsBatch(self, host_ids):
+    """Returns a consistent snapshot of the attributes of several hosts.
+
+    Args:
+      host_ids: iterable of host ids.
+    Returns:
+      A dictionary mapping each host id to its attributes, or to None for
+      unknown hosts.
+    """
+    self.Flush()
+    with self._store.Transaction() as cursor:
+      return dict((host_id, self._GetAttrsLocked(cursor, host_id))
+                  for host_id in host_ids)
+
+  def GetHostIds(self):
+    """Returns a list of the ids of all hosts in the table."""
+    self.Flush()
+    return [row[0] for row in self._store.Query('SELECT host_id FROM hosts')]
+
+  def GetStats(self):
+    """Returns a dictionary describing the size of the table."""
+    self.Flush()
+    counters = dict(self._store.Query('SELECT name, value FROM counters'))
+    num_events = self._store.Query('SELECT COUNT(*) FROM events')[0][0]
+    return {
+        'hosts': counters.get('hosts', 0),
+        'max_hosts': self.max_hosts,
+        'expired_hosts': counters.get('expired_hosts', 0),
+        'events': num_events,
+        'log_size': self.log_size,
+        'database': self._store.path,
+        'database_size': os.path.getsize(self._store.path),
+    }
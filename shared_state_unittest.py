@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for shared_state module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import shared_state
+
+
+class SharedStateTest(unittest.TestCase):
+
+  def setUp(self):
+    self._state_dir = tempfile.mkdtemp('shared_state_unittest')
+    self._path = os.path.join(self._state_dir, shared_state.DATABASE_FILE)
+
+  def tearDown(self):
+    shutil.rmtree(self._state_dir)
+
+  def _NewTable(self, max_hosts=10):
+    # Each table has its own store, as each worker process would.
+    return shared_state.SharedHostInfoTable(
+        shared_state.SharedStore(self._path), log_size=2, max_hosts=max_hosts)
+
+  def testChangesAreShared(self):
+    """Tests that one store sees the changes made through another."""
+    table = self._NewTable()
+    other_table = self._NewTable()
+    table.UpdateHost('1.2.3.4', attrs={'last_known_version': '1.0.0'},
+                     log_entry={'event_type': 3, 'version': '1.0.0'})
+    other_table.SetAttr('1.2.3.4', 'forced_update_label', 'label')
+
+    host = table.GetHostInfo('1.2.3.4')
+    self.assertEqual(host.attrs, {'last_known_version': '1.0.0',
+                                  'forced_update_label': 'label'})
+    self.assertEqual(host.GetLog()[0]['version'], '1.0.0')
+    self.assertEqual(other_table.PopAttr('1.2.3.4', 'forced_update_label'),
+                     'label')
+    self.assertEqual(table.PopAttr('1.2.3.4', 'forced_update_label'), None)
+    self.assertEqual(table.GetHostInfo('5.6.7.8'), None)
+
+  def testLogIsBounded(self):
+    table = self._NewTable()
+    for version in ('1.0.0', '2.0.0', '3.0.0'):
+      table.UpdateHost('1.2.3.4', log_entry={'version': version})
+    self.assertEqual([entry['version']
+                      for entry in table.GetHostInfo('1.2.3.4').GetLog()],
+                     ['2.0.0', '3.0.0'])
+
+  def testExpiry(self):
+    """Tests that the least recently active hosts are dropped."""
+    table = self._NewTable(max_hosts=2)
+    table.UpdateHost('1.1.1.1', log_entry={'version': '1.0.0'})
+    table.UpdateHost('2.2.2.2')
+    table.GetInitHostInfo('1.1.1.1')
+    table.UpdateHost('3.3.3.3')
+    self.assertEqual(sorted(table.GetHostIds()), ['1.1.1.1', '3.3.3.3'])
+    stats = table.GetStats()
+    self.assertEqual(stats['hosts'], 2)
+    self.assertEqual(stats['expired_hosts'], 1)
+    self.assertEqual(stats['events'], 1)
+
+  def testUpdatesAreWrittenTogether(self):
+    """Tests that changes by update pings are held until flushed."""
+    table = self._NewTable()
+    other_table = self._NewTable()
+    table.UpdateHost('1.1.1.1', attrs={'last_known_version': '1.0.0'},
+                     log_entry={'version': '1.0.0'})
+    table.UpdateHost('1.1.1.1', log_entry={'version': '2.0.0'})
+    table.UpdateHost('2.2.2.2', log_entry={'version': '1.0.0'})
+    self.assertEqual(other_table.GetHostIds(), [])
+
+    table.Flush()
+    self.assertEqual(sorted(other_table.GetHostIds()), ['1.1.1.1', '2.2.2.2'])
+    host = other_table.GetHostInfo('1.1.1.1')
+    self.assertEqual(host.attrs, {'last_known_version': '1.0.0'})
+    self.assertEqual([entry['version'] for entry in host.GetLog()],
+                     ['1.0.0', '2.0.0'])
+
+  def testAttrsBatch(self):
+    table = self._NewTable()
+    table.SetAttrBatch('forced_update_label', {'1.1.1.1': 'a', '2.2.2.2': 'b'})
+    self.assertEqual(
+        table.GetAttrsBatch(['1.1.1.1', '2.2.2.2', '3.3.3.3']),
+        {'1.1.1.1': {'forced_update_label': 'a'},
+         '2.2.2.2': {'forced_update_label': 'b'},
+         '3.3.3.3': None})
+
+  def testAttrsBatchKeepsItsHosts(self):
+    """Tests that a batch larger than the table doesn't expire itself."""
+    table = self._NewTable(max_hosts=2)
+    table.SetAttr('1.1.1.1', 'last_known_version', '1.0.0')
+    labels = {'2.2.2.2': 'a', '3.3.3.3': 'b', '4.4.4.4': 'c'}
+    table.SetAttrBatch('forced_update_label', labels)
+    self.assertEqual(sorted(table.GetHostIds()), sorted(labels))
+
+  def testJobs(self):
+    store = shared_state.SharedStore(self._path)
+    other_store = shared_state.SharedStore(self._path)
+    self.assertEqual(store.WaitForJob('job'), None)
+    self.assertTrue(store.StartJob('job'))
+    self.assertFalse(other_store.StartJob('job'))
+    store.FinishJob('job', 'failed')
+    self.assertEqual(other_store.WaitForJob('job'), 'failed')
+
+    # Finished jobs may be run again.
+    self.assertTrue(other_store.StartJob('job'))
+    other_store.FinishJob('job')
+    self.assertEqual(store.WaitForJob('job'), '')
+
+    # The foreground part of a job is waited for on its own.
+    self.assertTrue(store.StartJob('job'))
+    store.FinishJobForeground('job')
+    self.assertEqual(other_store.WaitForJob('job', foreground=True), '')
+    self.assertFalse(other_store.StartJob('job'))
+
+  def testJobOfExitedProcess(self):
+    """Tests that a job abandoned by its process counts as failed."""
+    store = shared_state.SharedStore(self._path)
+    pid = os.fork()
+    if not pid:
+      store.StartJob('job')
+      os._exit(0)
+    os.waitpid(pid, 0)
+    self.assertTrue(store.WaitForJob('job'))
+    self.assertTrue(store.StartJob('job'))
+
+
+if __name__ == '__main__':
+  unittest.main()
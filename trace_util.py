@@ -0,0 +1,242 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Timing of the stages of requests.
+
+A trace times one request, identified by a request id, as a list of named
+spans: the stages the request went through, such as parsing, hashing or
+generating a payload. Spans are opened within the trace of the current
+thread, and cost next to nothing on threads without one. Finished traces are
+kept in a bounded ring, newest first, for /api/traces. Usage:
+
+  with trace_util.Trace('update', request_id):
+    ...
+    with trace_util.Span('parse_request'):
+      ...
+
+  @trace_util.TracedMethod
+  def Stage(self):
+    ...
+
+Traces are kept per process; with several worker processes, each keeps the
+traces of the requests it served.
+"""
+
+import collections
+import contextlib
+import functools
+import random
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args, **kwargs):
+  return log_util.LogWithTag('TRACE', message, *args, **kwargs)
+
+
+DEFAULT_MAX_TRACES = 1000
+
+# Spans recorded per trace, beyond which further ones are only counted, so a
+# loop of spans can't grow a trace without bound.
+_MAX_SPANS = 200
+
+# Finished traces, oldest first.
+_traces = collections.deque(maxlen=DEFAULT_MAX_TRACES)
+_traces_lock = threading.Lock()
+
+# Traces taking at least this many seconds are logged; None disables this.
+_slow_seconds = None
+
+# The trace of the current thread, and the nesting depth of its open spans.
+_local = threading.local()
+
+
+class _Trace(object):
+  """The timings of a request.
+
+  Members:
+    request_id: identifier of the request.
+    name: name of the request, e.g. its path.
+    start: time the trace started, in seconds since the epoch.
+    duration: seconds the trace took, or None while it is running.
+    spans: list of (name, start offset, duration, depth) tuples of the spans
+           of the trace, in order of completion; depth is 1 for outermost
+           spans.
+    error: name of the exception that ended the trace, if any.
+  """
+
+  def __init__(self, name, request_id):
+    self.request_id = request_id
+    self.name = name
+    self.start = time.time()
+    self.duration = None
+    self.spans = []
+    self.num_dropped_spans = 0
+    self.error = None
+
+  def AddSpan(self, name, start, duration, depth):
+    """Records a span, given its start time in seconds since the epoch."""
+    if len(self.spans) < _MAX_SPANS:
+      self.spans.append((name, start - self.start, duration, depth))
+    else:
+      self.num_dropped_spans += 1
+
+  def ToDict(self):
+    """Returns the trace as a dictionary, for JSON encoding."""
+    return {
+        'request_id': self.request_id,
+        'name': self.name,
+        'start': self.start,
+        'duration': self.duration,
+        'error': self.error,
+        'spans': [{'name': name, 'offset': offset, 'duration': duration,
+                   'depth': depth}
+                  for name, offset, duration, depth in self.spans],
+        'dropped_spans': self.num_dropped_spans,
+    }
+
+
+def NewRequestId():
+  """Returns a new random request id."""
+  return '%016x' % random.getrandbits(64)
+
+
+def Configure(max_traces=DEFAULT_MAX_TRACES, slow_seconds=None):
+  """Sets how many traces are kept and which ones are logged.
+
+  Args:
+    max_traces: number of finished traces kept.
+    slow_seconds: log traces taking at least this many seconds, with their
+                  spans; None to log none.
+  """
+  # pylint: disable=W0603
+  global _traces, _slow_seconds
+  with _traces_lock:
+    _traces = collections.deque(_traces, maxlen=max_traces)
+  _slow_seconds = slow_seconds
+
+
+def GetCurrentTrace():
+  """Returns the trace of the current thread, or None."""
+  return getattr(_local, 'trace', None)
+
+
+def GetRequestId():
+  """Returns the request id of the trace of the current thread, or None."""
+  trace = GetCurrentTrace()
+  return trace and trace.request_id
+
+
+@contextlib.contextmanager
+def Resume(trace):
+  """Continues a trace of another thread on the current thread.
+
+  Spans opened on the current thread within the block are added to the
+  trace. Use this to follow a request handed to another thread.
+
+  Args:
+    trace: a trace, as returned by GetCurrentTrace(), or None.
+  """
+  saved = (GetCurrentTrace(), getattr(_local, 'depth', 0))
+  _local.trace, _local.depth = trace, 0
+  try:
+    yield
+  finally:
+    _local.trace, _local.depth = saved
+
+
+@contextlib.contextmanager
+def Span(name):
+  """Times a block as a span of the trace of the current thread, if any."""
+  trace = GetCurrentTrace()
+  if trace is None:
+    yield
+    return
+
+  _local.depth += 1
+  start = time.time()
+  try:
+    yield
+  finally:
+    trace.AddSpan(name, start, time.time() - start, _local.depth)
+    _local.depth -= 1
+
+
+def TracedMethod(method):
+  """Decorates a method to time its calls as spans named Class.method."""
+  @functools.wraps(method)
+  def Wrapper(self, *args, **kwargs):
+    if GetCurrentTrace() is None:
+      return method(self, *args, **kwargs)
+    with Span('%s.%s' % (self.__class__.__name__, method.__name__)):
+      return method(self, *args, **kwargs)
+  return Wrapper
+
+
+def _Finish(trace):
+  """Keeps a finished trace, and logs it if it was slow."""
+  with _traces_lock:
+    _traces.append(trace)
+
+  if _slow_seconds is not None and trace.duration >= _slow_seconds:
+    _Log('Slow request %s to %s took %.3fs: %s', trace.request_id, trace.name,
+         trace.duration,
+         ', '.join('%s %.3fs' % (name, duration)
+                   for name, _, duration, depth in trace.spans if depth == 1),
+         level=log_util.WARNING)
+
+
+@contextlib.contextmanager
+def Trace(name, request_id=None):
+  """Traces a block as the handling of a request.
+
+  Within a trace of the current thread, this is a span of it instead.
+
+  Args:
+    name: name of the request, e.g. its path.
+    request_id: identifier of the request; a new one by default.
+  """
+  if GetCurrentTrace() is not None:
+    with Span(name):
+      yield
+    return
+
+  trace = _Trace(name, request_id or NewRequestId())
+  _local.trace, _local.depth = trace, 0
+  try:
+    yield
+  except BaseException, e:
+    trace.error = e.__class__.__name__
+    raise
+  finally:
+    _local.trace = None
+    trace.duration = time.time() - trace.start
+    _Finish(trace)
+
+
+def GetTraces(name=None, request_id=None, min_seconds=None, limit=None):
+  """Returns finished traces as dictionaries, newest first.
+
+  Args:
+    name: only return traces whose name starts with this.
+    request_id: only return traces of this request.
+    min_seconds: only return traces taking at least this many seconds.
+    limit: maximum number of traces to return.
+  """
+  with _traces_lock:
+    traces = list(_traces)
+
+  result = []
+  for trace in reversed(traces):
+    if limit is not None and len(result) >= limit:
+      break
+    if ((name and not trace.name.startswith(name)) or
+        (request_id and trace.request_id != request_id) or
+        (min_seconds is not None and trace.duration < min_seconds)):
+      continue
+    result.append(trace.ToDict())
+  return result
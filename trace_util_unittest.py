@@ -0,0 +1,89 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for trace_util module."""
+
+import threading
+import unittest
+
+import trace_util
+
+
+class Stager(object):
+  """A class with a traced method."""
+
+  @trace_util.TracedMethod
+  def Stage(self, value):
+    return value
+
+
+class TraceUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    trace_util.Configure()
+
+  def testTrace(self):
+    with trace_util.Trace('/update', 'abc'):
+      self.assertEqual(trace_util.GetRequestId(), 'abc')
+      with trace_util.Span('parse'):
+        pass
+      with trace_util.Span('generate'):
+        with trace_util.Span('hash'):
+          pass
+      self.assertEqual(Stager().Stage(3), 3)
+    self.assertEqual(trace_util.GetRequestId(), None)
+
+    [trace] = trace_util.GetTraces(request_id='abc')
+    self.assertEqual(trace['name'], '/update')
+    self.assertEqual(trace['error'], None)
+    self.assertEqual([(span['name'], span['depth'])
+                      for span in trace['spans']],
+                     [('parse', 1), ('hash', 2), ('generate', 1),
+                      ('Stager.Stage', 1)])
+
+  def testSpanWithoutTrace(self):
+    with trace_util.Span('parse'):
+      pass
+    self.assertEqual(Stager().Stage(3), 3)
+
+  def testError(self):
+    def Fail():
+      with trace_util.Trace('/fail', 'def'):
+        raise ValueError('oops')
+    self.assertRaises(ValueError, Fail)
+    [trace] = trace_util.GetTraces(request_id='def')
+    self.assertEqual(trace['error'], 'ValueError')
+
+  def testResume(self):
+    """Tests that spans on another thread are added to a resumed trace."""
+    def Run(trace):
+      with trace_util.Resume(trace):
+        with trace_util.Span('executor'):
+          pass
+
+    with trace_util.Trace('/download', 'ghi'):
+      thread = threading.Thread(target=Run,
+                                args=(trace_util.GetCurrentTrace(),))
+      thread.start()
+      thread.join()
+    [trace] = trace_util.GetTraces(request_id='ghi')
+    self.assertEqual([span['name'] for span in trace['spans']], ['executor'])
+
+  def testGetTraces(self):
+    trace_util.Configure(max_traces=2)
+    for name in ('/a', '/b', '/c'):
+      with trace_util.Trace(name):
+        pass
+    self.assertEqual([trace['name'] for trace in trace_util.GetTraces()],
+                     ['/c', '/b'])
+    self.assertEqual([trace['name'] for trace in trace_util.GetTraces(
+        name='/b')], ['/b'])
+    self.assertEqual(len(trace_util.GetTraces(limit=1)), 1)
+    self.assertEqual(trace_util.GetTraces(min_seconds=60), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
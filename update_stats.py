@@ -0,0 +1,130 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Fleet-wide counters of update activity, in rolling time buckets."""
+
+import threading
+import time
+
+
+# Default width of a bucket in seconds, and number of buckets kept. Together
+# they determine the longest window that can be queried.
+DEFAULT_BUCKET_SECONDS = 60
+DEFAULT_NUM_BUCKETS = 60
+
+# Default maximum number of distinct keys counted per bucket. Keys beyond that
+# are counted under OVERFLOW_KEY, so that memory use stays fixed no matter how
+# many boards and versions report in.
+DEFAULT_MAX_KEYS = 1000
+
+OVERFLOW_KEY = ('other', 'other', None, None)
+
+# Names of the fields of a counter key, as used in query results.
+_KEY_FIELDS = ('board', 'version', 'event_type', 'event_result')
+
+
+class UpdateStatsError(Exception):
+  """Exception classes used by this module."""
+  pass
+
+
+class _Bucket(object):
+  """Counts of one time slot, keyed by (board, version, type, result)."""
+  __slots__ = ('start', 'counts')
+
+  def __init__(self, start):
+    self.start = start
+    self.counts = {}
+
+
+class UpdateStats(object):
+  """Counts update pings and events over a sliding window of time.
+
+  Time is divided into slots of bucket_seconds; a ring of num_buckets buckets
+  holds the counts of the most recent slots, and a bucket is reused once its
+  slot has gone out of range.
+  """
+
+  def __init__(self, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+               num_buckets=DEFAULT_NUM_BUCKETS, max_keys=DEFAULT_MAX_KEYS):
+    self.bucket_seconds = bucket_seconds
+    self.num_buckets = num_buckets
+    self.max_keys = max_keys
+    self._buckets = [None] * num_buckets
+    self._lock = threading.Lock()
+
+  def Record(self, board, version, event_type=None, event_result=None,
+             now=None):
+    """Counts one update ping or event.
+
+    Args:
+      board: board reported by the host.
+      version: version reported by the host.
+      event_type: type of the reported event; None for an update check.
+      event_result: result of the reported event; None for an update check.
+      now: time of the event in seconds since the epoch; defaults to now.
+    """
+    if now is None:
+      now = time.time()
+    slot = int(now // self.bucket_seconds)
+    key = (board, version, event_type, event_result)
+    with self._lock:
+      index = slot % self.num_buckets
+      bucket = self._buckets[index]
+      if bucket is None or bucket.start != slot:
+        bucket = self._buckets[index] = _Bucket(slot)
+      if key not in bucket.counts and len(bucket.counts) >= self.max_keys:
+        key = OVERFLOW_KEY
+      bucket.counts[key] = bucket.counts.get(key, 0) + 1
+
+  def Query(self, window=None, board=None, version=None, now=None):
+    """Sums the counts of recent buckets.
+
+    Buckets overlapping the window count in full, so counts may include up to
+    bucket_seconds of activity older than the window.
+
+    Args:
+      window: number of seconds to look back; defaults to (and is capped at)
+              everything kept.
+      board: if set, only count activity of this board.
+      version: if set, only count activity of this version.
+      now: end of the window in seconds since the epoch; defaults to now.
+    Returns:
+      A list of dictionaries with board, version, event_type, event_result
+      and count fields, ordered by key.
+    Raises:
+      UpdateStatsError: if the window is not positive.
+    """
+    if now is None:
+      now = time.time()
+    max_window = self.bucket_seconds * self.num_buckets
+    if window is None:
+      window = max_window
+    elif window <= 0:
+      raise UpdateStatsError('Window must be positive: %r' % window)
+    window = min(window, max_window)
+
+    last_slot = int(now // self.bucket_seconds)
+    # Any bucket overlapping the window counts in full.
+    first_slot = int((now - window) // self.bucket_seconds)
+    first_slot = max(first_slot, last_slot - self.num_buckets + 1)
+
+    totals = {}
+    with self._lock:
+      for bucket in self._buckets:
+        if bucket is None or not first_slot <= bucket.start <= last_slot:
+          continue
+        for key, count in bucket.counts.iteritems():
+          totals[key] = totals.get(key, 0) + count
+
+    results = []
+    for key in sorted(totals):
+      if board is not None and key[0] != board:
+        continue
+      if version is not None and key[1] != version:
+        continue
+      result = dict(zip(_KEY_FIELDS, key))
+      result['count'] = totals[key]
+      results.append(result)
+    return results
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for update_stats module."""
+
+import unittest
+
+import update_stats
+
+
+class UpdateStatsTest(unittest.TestCase):
+
+  def setUp(self):
+    self._stats = update_stats.UpdateStats(bucket_seconds=60, num_buckets=10,
+                                           max_keys=3)
+
+  def testQueryWindow(self):
+    """Tests that counts are summed over buckets within the window only."""
+    self._stats.Record('x86-alex', '1.0', 3, 2, now=1000)
+    self._stats.Record('x86-alex', '1.0', 3, 2, now=1130)
+    self._stats.Record('x86-alex', '1.0', now=1130)
+    self._stats.Record('lumpy', '2.0', 3, 0, now=1150)
+
+    self.assertEqual(self._stats.Query(now=1150), [
+        {'board': 'lumpy', 'version': '2.0', 'event_type': 3,
+         'event_result': 0, 'count': 1},
+        {'board': 'x86-alex', 'version': '1.0', 'event_type': None,
+         'event_result': None, 'count': 1},
+        {'board': 'x86-alex', 'version': '1.0', 'event_type': 3,
+         'event_result': 2, 'count': 2}])
+    # The bucket at 1000 is out of a two minute window.
+    self.assertEqual(
+        [stat['count'] for stat in self._stats.Query(window=120, now=1150,
+                                                     board='x86-alex')],
+        [1, 1])
+    self.assertEqual(self._stats.Query(version='3.0', now=1150), [])
+    self.assertRaises(update_stats.UpdateStatsError, self._stats.Query,
+                      window=0)
+
+  def testQueryWindowBoundary(self):
+    """Tests that the bucket the window starts in counts in full."""
+    self._stats.Record('x86-alex', '1.0', now=1020)
+    self._stats.Record('x86-alex', '1.0', now=1079)
+    self._stats.Record('x86-alex', '1.0', now=1150)
+    # The window starts at 1050, in the bucket from 1020 to 1080.
+    self.assertEqual(
+        [stat['count'] for stat in self._stats.Query(window=100, now=1150)],
+        [3])
+    self.assertEqual(
+        [stat['count'] for stat in self._stats.Query(window=70, now=1150)],
+        [1])
+
+  def testBucketsAreReused(self):
+    """Tests that counts older than all buckets are forgotten."""
+    self._stats.Record('x86-alex', '1.0', now=0)
+    self._stats.Record('x86-alex', '1.0', now=600)
+    self.assertEqual(
+        [stat['count'] for stat in self._stats.Query(window=10 ** 6, now=600)],
+        [1])
+
+  def testKeysAreBounded(self):
+    for version in range(5):
+      self._stats.Record('x86-alex', str(version), now=0)
+    stats = self._stats.Query(now=0)
+    self.assertEqual(len(stats), 4)
+    self.assertEqual(stats[0]['board'], 'other')
+    self.assertEqual(stats[0]['count'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,73 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Ordering of Chrome OS version and build strings.
+
+All forms in use compare consistently through VersionKey():
+  - new-style platform versions, e.g. 1098.0.2011_09_28_1635 or 2241.0.0;
+  - old four-token versions, e.g. 0.16.892.0, whose first two tokens are
+    ignored so that they compare to new-style versions (as 892.0);
+  - build names, e.g. R17-1413.0.0-a1-b1346, ordered by milestone first.
+"""
+
+import re
+
+
+# Splits a version into an optional milestone, its dotted platform version and
+# whatever follows it.
+_VERSION_RE = re.compile(r'^(?:R(\d+)-)?(\d[\d_]*(?:\.[\d_]+)*)(.*)$')
+
+# Splits a suffix (or an unparsable version) into numbers and words.
+_COMPONENT_RE = re.compile(r'\d+|[a-zA-Z]+')
+
+# Parsed keys, shared by all users of a version string. Cleared when it grows
+# beyond the limit, which a devserver won't reach in practice.
+_key_cache = {}
+_MAX_CACHED_KEYS = 1 << 16
+
+
+def _Components(string):
+  return tuple(int(component) if component.isdigit() else component
+               for component in _COMPONENT_RE.findall(string))
+
+
+def _ParseVersion(version):
+  match = _VERSION_RE.match(version)
+  if not match:
+    # Not a version at all; order it before all versions, consistently.
+    return (-1, (), _Components(version))
+
+  milestone, platform_version, suffix = match.groups()
+  tokens = tuple(int(token.replace('_', ''))
+                 for token in platform_version.split('.'))
+  # If the version is an old four-token one like "0.16.892.0", drop the first
+  # two tokens -- we use versions like "892.0.0" now.
+  # TODO(derat): Remove the code for old-style versions after 20120101.
+  if len(tokens) == 4:
+    tokens = tokens[2:]
+  return (int(milestone) if milestone else 0, tokens, _Components(suffix))
+
+
+def VersionKey(version):
+  """Returns a key that orders version strings, e.g. for sorted().
+
+  Keys are tuples of (milestone, platform version tokens, suffix components).
+  Platform versions compare token by token, a longer one winning a tie, so
+  892.0.0 is newer than the old-style 0.16.892.0. Versions without a milestone
+  order before those with one. Suffix components are numbers and words;
+  numbers order before words, as with distutils' LooseVersion.
+
+  Parsing happens once per distinct string; later calls return the same key.
+  """
+  key = _key_cache.get(version)
+  if key is None:
+    if len(_key_cache) >= _MAX_CACHED_KEYS:
+      _key_cache.clear()
+    key = _key_cache[version] = _ParseVersion(version)
+  return key
+
+
+def IsNewer(version, other_version):
+  """Returns whether a version is strictly newer than another one."""
+  return VersionKey(version) > VersionKey(other_version)
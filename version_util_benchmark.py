@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmarks version_util against the version comparisons it replaced.
+
+Compares, over a set of random version strings:
+  - pairwise update checks, as Autoupdate._CanUpdate used to tokenize both
+    versions on every ping, against version_util.IsNewer;
+  - sorting build names with distutils' LooseVersion, as GetLatestBuildVersion
+    used to, against sorting with version_util.VersionKey.
+"""
+
+import distutils.version
+import optparse
+import random
+import timeit
+
+import version_util
+
+
+def _OldCanUpdate(client_version, latest_version):
+  """The token comparison formerly done by Autoupdate._CanUpdate."""
+  client_tokens = client_version.replace('_', '').split('.')
+  if len(client_tokens) == 4:
+    client_tokens = client_tokens[2:]
+  latest_tokens = latest_version.replace('_', '').split('.')
+  if len(latest_tokens) == 4:
+    latest_tokens = latest_tokens[2:]
+  for i in range(min(len(client_tokens), len(latest_tokens))):
+    if int(latest_tokens[i]) == int(client_tokens[i]):
+      continue
+    return int(latest_tokens[i]) > int(client_tokens[i])
+  return len(latest_tokens) > len(client_tokens)
+
+
+def _RandomVersions(count, num_distinct):
+  """Returns |count| platform versions drawn from |num_distinct| ones."""
+  distinct = ['%d.%d.%d' % (random.randint(1000, 3000), random.randint(0, 9),
+                            random.randint(0, 99))
+              for _ in range(num_distinct)]
+  return [random.choice(distinct) for _ in range(count)]
+
+
+def _RandomBuilds(count):
+  return ['R%d-%d.%d.0-a1-b%d' % (random.randint(15, 25),
+                                  random.randint(1000, 3000),
+                                  random.randint(0, 9),
+                                  random.randint(1, 5000))
+          for _ in range(count)]
+
+
+def _Time(func, repeat):
+  return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--count', type='int', default=50000,
+                    help='number of version strings (default: %default)')
+  parser.add_option('--distinct', type='int', default=200,
+                    help='number of distinct client versions, as in a fleet '
+                         '(default: %default)')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='runs to take the best time of (default: %default)')
+  options, _ = parser.parse_args()
+
+  random.seed(0)
+  clients = _RandomVersions(options.count, options.distinct)
+  latest = '2500.0.0'
+  builds = _RandomBuilds(options.count)
+
+  old = _Time(lambda: [_OldCanUpdate(client, latest) for client in clients],
+              options.repeat)
+  new = _Time(lambda: [version_util.IsNewer(latest, client)
+                       for client in clients], options.repeat)
+  print 'update checks (%d):  tokenize %.3fs  VersionKey %.3fs  (%.1fx)' % (
+      options.count, old, new, old / new)
+
+  old = _Time(lambda: sorted(
+      [distutils.version.LooseVersion(build) for build in builds]),
+              options.repeat)
+  version_util._key_cache.clear()
+  new = _Time(lambda: sorted(builds, key=version_util.VersionKey),
+              options.repeat)
+  print 'build sort (%d):     LooseVersion %.3fs  VersionKey %.3fs  (%.1fx)' % (
+      options.count, old, new, old / new)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for version_util module."""
+
+import unittest
+
+import version_util
+
+
+class VersionUtilTest(unittest.TestCase):
+
+  def testPlatformVersions(self):
+    self.assertTrue(version_util.IsNewer('1098.0.2011_09_30_0806',
+                                         '1098.0.2011_09_28_1635'))
+    self.assertTrue(version_util.IsNewer('1100.0.0', '1098.0.0'))
+    self.assertFalse(version_util.IsNewer('1098.0.0', '1098.0.0'))
+    # Tokens compare as numbers, not strings.
+    self.assertTrue(version_util.IsNewer('1000.0.0', '999.0.0'))
+
+  def testOldStyleVersions(self):
+    """Tests that the first two tokens of four-token versions are ignored."""
+    self.assertTrue(version_util.IsNewer('892.0.0', '0.16.892.0'))
+    self.assertFalse(version_util.IsNewer('890.0.0', '0.16.892.0'))
+    self.assertTrue(version_util.IsNewer('0.16.892.1', '0.16.892.0'))
+
+  def testBuildNames(self):
+    """Tests that build names order by milestone, version, then suffix."""
+    builds = ['R17-18.0.0-a1-b1346', 'R16-2241.0.0-a0-b2',
+              'R17-1413.0.0-a1-b1346', 'R17-1413.0.0-a1-b999', 'latest',
+              '1500.0.0']
+    self.assertEqual(sorted(builds, key=version_util.VersionKey),
+                     ['latest', '1500.0.0', 'R16-2241.0.0-a0-b2',
+                      'R17-18.0.0-a1-b1346', 'R17-1413.0.0-a1-b999',
+                      'R17-1413.0.0-a1-b1346'])
+
+  def testKeysAreShared(self):
+    self.assertTrue(version_util.VersionKey('R17-1413.0.0-a1') is
+                    version_util.VersionKey('R17-1413.0.0-a1'))
+
+
+if __name__ == '__main__':
+  unittest.main()